@@ -1,7 +1,10 @@
 import functools as fct
 import os
+import threading
 import warnings
+from collections import OrderedDict
 from typing import List, Optional, Tuple, Union
+from uuid import uuid4
 
 import cv2
 import cvxpy as cvx
@@ -18,8 +21,9 @@ import sparse
 import xarray as xr
 import zarr
 from distributed import get_client
-from scipy.linalg import lstsq, toeplitz
+from scipy.linalg import lstsq, solve_triangular, toeplitz
 from scipy.ndimage import label
+from scipy.optimize import nnls
 from scipy.signal import butter, lfilter, welch
 from scipy.sparse import dia_matrix
 from skimage import morphology as moph
@@ -27,8 +31,11 @@ from sklearn.linear_model import LassoLars
 from statsmodels.tsa.stattools import acovf
 
 from .utilities import (
+    as_dense,
+    as_sparse,
     custom_arr_optimize,
     custom_delay_optimize,
+    is_sparse,
     open_minian,
     rechunk_like,
     save_minian,
@@ -235,6 +242,7 @@ def update_spatial(
     normalize=True,
     size_thres=(9, None),
     in_memory=False,
+    solver="lars",
 ) -> Tuple[xr.DataArray, xr.DataArray, xr.DataArray, xr.DataArray]:
     """
     Update spatial components given the input data and temporal dynamic for each
@@ -263,7 +271,8 @@ def update_spatial(
         Input movie data. Should have dimensions "height", "width" and "frame".
     A : xr.DataArray
         Previous estimation of spatial footprints. Should have dimension
-        "height", "width" and "unit_id".
+        "height", "width" and "unit_id". Can be sparse-backed (see
+        :func:`minian.utilities.as_sparse`).
     C : xr.DataArray
         Estimation of temporal component for each cell. Should have dimension
         "frame" and "unit_id".
@@ -294,12 +303,21 @@ def update_spatial(
     in_memory : bool, optional
         Whether to load `C` into memory before spatial update. By default
         `False`.
+    solver : str, optional
+        Method used to solve the optimization problem. If `"lars"`, then each
+        pixel is solved with :class:`sklearn.linear_model.LassoLars`, see
+        :func:`update_spatial_perpx`. If `"cd"`, then all pixels in a block are
+        solved with coordinate descent on the Gram matrix of temporal
+        components, warm-started from `A`, which is considerably faster on long
+        recordings. See :func:`update_spatial_block` for details. By default
+        `"lars"`.
 
     Returns
     -------
     A_new : xr.DataArray
         New estimation of spatial footprints. Same shape as `A` except the
-        "unit_id" dimension might be smaller due to filtering.
+        "unit_id" dimension might be smaller due to filtering. Sparse-backed if
+        `A` is sparse-backed.
     mask : xr.DataArray
         Boolean mask of whether a cell passed size filtering. Has dimension
         "unit_id" that is same as input `A`. Useful for subsetting other
@@ -330,29 +348,22 @@ def update_spatial(
     `sn` and the global scalar `sparse_penal`. Higher value of :math:`\\alpha`
     will result in more sparse estimation of spatial footprints.
     """
+    if solver not in ["lars", "cd"]:
+        raise NotImplementedError(solver)
     intpath = os.environ["MINIAN_INTERMEDIATE"]
     if in_memory:
         C_store = C.compute().values
     else:
         C_path = os.path.join(intpath, C.name + ".zarr", C.name)
         C_store = zarr.open_array(C_path)
+    # rows of `C` cached on the workers are only shared within this call
+    C_token = uuid4().hex
     print("estimating penalty parameter")
     alpha = sparse_penal * sn
     alpha = rechunk_like(alpha.compute(), sn)
     print("computing subsetting matrix")
-    selem = moph.disk(dl_wnd)
-    sub = xr.apply_ufunc(
-        cv2.dilate,
-        A,
-        input_core_dims=[["height", "width"]],
-        output_core_dims=[["height", "width"]],
-        vectorize=True,
-        kwargs=dict(kernel=selem),
-        dask="parallelized",
-        output_dtypes=[A.dtype],
-    )
-    sub = sub > 0
-    sub.data = sub.data.map_blocks(sparse.COO)
+    sub = dilate_footprints(A, moph.disk(dl_wnd))
+    A_init = as_sparse(A)
     if update_background:
         assert b is not None, "`b` must be provided when updating background"
         assert f is not None, "`f` must be provided when updating background"
@@ -360,18 +371,20 @@ def update_spatial(
         b_in.data = b_in.data.map_blocks(sparse.COO)
         b_in = b_in.compute()
         sub = xr.concat([sub, b_in], "unit_id")
+        b_init = rechunk_like(b, Y).assign_coords(unit_id=-1).expand_dims("unit_id")
+        b_init.data = b_init.data.map_blocks(sparse.COO)
+        A_init = xr.concat([A_init, b_init.compute()], "unit_id")
         f_in = f.compute().data
     else:
         f_in = None
-    sub = rechunk_like(sub.transpose("height", "width", "unit_id").compute(), Y)
+    sub = sub.transpose("height", "width", "unit_id").compute()
+    sub_crd = sub.data.coords
+    sub = rechunk_like(sub, Y)
+    A_init = rechunk_like(A_init.transpose("height", "width", "unit_id").compute(), Y)
     print("fitting spatial matrix")
-    ssub = darr.map_blocks(
-        sps_any,
-        sub.data,
-        drop_axis=2,
-        chunks=((1, 1)),
-        meta=sparse.ones(1).astype(bool),
-    ).compute()
+    # blocks with any unit are located from the exact coordinates of the
+    # dilated masks, which are tighter than any index of their bounding boxes
+    ssub = sps_block_any(sub_crd, sub.data.chunks)
     Y_trans = Y.transpose("height", "width", "frame")
     # take fast route if a lot of chunks are empty
     if ssub.sum() < 500:
@@ -383,8 +396,11 @@ def update_spatial(
                     Y_trans.data.blocks[hblk, wblk, :],
                     alpha.data.blocks[hblk, wblk],
                     cur_sub,
+                    A_init.data.blocks[hblk, wblk, :],
                     C_store=C_store,
+                    C_token=C_token,
                     f=f_in,
+                    solver=solver,
                 )
             else:
                 cur_blk = darr.array(sparse.zeros((cur_sub.shape)))
@@ -395,13 +411,21 @@ def update_spatial(
             Y_trans.data,
             alpha.data,
             sub.data,
+            A_init.data,
             C_store=C_store,
+            C_token=C_token,
             f=f_in,
+            solver=solver,
         )
     with da.config.set(**{"optimization.fuse.ave-width": 6}):
         A_new = da.optimize(A_new)[0]
+    A_new = darr.moveaxis(A_new, -1, 0)
+    if is_sparse(A):
+        A_new = A_new.map_blocks(sparse.COO, dtype=A.dtype)
+    else:
+        A_new = A_new.map_blocks(lambda a: a.todense(), dtype=A.dtype)
     A_new = xr.DataArray(
-        darr.moveaxis(A_new, -1, 0).map_blocks(lambda a: a.todense(), dtype=A.dtype),
+        A_new,
         dims=["unit_id", "height", "width"],
         coords={
             "unit_id": sub.coords["unit_id"],
@@ -415,9 +439,14 @@ def update_spatial(
         overwrite=True,
         chunks={"unit_id": 1, "height": -1, "width": -1},
     )
+    clear_C_rows(C_token)
+    try:
+        get_client().run(clear_C_rows, C_token)
+    except ValueError:
+        pass
     add_rets = []
     if update_background:
-        b_new = A_new.sel(unit_id=-1).compute()
+        b_new = as_dense(A_new.sel(unit_id=-1)).compute()
         A_new = A_new[:-1, :, :]
         add_rets.append(b_new)
     if size_thres:
@@ -426,41 +455,133 @@ def update_spatial(
         mask = np.ones(A_new.sizes["unit_id"], dtype=bool)
         if low:
             mask = np.logical_and(
-                (A_bin.sum(["height", "width"]) > low).compute(), mask
+                as_dense(A_bin.sum(["height", "width"]) > low).compute(), mask
             )
         if high:
             mask = np.logical_and(
-                (A_bin.sum(["height", "width"]) < high).compute(), mask
+                as_dense(A_bin.sum(["height", "width"]) < high).compute(), mask
             )
         mask = xr.DataArray(
             mask, dims=["unit_id"], coords={"unit_id": A_new.coords["unit_id"].values}
         )
     else:
-        mask = (A_new.sum(["height", "width"]) > 0).compute()
+        mask = as_dense(A_new.sum(["height", "width"]) > 0).compute()
     print("{} out of {} units dropped".format(len(mask) - mask.sum().values, len(mask)))
     A_new = A_new.sel(unit_id=mask)
     if normalize:
-        norm_fac = A_new.max(["height", "width"]).compute()
+        norm_fac = as_dense(A_new.max(["height", "width"])).compute()
         A_new = A_new / norm_fac
         add_rets.append(norm_fac)
     return (A_new, mask, *add_rets)
 
 
-def sps_any(x: sparse.COO) -> np.ndarray:
+def dilate_footprints(A: xr.DataArray, selem: np.ndarray) -> xr.DataArray:
     """
-    Compute `any` on a sparse array.
+    Compute the dilated binary masks of spatial footprints.
+
+    The result is the same as applying :func:`cv2.dilate` to the full
+    field-of-view of each cell and thresholding at zero, but only the bounding
+    box of each cell padded by the size of `selem` is dilated, and the result
+    is assembled directly as sparse coordinates.
 
     Parameters
     ----------
-    x : sparse.COO
-        Input sparse array.
+    A : xr.DataArray
+        Spatial footprints of cells. Should have dimensions ("unit_id",
+        "height", "width"). Can be dense or sparse-backed.
+    selem : np.ndarray
+        Structuring element used for dilation.
+
+    Returns
+    -------
+    sub : xr.DataArray
+        The dilated masks as an in-memory boolean array backed by
+        :class:`sparse.COO`. Has the same dimensions and coordinates as `A`.
+    """
+    A = A.transpose("unit_id", "height", "width")
+    nu, h, w = A.shape
+    if is_sparse(A):
+        A_sps = A.data
+        if isinstance(A_sps, darr.Array):
+            A_sps = A_sps.compute()
+        A_sps = sparse.COO(A_sps)
+        crd = A_sps.coords[:, A_sps.data > 0]
+    else:
+        arr = darr.asarray(A.data)
+        offs = [np.cumsum((0,) + c[:-1]) for c in arr.chunks]
+        blks = zip(np.ndindex(*arr.numblocks), arr.to_delayed().ravel())
+        crd = da.compute(
+            *[
+                da.delayed(nonzero_coords)(blk, [o[i] for o, i in zip(offs, idx)])
+                for idx, blk in blks
+            ]
+        )
+        crd = np.concatenate(crd, axis=1)
+    crd = crd[:, np.argsort(crd[0], kind="stable")]
+    ustart = np.searchsorted(crd[0], np.arange(nu + 1))
+    dh, dw = selem.shape[0] // 2, selem.shape[1] // 2
+    selem = selem.astype(np.uint8)
+    crd_ls = [np.zeros((3, 0), dtype=int)]
+    for uid in range(nu):
+        hs, ws = crd[1:, ustart[uid] : ustart[uid + 1]]
+        if not len(hs):
+            continue
+        h0, w0 = max(hs.min() - dh, 0), max(ws.min() - dw, 0)
+        h1, w1 = min(hs.max() + dh + 1, h), min(ws.max() + dw + 1, w)
+        patch = np.zeros((h1 - h0, w1 - w0), dtype=np.uint8)
+        patch[hs - h0, ws - w0] = 1
+        ph, pw = np.nonzero(cv2.dilate(patch, selem))
+        crd_ls.append(np.stack([np.full(len(ph), uid), ph + h0, pw + w0]))
+    crd = np.concatenate(crd_ls, axis=1)
+    sub = sparse.COO(crd, data=np.ones(crd.shape[1], dtype=bool), shape=(nu, h, w))
+    return xr.DataArray(sub, dims=A.dims, coords=A.coords)
+
+
+def nonzero_coords(a: np.ndarray, offset: List[int]) -> np.ndarray:
+    """
+    Find coordinates of positive entries in an array.
+
+    Parameters
+    ----------
+    a : np.ndarray
+        Input array.
+    offset : List[int]
+        Offset added to the coordinates along each dimension.
 
     Returns
     -------
-    x_any : np.ndarray
-        2d boolean numpy array.
+    crd : np.ndarray
+        Coordinates of positive entries with shape (a.ndim, n).
     """
-    return np.atleast_2d(x.nnz > 0)
+    crd = np.stack(np.unravel_index(np.flatnonzero(a > 0), a.shape))
+    return crd + np.array(offset, dtype=int).reshape((-1, 1))
+
+
+def sps_block_any(crd: np.ndarray, chunks: tuple) -> np.ndarray:
+    """
+    Compute whether each block along the first two dimensions contains any
+    nonzero entries of a sparse array.
+
+    Parameters
+    ----------
+    crd : np.ndarray
+        Coordinates of nonzero entries of the sparse array, as in
+        :attr:`sparse.COO.coords`.
+    chunks : tuple
+        Chunk sizes of the array in :doc:`dask:array-chunks` convention.
+
+    Returns
+    -------
+    blk_any : np.ndarray
+        2d boolean numpy array with one entry per block.
+    """
+    blk_any = np.zeros((len(chunks[0]), len(chunks[1])), dtype=bool)
+    blk_idx = [
+        np.searchsorted(np.cumsum(chk), c, side="right")
+        for chk, c in zip(chunks[:2], crd[:2])
+    ]
+    blk_any[tuple(blk_idx)] = True
+    return blk_any
 
 
 def update_spatial_perpx(
@@ -520,16 +641,107 @@ def update_spatial_perpx(
     return sparse.COO(coords=idx, data=coef, shape=sub.shape)
 
 
-@darr.as_gufunc(signature="(f),(),(u)->(u)", output_dtypes=float)
+C_ROWS_CACHE = OrderedDict()
+"""
+Per-worker cache of temporal components loaded by :func:`load_C_rows`, shared
+across all threads and blocks and keyed by the token of each call to
+:func:`update_spatial`.
+"""
+C_ROWS_LOCK = threading.Lock()
+
+
+def load_C_rows(
+    C_store: Union[np.ndarray, zarr.core.Array],
+    idx: np.ndarray,
+    token: Optional[str] = None,
+    nbytes=2 ** 28,
+) -> np.ndarray:
+    """
+    Load temporal components of selected units, with caching for zarr arrays.
+
+    Rows of a zarr array are kept in a least-recently-used cache shared by all
+    blocks processed on the same worker, so that each row is only read and
+    decompressed once across neighboring blocks. Cached rows are keyed by
+    `token`, which should be unique to the content of `C_store`, and can be
+    released with :func:`clear_C_rows`. Numpy arrays, or zarr arrays without a
+    `token`, are indexed directly.
+
+    Parameters
+    ----------
+    C_store : Union[np.ndarray, zarr.core.Array]
+        Estimation of temporal dynamics of cells with shape (unit_id, frame).
+    idx : np.ndarray
+        Indices of units to load.
+    token : str, optional
+        Key of `C_store` in the cache. By default `None`.
+    nbytes : int, optional
+        Maximum size of the cache in bytes. By default `2 ** 28`.
+
+    Returns
+    -------
+    C : np.ndarray
+        Temporal components of selected units with shape (len(idx), frame).
+    """
+    if not isinstance(C_store, zarr.core.Array):
+        return np.asarray(C_store[idx, :], dtype=float)
+    if token is None:
+        return np.asarray(
+            C_store.get_orthogonal_selection((idx, slice(None))), dtype=float
+        )
+    C = np.empty((len(idx), C_store.shape[1]))
+    missing = []
+    with C_ROWS_LOCK:
+        for i, u in enumerate(idx):
+            try:
+                C_ROWS_CACHE.move_to_end((token, u))
+                C[i] = C_ROWS_CACHE[(token, u)]
+            except KeyError:
+                missing.append(i)
+    if missing:
+        missing = np.array(missing)
+        C[missing] = C_store.get_orthogonal_selection((idx[missing], slice(None)))
+        nmax = max(int(nbytes // C.itemsize // C.shape[1]), 1)
+        with C_ROWS_LOCK:
+            for i in missing:
+                C_ROWS_CACHE[(token, idx[i])] = C[i].copy()
+            while len(C_ROWS_CACHE) > nmax:
+                C_ROWS_CACHE.popitem(last=False)
+    return C
+
+
+def clear_C_rows(token: str):
+    """
+    Remove all rows cached by :func:`load_C_rows` under a token.
+
+    Parameters
+    ----------
+    token : str
+        Key of the temporal components in the cache.
+    """
+    with C_ROWS_LOCK:
+        for key in [k for k in C_ROWS_CACHE if k[0] == token]:
+            del C_ROWS_CACHE[key]
+
+
+@darr.as_gufunc(signature="(f),(),(u),(u)->(u)", output_dtypes=float)
 def update_spatial_block(
-    y: np.ndarray, alpha: np.ndarray, sub: sparse.COO, **kwargs
+    y: np.ndarray, alpha: np.ndarray, sub: sparse.COO, a: sparse.COO, **kwargs
 ) -> sparse.COO:
     """
     Carry out spatial update for each 3d block of data.
 
-    This function wraps around :func:`update_spatial_perpx` so that it can be
-    applied to 3d blocks of data. Keyword arguments are passed to
-    :func:`update_spatial_perpx`.
+    If keyword argument `solver` is `"lars"` (the default), this function
+    simply calls :func:`update_spatial_perpx` for each pixel that has any
+    non-zero value in `sub`. If `solver` is `"cd"`, the same problem is solved
+    for all pixels in the block at once. The temporal components of all cells
+    touched by the block are loaded once, and the problem of each pixel is
+    formulated in terms of the Gram matrix `C @ C.T` and the projection `y @
+    C.T`, which are computed once for the block. The data are centered and
+    normalized in the same way as :class:`sklearn.linear_model.LassoLars`, and
+    each pixel is then solved with :func:`lasso_gram_cd`, warm-started from the
+    previous spatial footprints `a`. Keyword arguments `C_store` and `f` are
+    interpreted in the same way as :func:`update_spatial_perpx`, and keyword
+    argument `C_token` is passed to :func:`load_C_rows` as the cache key.
 
     Parameters
     ----------
@@ -540,6 +752,10 @@ def update_spatial_block(
         (height, width).
     sub : sparse.COO
         Subsetting matrix. Should have dimension (height, width, unit_id).
+    a : sparse.COO
+        Previous estimation of spatial footprints used as initial values. Only
+        used if `solver` is `"cd"`. Should have dimension (height, width,
+        unit_id).
 
     Returns
     -------
@@ -553,23 +769,246 @@ def update_spatial_block(
     update_spatial
     """
     C_store = kwargs.get("C_store")
+    C_token = kwargs.get("C_token")
     f = kwargs.get("f")
-    crd_ls = []
-    data_ls = []
-    for h, w in zip(*sub.any(axis=-1).nonzero()):
-        res = update_spatial_perpx(y[h, w, :], alpha[h, w], sub[h, w, :], C_store, f)
-        crd = res.coords
-        crd = np.concatenate([np.full_like(crd, h), np.full_like(crd, w), crd], axis=0)
-        crd_ls.append(crd)
-        data_ls.append(res.data)
-    if data_ls:
-        return sparse.COO(
-            coords=np.concatenate(crd_ls, axis=1),
-            data=np.concatenate(data_ls),
-            shape=sub.shape,
-        )
-    else:
-        return sparse.zeros(sub.shape)
+    if kwargs.get("solver", "lars") == "lars":
+        crd_ls = []
+        data_ls = []
+        for h, w in zip(*sub.any(axis=-1).nonzero()):
+            res = update_spatial_perpx(
+                y[h, w, :], alpha[h, w], sub[h, w, :], C_store, f
+            )
+            crd = res.coords
+            crd = np.concatenate(
+                [np.full_like(crd, h), np.full_like(crd, w), crd], axis=0
+            )
+            crd_ls.append(crd)
+            data_ls.append(res.data)
+        if data_ls:
+            return sparse.COO(
+                coords=np.concatenate(crd_ls, axis=1),
+                data=np.concatenate(data_ls),
+                shape=sub.shape,
+            )
+        else:
+            return sparse.zeros(sub.shape)
+    shape = sub.shape
+    nu = shape[-1]
+    sub = sub.reshape((-1, nu)).tocsr()
+    pxs = np.nonzero(np.diff(sub.indptr))[0]
+    if not len(pxs):
+        return sparse.zeros(shape)
+    sub = sub[pxs]
+    sub.sort_indices()
+    # load temporal components of all units touched by the block once, rows
+    # shared with neighboring blocks are served from the per-worker cache
+    uids = np.unique(sub.indices)
+    cells = uids[uids < nu - 1] if f is not None else uids
+    C = load_C_rows(C_store, cells, C_token)
+    if len(cells) < len(uids):
+        C = np.concatenate([C, np.asarray(f, dtype=float).reshape((1, -1))], axis=0)
+    y = np.asarray(y, dtype=float).reshape((-1, y.shape[-1]))[pxs]
+    rows = np.repeat(np.arange(len(pxs)), np.diff(sub.indptr))
+    a = a.reshape((-1, nu)).tocsr()[pxs]
+    coef = lasso_gram_cd(
+        C @ C.T,
+        C.sum(axis=1),
+        y @ C.T,
+        y.sum(axis=1),
+        np.asarray(alpha, dtype=float).reshape(-1)[pxs],
+        sub.indptr,
+        np.searchsorted(uids, sub.indices),
+        np.asarray(a[rows, sub.indices], dtype=float).reshape(-1),
+        C.shape[1],
+    )
+    mask = coef > 0
+    crd_h, crd_w = np.unravel_index(pxs[rows[mask]], shape[:2])
+    return sparse.COO(
+        coords=np.stack([crd_h, crd_w, sub.indices[mask]]),
+        data=coef[mask],
+        shape=shape,
+    )
+
+
+@nb.jit(nopython=True, nogil=True, cache=True)
+def lasso_gram_cd(
+    G: np.ndarray,
+    sC: np.ndarray,
+    B: np.ndarray,
+    sy: np.ndarray,
+    alpha: np.ndarray,
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    w0: np.ndarray,
+    nT: int,
+    max_iter=1000,
+    tol=1e-10,
+) -> np.ndarray:
+    """
+    Solve non-negative lasso problems of many pixels with coordinate descent in
+    the Gram domain.
+
+    For each pixel, the problem is the same as
+    :class:`sklearn.linear_model.LassoLars` with `positive=True`, including the
+    centering of data and normalization of regressors, but is formulated
+    entirely in terms of precomputed inner products. After each sweep of
+    coordinate descent, the problem restricted to the current support is solved
+    exactly. The solution is accepted once it satisfies the optimality
+    conditions, hence is exact up to floating point precision like the one
+    from least angle regression. Otherwise the iterate moves towards the
+    restricted solution as far as the non-negativity constraints allow, which
+    never increases the objective.
+
+    Parameters
+    ----------
+    G : np.ndarray
+        Gram matrix of all regressors with shape (k, k).
+    sC : np.ndarray
+        Sum of each regressor over time with shape (k,).
+    B : np.ndarray
+        Inner products between the target of each pixel and all regressors with
+        shape (npx, k).
+    sy : np.ndarray
+        Sum of the target of each pixel over time with shape (npx,).
+    alpha : np.ndarray
+        Sparsity penalty of each pixel with shape (npx,).
+    indptr : np.ndarray
+        Index pointers into `indices` for each pixel, in the CSR convention.
+    indices : np.ndarray
+        Regressors involved in the problem of each pixel.
+    w0 : np.ndarray
+        Initial values of the solution, aligned with `indices`.
+    nT : int
+        Number of time points.
+    max_iter : int, optional
+        Maximum number of sweeps over the regressors. By default `1000`.
+    tol : float, optional
+        Relative tolerance of the optimality conditions. Coordinate descent
+        alone is also considered converged if the largest update is smaller
+        than `tol` times the largest coefficient, which only happens if the
+        restricted problem is degenerate. By default `1e-10`.
+
+    Returns
+    -------
+    coef : np.ndarray
+        The solution, aligned with `indices`.
+    """
+    coef = np.zeros(len(indices))
+    for p in range(len(sy)):
+        st, ed = indptr[p], indptr[p + 1]
+        k = ed - st
+        if k == 0:
+            continue
+        idx = indices[st:ed]
+        Gn = np.empty((k, k))
+        bn = np.empty(k)
+        nrm = np.empty(k)
+        for i in range(k):
+            for j in range(k):
+                Gn[i, j] = G[idx[i], idx[j]] - sC[idx[i]] * sC[idx[j]] / nT
+        for i in range(k):
+            if Gn[i, i] > 1e-12 * max(G[idx[i], idx[i]], 1e-300):
+                nrm[i] = np.sqrt(Gn[i, i])
+            else:
+                nrm[i] = 0
+        # center and normalize
+        for i in range(k):
+            bn[i] = B[p, idx[i]] - sC[idx[i]] * sy[p] / nT
+            if nrm[i] > 0:
+                bn[i] /= nrm[i]
+            else:
+                bn[i] = 0
+            for j in range(k):
+                if nrm[i] > 0 and nrm[j] > 0:
+                    Gn[i, j] /= nrm[i] * nrm[j]
+                else:
+                    Gn[i, j] = 0
+        lam = alpha[p] * nT
+        kkt_tol = tol * (lam + np.abs(bn).max())
+        w = np.zeros(k)
+        for i in range(k):
+            if nrm[i] > 0 and w0[st + i] > 0:
+                w[i] = w0[st + i] * nrm[i]
+        q = Gn @ w
+        for _ in range(max_iter):
+            max_dw, max_w = 0.0, 0.0
+            for j in range(k):
+                if nrm[j] == 0:
+                    continue
+                wj = max((bn[j] - q[j] + Gn[j, j] * w[j] - lam) / Gn[j, j], 0.0)
+                dw = wj - w[j]
+                if dw != 0:
+                    for i in range(k):
+                        q[i] += Gn[i, j] * dw
+                    w[j] = wj
+                max_dw = max(max_dw, abs(dw))
+                max_w = max(max_w, wj)
+            # solve the problem restricted to the support exactly, moving
+            # towards the solution and shrinking the support until it is
+            # feasible
+            act = np.nonzero(w > 0)[0]
+            while True:
+                z = spd_solve(Gn[act][:, act], bn[act] - lam)
+                if z is None or (z > 0).all():
+                    break
+                step, blk = 1.0, 0
+                for i in range(len(act)):
+                    if z[i] <= 0 and w[act[i]] / (w[act[i]] - z[i]) < step:
+                        step, blk = w[act[i]] / (w[act[i]] - z[i]), i
+                for i in range(len(act)):
+                    w[act[i]] += step * (z[i] - w[act[i]])
+                w[act[blk]] = 0
+                w = np.maximum(w, 0)
+                act = np.nonzero(w > 0)[0]
+            if z is None:
+                q = Gn @ w
+                if max_dw <= tol * max_w:
+                    break
+                continue
+            w = np.zeros(k)
+            w[act] = z
+            q = Gn @ w
+            if (bn - q - lam <= kkt_tol).all():
+                break
+        for i in range(k):
+            if nrm[i] > 0:
+                coef[st + i] = w[i] / nrm[i]
+    return coef
+
+
+@nb.jit(nopython=True, nogil=True, cache=True)
+def spd_solve(a: np.ndarray, b: np.ndarray) -> Optional[np.ndarray]:
+    """
+    Solve a symmetric positive definite linear system with Cholesky
+    factorization.
+
+    Parameters
+    ----------
+    a : np.ndarray
+        Symmetric matrix with shape (k, k).
+    b : np.ndarray
+        Right hand side with shape (k,).
+
+    Returns
+    -------
+    x : Optional[np.ndarray]
+        The solution, or `None` if `a` is not numerically positive definite.
+    """
+    k = len(b)
+    L = np.zeros((k, k))
+    for j in range(k):
+        d = a[j, j] - L[j, :j] @ L[j, :j]
+        if d <= 1e-10 * a[j, j]:
+            return None
+        L[j, j] = np.sqrt(d)
+        for i in range(j + 1, k):
+            L[i, j] = (a[i, j] - L[i, :j] @ L[j, :j]) / L[j, j]
+    x = b.copy()
+    for i in range(k):
+        x[i] = (x[i] - L[i, :i] @ x[:i]) / L[i, i]
+    for i in range(k - 1, -1, -1):
+        x[i] = (x[i] - L[i + 1 :, i] @ x[i + 1 :]) / L[i, i]
+    return x
 
 
 def compute_trace(
@@ -612,7 +1051,7 @@ def compute_trace(
     fms = Y.coords["frame"]
     uid = A.coords["unit_id"]
     Y = Y.data
-    A = darr.from_array(A.data.map_blocks(sparse.COO).compute(), chunks=-1)
+    A = darr.from_array(as_sparse(A).data.compute(), chunks=-1)
     C = C.data.map_blocks(sparse.COO).T
     b = (
         b.fillna(0)
@@ -673,6 +1112,7 @@ def update_temporal(
     post_scal=False,
     scs_fallback=False,
     concurrent_update=False,
+    solver="cvxpy",
 ) -> Tuple[
     xr.DataArray, xr.DataArray, xr.DataArray, xr.DataArray, xr.DataArray, xr.DataArray
 ]:
@@ -694,7 +1134,8 @@ def update_temporal(
     have comparable effects across cells. If abrupt change of baseline
     fluorescence is expected, a `bseg` vector can be passed to enable estimation
     of independent baseline for different segments of time. The temporal update
-    itself is performed by solving an optimization problem using `cvxpy`, with
+    itself is performed by solving an optimization problem using either `cvxpy`
+    or a dedicated active-set solver as specified by `solver`, with
     `concurrent_update`, `warm_start`, `max_iters`, `scs_fallback` controlling
     different aspects of the optimization. Finally, the results can be filtered
     with `zero_thres` to suppress small values caused by numerical errors, and a
@@ -775,8 +1216,8 @@ def update_temporal(
         `True`.
     warm_start : bool, optional
         Whether to use previous estimation of `C` to warm start the
-        optimization. Can lead to faster convergence in theory. Experimental. By
-        default `False`.
+        optimization. Can lead to faster convergence in theory. Experimental.
+        Only used if `solver = "cvxpy"`. By default `False`.
     post_scal : bool, optional
         Whether to apply the post-hoc scaling process, where a scalar will be
         estimated with least square for each cell to scale the amplitude of
@@ -785,12 +1226,19 @@ def update_temporal(
         normalization. By default `False`.
     scs_fallback : bool, optional
         Whether to fall back to `scs` solver if the default `ecos` solver fails.
-        By default `False`.
+        Only used if `solver = "cvxpy"`. By default `False`.
     concurrent_update : bool, optional
         Whether to update a group of cells as a single optimization problem.
         Yields slightly more accurate estimation when cross-talk between cells
         are severe, but significantly increase convergence time and memory
         demand. By default `False`.
+    solver : str, optional
+        Backend used to solve the optimization problem. If `"cvxpy"`, a generic
+        convex problem is constructed and solved with `ecos` for each cell. If
+        `"active_set"`, the same problem is solved with a dedicated active-set
+        solver whose cost is linear in the number of frames, which is
+        considerably faster on long recordings. See
+        :func:`update_temporal_active_set` for details. By default `"cvxpy"`.
 
     Returns
     -------
@@ -851,13 +1299,15 @@ def update_temporal(
     `sparse_penal`. Higher value of :math:`\\alpha` will result in more sparse
     estimation of deconvolved spikes.
     """
+    if solver not in ["cvxpy", "active_set"]:
+        raise NotImplementedError(solver)
     intpath = os.environ["MINIAN_INTERMEDIATE"]
     if YrA is None:
         YrA = compute_trace(Y, A, b, C, f).persist()
     Ymask = (YrA > 0).any("frame").compute()
     A, C, YrA = A.sel(unit_id=Ymask), C.sel(unit_id=Ymask), YrA.sel(unit_id=Ymask)
     print("grouping overlaping units")
-    A_sps = (A.data.map_blocks(sparse.COO) > 0).compute().astype(np.float32)
+    A_sps = (as_sparse(A).data > 0).compute().astype(np.float32)
     A_inter = sparse.tensordot(A_sps, A_sps, axes=[(1, 2), (1, 2)])
     A_usum = np.tile(A_sps.sum(axis=(1, 2)).todense(), (A_sps.shape[0], 1))
     A_usum = A_usum + A_usum.T
@@ -884,7 +1334,7 @@ def update_temporal(
         cur_YrA, cur_C = cur_YrA[1].data.rechunk(-1), cur_C[1].data.rechunk(-1)
         # peak memory demand for cvxpy is roughly 500 times input
         mem_cvx = cur_YrA.nbytes if concurrent_update else cur_YrA[0].nbytes
-        mem_cvx = mem_cvx * 500
+        mem_cvx = mem_cvx * 500 if solver == "cvxpy" else 0
         mem_demand = max(mem_cvx, cur_YrA.nbytes * 5) / 1e6
         # issue a warning if expected memory demand is larger than 1G
         if mem_demand > 1e3:
@@ -919,6 +1369,7 @@ def update_temporal(
                     max_iters=max_iters,
                     scs_fallback=scs_fallback,
                     zero_thres=zero_thres,
+                    solver=solver,
                 )
             )[0]
         c_ls.append(darr.from_delayed(res[0], shape=cur_YrA.shape, dtype=cur_YrA.dtype))
@@ -1097,14 +1548,16 @@ def update_temporal_block(
     use_smooth=True,
     med_wd=None,
     concurrent=False,
+    solver="cvxpy",
     **kwargs
 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     """
     Update temporal components given residule traces of a group of cells.
 
-    This function wraps around :func:`update_temporal_cvxpy`, but also carry out
-    additional initial steps given `YrA` of a group of cells. Additional keyword
-    arguments are passed through to :func:`update_temporal_cvxpy`.
+    This function wraps around :func:`update_temporal_cvxpy` or
+    :func:`update_temporal_active_set`, but also carry out additional initial
+    steps given `YrA` of a group of cells. Additional keyword arguments are
+    passed through to the solver.
 
     Parameters
     ----------
@@ -1129,6 +1582,9 @@ def update_temporal_block(
     concurrent : bool, optional
         Whether to update a group of cells as a single optimization problem. By
         default `False`.
+    solver : str, optional
+        Either `"cvxpy"` or `"active_set"`, specifying the backend used to solve
+        the optimization problem. By default `"cvxpy"`.
 
     Returns
     -------
@@ -1148,10 +1604,22 @@ def update_temporal_block(
         Estimation of AR coefficient for each cell. Should have dimensions
         ("unit_id", "lag") with "lag" having length `p`.
 
+    Raises
+    ------
+    NotImplementedError
+        if `solver` is not "cvxpy" or "active_set"
+
     See Also
     -------
     update_temporal : for more explanation of parameters
     """
+    try:
+        solve = {
+            "cvxpy": update_temporal_cvxpy,
+            "active_set": update_temporal_active_set,
+        }[solver]
+    except KeyError:
+        raise NotImplementedError(solver)
     vec_get_noise = np.vectorize(
         noise_fft,
         otypes=[float],
@@ -1188,11 +1656,11 @@ def update_temporal_block(
         for i, cur_yra in enumerate(YrA):
             YrA[i, :] = med_baseline(cur_yra, med_wd)
     if concurrent:
-        c, s, b, c0 = update_temporal_cvxpy(YrA, g, tn, **kwargs)
+        c, s, b, c0 = solve(YrA, g, tn, **kwargs)
     else:
         res_ls = []
         for cur_yra, cur_g, cur_tn in zip(YrA, g, tn):
-            res = update_temporal_cvxpy(cur_yra, cur_g, cur_tn, **kwargs)
+            res = solve(cur_yra, cur_g, cur_tn, **kwargs)
             res_ls.append(res)
         c = np.concatenate([r[0] for r in res_ls], axis=0) / norm_factor
         s = np.concatenate([r[1] for r in res_ls], axis=0) / norm_factor
@@ -1392,6 +1860,598 @@ def update_temporal_cvxpy(
     return c, s, b, c0
 
 
+def update_temporal_active_set(
+    y: np.ndarray, g: np.ndarray, sn: np.ndarray, A=None, bseg=None, **kwargs
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Solve the temporal update optimization problem with a dedicated active-set
+    solver.
+
+    This function solves the same problem as :func:`update_temporal_cvxpy` for
+    each cell, but without constructing a generic convex program. For a fixed
+    sparse penalty on squared residuals, the calcium trace is the projection
+    onto the cone of traces with non-negative spikes, which is solved with
+    block principal pivoting in the dual (see :func:`ar_cone_proj`). The
+    baseline and initial calcium are estimated with box-constrained Newton
+    steps around the projection (see :func:`ar_deconv_l2`), and the penalty on
+    squared residuals is finally searched for such that the solution is also
+    the solution of the original problem with unsquared residuals, or with a
+    constraint on the noise level (see :func:`ar_deconv`). Every step is
+    linear in the number of frames. Since the solver is warm started internally,
+    `c_last` and `scs_fallback` are ignored.
+
+    Parameters
+    ----------
+    y : np.ndarray
+        Input residule trace of one or more cells.
+    g : np.ndarray
+        Estimated AR coefficients of one or more cells.
+    sn : np.ndarray
+        Noise level of one or more cells.
+    A : np.ndarray, optional
+        Spatial footprint of one or more cells. Not used. By default `None`.
+    bseg : np.ndarray, optional
+        1d vector with length "frame" representing segments for which baseline
+        should be estimated independently. By default `None`.
+
+    Returns
+    -------
+    c : np.ndarray
+        New estimation of the calcium dynamic of the group of cells. Should have
+        dimensions ("unit_id", "frame") and same shape as `y`.
+    s : np.ndarray
+        New estimation of the deconvolved spikes of the group of cells. Should
+        have dimensions ("unit_id", "frame") and same shape as `c`.
+    b : np.ndarray
+        New estimation of baseline fluorescence of the group of cells. Should
+        have dimensions ("unit_id", "frame") and same shape as `c`.
+    c0 : np.ndarray
+        New estimation of a initial calcium decay of the group of cells. Should
+        have dimensions ("unit_id", "frame") and same shape as `c`.
+
+    Other Parameters
+    -------
+    sparse_penal : float
+        Sparse penalty parameter for all the cells.
+    max_iters : int
+        Maximum number of pivoting and Newton iterations.
+    use_cons : bool, optional
+        Whether to try constrained version of the problem first. By default
+        `False`.
+    zero_thres : float
+        Threshold to filter out small values in the result.
+
+    See Also
+    -------
+    update_temporal : for more explanation of parameters
+    update_temporal_cvxpy : for the formulation of the problem
+    """
+    sparse_penal = kwargs.get("sparse_penal")
+    max_iters = kwargs.get("max_iters")
+    use_cons = kwargs.get("use_cons", False)
+    zero_thres = kwargs.get("zero_thres")
+    if y.ndim < 2:
+        y = y.reshape((1, -1))
+    if g.ndim < 2:
+        g = g.reshape((1, -1))
+    sn = np.atleast_1d(sn)
+    _T = y.shape[-1]
+    _u = g.shape[0]
+    if bseg is not None:
+        nseg = int(np.max(bseg) + 1)
+        b_temp = np.zeros((nseg, _T))
+        for iseg in range(nseg):
+            b_temp[iseg, bseg == iseg] = 1
+    else:
+        nseg = 1
+        b_temp = np.ones((1, _T))
+    c, s, b, c0 = [np.zeros((_u, _T)) for _ in range(4)]
+    for u in range(_u):
+        cur_y = y[u, :].astype(float)
+        gt = np.concatenate(([1], -g[u, :]))
+        dc_vec = np.max(np.roots(gt).real) ** np.arange(_T)
+        M = np.concatenate([b_temp, dc_vec.reshape((1, -1))], axis=0).T
+        lb = np.concatenate([np.full(nseg, cur_y.min()), [0]])
+        b_init = np.array(
+            [np.median(cur_y[bs > 0]) if bs.any() else 0 for bs in b_temp]
+        )
+        beta = np.maximum(np.concatenate([b_init, [0]]), lb)
+        inF = ar_mul(gt, cur_y - M @ beta) < 0
+        # the norm of residual is roughly sn * sqrt(T) at the solution
+        mu = sn[u] ** 2 * np.sqrt(_T)
+        res = None
+        if use_cons:
+            res = ar_deconv(
+                cur_y,
+                gt,
+                M,
+                lb,
+                beta,
+                inF,
+                mu,
+                thres=sn[u] * np.sqrt(_T),
+                max_iters=max_iters,
+            )
+            if res is None:
+                warnings.warn("constrained version of problem infeasible")
+        if res is None:
+            res = ar_deconv(
+                cur_y,
+                gt,
+                M,
+                lb,
+                beta,
+                inF,
+                mu * sparse_penal,
+                lam=sn[u] * sparse_penal,
+                max_iters=max_iters,
+            )
+        cur_c, cur_s, beta, conv = res
+        if not conv:
+            warnings.warn("problem solved sub-optimally", RuntimeWarning)
+        c[u, :] = cur_c
+        s[u, :] = cur_s
+        b[u, :] = beta[:nseg] @ b_temp
+        c0[u, :] = beta[-1] * dc_vec
+    c = np.where(c > zero_thres, c, 0)
+    s = np.where(s > zero_thres, s, 0)
+    b = np.where(b > zero_thres, b, 0)
+    c0 = np.where(c0 > zero_thres, c0, 0)
+    return c, s, b, c0
+
+
+def ar_deconv(
+    y: np.ndarray,
+    gt: np.ndarray,
+    M: np.ndarray,
+    lb: np.ndarray,
+    beta: np.ndarray,
+    inF: np.ndarray,
+    mu: float,
+    lam: Optional[float] = None,
+    thres: Optional[float] = None,
+    max_iters=200,
+) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray, bool]]:
+    """
+    Solve the penalized or noise-constrained AR deconvolution problem of a
+    single cell.
+
+    With `lam`, the problem is to minimize :math:`\\left \\lVert \\mathbf{y} -
+    \\mathbf{c} - \\mathbf{M} \\beta \\right \\rVert + \\lambda \\left \\lVert
+    \\mathbf{G} \\mathbf{c} \\right \\rVert _1`, where the residual is *not*
+    squared. With `thres`, the problem is to minimize :math:`\\left \\lVert
+    \\mathbf{G} \\mathbf{c} \\right \\rVert _1` with the norm of the residual no
+    larger than `thres`. Both are solved by finding the penalty :math:`\\mu` on
+    squared residuals (see :func:`ar_deconv_l2`) whose solution satisfies the
+    optimality conditions of the original problem. The norm of the residual is
+    non-decreasing in :math:`\\mu`, hence the root is bracketed with geometric
+    steps from the initial guess `mu` and then refined with the Illinois
+    method. Since consecutive problems are close to each other, each of them
+    is warm started from the active set and offsets of the previous one.
+
+    Parameters
+    ----------
+    y : np.ndarray
+        Input trace with length "frame".
+    gt : np.ndarray
+        First column of the AR matrix :math:`\\mathbf{G}`, with one followed by
+        the negated AR coefficients.
+    M : np.ndarray
+        Regressors of the offsets with shape ("frame", k), where the first
+        columns model the baseline of each segment and the last column models
+        the initial calcium decay.
+    lb : np.ndarray
+        Lower bounds of the offsets with shape (k,).
+    beta : np.ndarray
+        Initial values of the offsets with shape (k,).
+    inF : np.ndarray
+        Initial boolean mask of frames where the spike is constrained to zero.
+    mu : float
+        Initial guess of the penalty on squared residuals.
+    lam : float, optional
+        Sparse penalty of the unsquared problem. By default `None`.
+    thres : float, optional
+        Threshold of the norm of residual for the noise-constrained problem.
+        Only used if `lam is None`. By default `None`.
+    max_iters : int, optional
+        Maximum number of iterations of each stage. By default `200`.
+
+    Returns
+    -------
+    c : np.ndarray
+        Calcium trace with length "frame".
+    s : np.ndarray
+        Deconvolved spikes with length "frame".
+    beta : np.ndarray
+        Estimated offsets with shape (k,).
+    converged : bool
+        Whether all stages converged.
+
+    Notes
+    -----
+    `None` is returned instead if the noise-constrained problem is infeasible.
+    """
+
+    def fun(mu, r):
+        if lam is not None:
+            return mu - lam * np.linalg.norm(r)
+        else:
+            return np.linalg.norm(r) - thres
+
+    mu0 = mu
+    tol = 1e-10 * (mu0 if lam is not None else thres)
+    mu_a = mu_b = None
+    conv = True
+    for _ in range(max_iters):
+        res = ar_deconv_l2(y, gt, M, lb, mu, beta, inF, max_iters)
+        beta, inF = res[2], res[3]
+        conv = conv and res[5]
+        h = fun(mu, res[4])
+        if h < 0:
+            if lam is None and not (res[1] > 0).any():
+                # noise constraint is met without any spike
+                return res[0], res[1], beta, conv
+            mu_a, h_a = mu, h
+            if mu_b is not None:
+                break
+            mu = mu * 1.5
+        elif h > 0:
+            if mu == 0:
+                return None
+            mu_b, h_b = mu, h
+            if mu_a is not None:
+                break
+            # test feasibility directly once far below the initial guess
+            mu = mu / 1.5 if mu > 1e-6 * mu0 else 0
+        else:
+            return res[0], res[1], beta, conv
+    else:
+        return res[0], res[1], beta, False
+    side = 0
+    while mu_b - mu_a > 1e-10 * mu_b:
+        mu = (mu_a * h_b - mu_b * h_a) / (h_b - h_a)
+        res = ar_deconv_l2(y, gt, M, lb, mu, beta, inF, max_iters)
+        beta, inF = res[2], res[3]
+        conv = conv and res[5]
+        h = fun(mu, res[4])
+        if abs(h) <= tol:
+            break
+        if h < 0:
+            mu_a, h_a = mu, h
+            if side == -1:
+                h_b /= 2
+            side = -1
+        else:
+            mu_b, h_b = mu, h
+            if side == 1:
+                h_a /= 2
+            side = 1
+    return res[0], res[1], beta, conv
+
+
+def ar_deconv_l2(
+    y: np.ndarray,
+    gt: np.ndarray,
+    M: np.ndarray,
+    lb: np.ndarray,
+    mu: float,
+    beta: np.ndarray,
+    inF: np.ndarray,
+    max_iters=200,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, bool]:
+    """
+    Solve the AR deconvolution problem with squared residuals and offsets.
+
+    The problem is to minimize :math:`\\frac{1}{2} \\left \\lVert \\mathbf{y} -
+    \\mathbf{c} - \\mathbf{M} \\beta \\right \\rVert ^2 + \\mu \\left \\lVert
+    \\mathbf{G} \\mathbf{c} \\right \\rVert _1` subject to :math:`\\mathbf{G}
+    \\mathbf{c} \\geq 0` and :math:`\\beta \\geq \\mathbf{lb}`. For fixed
+    :math:`\\beta` the problem in :math:`\\mathbf{c}` is a projection solved by
+    :func:`ar_cone_proj`. The objective is piecewise quadratic in
+    :math:`\\beta`, and each piece is determined by the active set of the
+    projection. Hence :math:`\\beta` is solved with box-constrained Newton steps
+    using the exact Hessian of the current piece, safeguarded by backtracking.
+
+    Parameters
+    ----------
+    y : np.ndarray
+        Input trace with length "frame".
+    gt : np.ndarray
+        First column of the AR matrix :math:`\\mathbf{G}`.
+    M : np.ndarray
+        Regressors of the offsets with shape ("frame", k).
+    lb : np.ndarray
+        Lower bounds of the offsets with shape (k,).
+    mu : float
+        Sparse penalty on the spikes.
+    beta : np.ndarray
+        Initial values of the offsets with shape (k,).
+    inF : np.ndarray
+        Initial boolean mask of frames where the spike is constrained to zero.
+    max_iters : int, optional
+        Maximum number of Newton iterations. By default `200`.
+
+    Returns
+    -------
+    c : np.ndarray
+        Calcium trace with length "frame".
+    s : np.ndarray
+        Deconvolved spikes with length "frame".
+    beta : np.ndarray
+        Estimated offsets with shape (k,).
+    inF : np.ndarray
+        Boolean mask of frames where the spike is zero.
+    r : np.ndarray
+        Residual with length "frame".
+    converged : bool
+        Whether the solver converged.
+    """
+    _T = len(y)
+    w = ar_mul_t(gt, np.ones(_T))
+    # levenberg-marquardt style damping, since the curvature vanishes whenever
+    # the offsets can be fully absorbed by spikes
+    ridge = 1e-3 * (M ** 2).sum(axis=0) + 1e-12
+
+    def fit(bt, inF):
+        yb = y - M @ bt
+        c, s, inF, L, conv = ar_cone_proj(yb - mu * w, gt, inF, max_iters)
+        r = yb - c
+        return c, s, bt, inF, r, conv, L, 0.5 * r @ r + mu * w @ c
+
+    res = fit(beta, inF)
+    conv = res[5]
+    for _ in range(max_iters):
+        c, s, beta, inF, r, _, L, obj = res
+        grad = -M.T @ r
+        idx = np.flatnonzero(inF)
+        # curvature of the current piece, where the offsets are only
+        # partially absorbed through the projection onto the rows in inF
+        PM = np.zeros_like(M)
+        for j in range(M.shape[1]):
+            u = np.zeros(_T)
+            u[idx] = band_chol_solve(L, ar_mul(gt, M[:, j])[idx])
+            PM[:, j] = ar_mul_t(gt, u)
+        H = M.T @ PM + np.diag(ridge)
+        R = np.linalg.cholesky(H)
+        hb = grad + H @ (lb - beta)
+        x = nnls(R.T, -solve_triangular(R, hb, lower=True))[0]
+        delta = x + lb - beta
+        dec = grad @ delta
+        if -dec <= 1e-12 * max(obj, 1):
+            break
+        step = 1
+        while step > 1e-10:
+            res_new = fit(beta + step * delta, inF)
+            if res_new[-1] <= obj + 1e-4 * step * dec:
+                break
+            step = step / 2
+        else:
+            break
+        res = res_new
+        conv = conv and res[5]
+    else:
+        conv = False
+    return res[0], res[1], res[2], res[3], res[4], conv
+
+
+@nb.jit(nopython=True, nogil=True, cache=True)
+def ar_cone_proj(
+    z: np.ndarray, gt: np.ndarray, inF: np.ndarray, max_iters=200
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, bool]:
+    """
+    Project a trace onto the cone of calcium traces with non-negative spikes.
+
+    The problem is to minimize :math:`\\frac{1}{2} \\left \\lVert \\mathbf{z} -
+    \\mathbf{c} \\right \\rVert ^2` subject to :math:`\\mathbf{G} \\mathbf{c}
+    \\geq 0`. Its dual is a linear complementarity problem with the banded
+    matrix :math:`\\mathbf{G} \\mathbf{G}^T`, which is solved with block
+    principal pivoting, falling back to single pivoting if the number of
+    infeasible frames stops decreasing. Given an active set, the multipliers
+    are solved with a banded Cholesky factorization (see :func:`ar_gram_chol`),
+    hence each iteration is linear in the number of frames. For AR(1) this is
+    equivalent to pooling adjacent violators.
+
+    Parameters
+    ----------
+    z : np.ndarray
+        Input trace with length "frame".
+    gt : np.ndarray
+        First column of the AR matrix :math:`\\mathbf{G}`.
+    inF : np.ndarray
+        Initial boolean mask of frames where the spike is constrained to zero.
+    max_iters : int, optional
+        Maximum number of pivoting iterations. By default `200`.
+
+    Returns
+    -------
+    c : np.ndarray
+        Projected trace with length "frame".
+    s : np.ndarray
+        Spikes of the projected trace with length "frame".
+    inF : np.ndarray
+        Boolean mask of frames where the spike is zero.
+    L : np.ndarray
+        Banded Cholesky factor of the rows of :math:`\\mathbf{G}
+        \\mathbf{G}^T` in `inF`.
+    converged : bool
+        Whether the pivoting converged.
+    """
+    _T = len(z)
+    q = ar_mul(gt, z)
+    tol = 1e-9 * max(np.abs(z).max(), 1e-3)
+    inF = inF.copy()
+    infeas = np.zeros(_T, dtype=np.bool_)
+    ninf, nback = _T + 1, 3
+    conv = False
+    for it in range(max_iters):
+        idx = np.flatnonzero(inF)
+        L = ar_gram_chol(idx, gt)
+        lam = np.zeros(_T)
+        lam[idx] = band_chol_solve(L, -q[idx])
+        c = z + ar_mul_t(gt, lam)
+        s = ar_mul(gt, c)
+        nv, last = 0, -1
+        for t in range(_T):
+            if inF[t]:
+                s[t] = 0
+                infeas[t] = lam[t] < -tol
+            else:
+                infeas[t] = s[t] < -tol
+            if infeas[t]:
+                nv += 1
+                last = t
+        if nv == 0:
+            conv = True
+            break
+        if it == max_iters - 1:
+            break
+        if nv < ninf or nback > 0:
+            if nv < ninf:
+                ninf, nback = nv, 3
+            else:
+                nback -= 1
+            for t in range(_T):
+                if infeas[t]:
+                    inF[t] = not inF[t]
+        else:
+            inF[last] = not inF[last]
+    return c, s, inF, L, conv
+
+
+@nb.jit(nopython=True, nogil=True, cache=True)
+def ar_mul(gt: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """
+    Multiply a vector by the AR matrix :math:`\\mathbf{G}`.
+
+    Parameters
+    ----------
+    gt : np.ndarray
+        First column of the AR matrix :math:`\\mathbf{G}`.
+    x : np.ndarray
+        Input vector with length "frame".
+
+    Returns
+    -------
+    res : np.ndarray
+        :math:`\\mathbf{G} \\mathbf{x}`.
+    """
+    res = np.zeros(len(x))
+    for t in range(len(x)):
+        for j in range(min(len(gt) - 1, t) + 1):
+            res[t] += gt[j] * x[t - j]
+    return res
+
+
+@nb.jit(nopython=True, nogil=True, cache=True)
+def ar_mul_t(gt: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """
+    Multiply a vector by the transpose of the AR matrix :math:`\\mathbf{G}`.
+
+    Parameters
+    ----------
+    gt : np.ndarray
+        First column of the AR matrix :math:`\\mathbf{G}`.
+    x : np.ndarray
+        Input vector with length "frame".
+
+    Returns
+    -------
+    res : np.ndarray
+        :math:`\\mathbf{G}^T \\mathbf{x}`.
+    """
+    n = len(x)
+    res = np.zeros(n)
+    for t in range(n):
+        for j in range(min(len(gt) - 1, n - 1 - t) + 1):
+            res[t] += gt[j] * x[t + j]
+    return res
+
+
+@nb.jit(nopython=True, nogil=True, cache=True)
+def ar_gram_chol(idx: np.ndarray, gt: np.ndarray) -> np.ndarray:
+    """
+    Banded Cholesky factorization of a subset of rows and columns of
+    :math:`\\mathbf{G} \\mathbf{G}^T`.
+
+    Since :math:`\\mathbf{G}` is lower-triangular with bandwidth `p`, so is the
+    Cholesky factor of any principal submatrix of :math:`\\mathbf{G}
+    \\mathbf{G}^T` when the indices are sorted. The entries of the submatrix
+    are computed on the fly from `gt`.
+
+    Parameters
+    ----------
+    idx : np.ndarray
+        Sorted indices of the rows and columns.
+    gt : np.ndarray
+        First column of the AR matrix :math:`\\mathbf{G}`, with length `p + 1`.
+
+    Returns
+    -------
+    L : np.ndarray
+        The factor with shape (len(idx), p + 1), where `L[a, k]` is the entry of
+        row `a` and column `a - k` for `k > 0`, and `L[a, 0]` is the reciprocal
+        of the diagonal entry of row `a`.
+    """
+    n = len(idx)
+    p = len(gt) - 1
+    gg = np.zeros(p + 1)
+    for m in range(p + 1):
+        for j in range(p - m + 1):
+            gg[m] += gt[j] * gt[j + m]
+    L = np.zeros((n, p + 1))
+    for a in range(n):
+        for k in range(min(p, a), -1, -1):
+            b = a - k
+            m = idx[a] - idx[b]
+            acc = 0.0
+            if m <= p:
+                if idx[b] >= p - m:
+                    acc = gg[m]
+                else:
+                    # first rows of G are truncated
+                    for j in range(idx[b] + 1):
+                        acc += gt[j] * gt[j + m]
+            for j in range(a - min(p, a), b):
+                acc -= L[a, a - j] * L[b, b - j]
+            if k == 0:
+                L[a, 0] = 1 / np.sqrt(acc)
+            else:
+                L[a, k] = acc * L[b, 0]
+    return L
+
+
+@nb.jit(nopython=True, nogil=True, cache=True)
+def band_chol_solve(L: np.ndarray, r: np.ndarray) -> np.ndarray:
+    """
+    Solve a linear system given its banded Cholesky factor.
+
+    Parameters
+    ----------
+    L : np.ndarray
+        Banded Cholesky factor as returned by :func:`ar_gram_chol`.
+    r : np.ndarray
+        Right hand side of the system.
+
+    Returns
+    -------
+    x : np.ndarray
+        Solution of the system.
+    """
+    n, p1 = L.shape
+    x = r.copy()
+    for a in range(n):
+        acc = x[a]
+        for k in range(1, min(p1 - 1, a) + 1):
+            acc -= L[a, k] * x[a - k]
+        x[a] = acc * L[a, 0]
+    for a in range(n - 1, -1, -1):
+        acc = x[a]
+        for k in range(1, min(p1 - 1, n - 1 - a) + 1):
+            acc -= L[a + k, k] * x[a + k]
+        x[a] = acc * L[a, 0]
+    return x
+
+
 def unit_merge(
     A: xr.DataArray,
     C: xr.DataArray,
@@ -1442,7 +2502,7 @@ def unit_merge(
         array_optimize=darr.optimization.optimize,
         **{"optimization.fuse.subgraphs": False}
     ):
-        A_sps = (A.data.map_blocks(sparse.COO) > 0).rechunk(-1).persist()
+        A_sps = (as_sparse(A).data > 0).rechunk(-1).persist()
         A_inter = sparse.tril(
             darr.tensordot(
                 A_sps.astype(np.float32),
@@ -1626,7 +2686,10 @@ def filt_butter(x: np.ndarray, freq: float, btype: str) -> np.ndarray:
 
 def filt_fft_vec(x: np.ndarray, freq: float, btype: str) -> np.ndarray:
     """
-    Vectorized wrapper of :func:`filt_fft`.
+    Vectorized version of :func:`filt_fft`.
+
+    All timeseries are transformed with a single batched fft. The result is
+    written back into `x`.
 
     Parameters
     ----------
@@ -1643,8 +2706,14 @@ def filt_fft_vec(x: np.ndarray, freq: float, btype: str) -> np.ndarray:
     x_filt : np.ndarray
         Filtered timeseries
     """
-    for ix, xx in enumerate(x):
-        x[ix, :] = filt_fft(xx, freq, btype)
+    _T = x.shape[-1]
+    if btype == "low":
+        zero_range = slice(int(freq * _T), None)
+    elif btype == "high":
+        zero_range = slice(None, int(freq * _T))
+    xfft = numpy_fft.rfft(x, axis=-1)
+    xfft[..., zero_range] = 0
+    x[:] = numpy_fft.irfft(xfft, _T, axis=-1)
     return x
 
 
@@ -1676,9 +2745,7 @@ def compute_AtC(A: xr.DataArray, C: xr.DataArray) -> xr.DataArray:
         A.coords["height"].values,
         A.coords["width"].values,
     )
-    A = darr.from_array(
-        A.data.map_blocks(sparse.COO, dtype=A.dtype).compute(), chunks=-1
-    )
+    A = darr.from_array(as_sparse(A).data.compute(), chunks=-1)
     C = C.transpose("frame", "unit_id").data.map_blocks(sparse.COO, dtype=C.dtype)
     AtC = darr.tensordot(C, A, axes=(1, 0)).map_blocks(
         lambda a: a.todense(), dtype=A.dtype
@@ -1746,31 +2813,98 @@ def graph_optimize_corr(
         representing the node index of the edge (correlation), and column "corr"
         with computed value of correlation.
     """
+    nods = sorted(G.nodes)
+    nod_df = pd.DataFrame([G.nodes[n] for n in nods], columns=list(idx_dims))
+    nod_pos = {n: i for i, n in enumerate(nods)}
+    eg_df = nx.to_pandas_edgelist(G)
+    eg_df["source"] = eg_df["source"].map(nod_pos)
+    eg_df["target"] = eg_df["target"].map(nod_pos)
+    eg_df = edge_optimize_corr(varr, eg_df, nod_df, freq, chunk, step_size)
+    nods = np.array(nods)
+    eg_df["source"] = nods[eg_df["source"].values]
+    eg_df["target"] = nods[eg_df["target"].values]
+    return eg_df
+
+
+def edge_optimize_corr(
+    varr: xr.DataArray,
+    eg_df: pd.DataFrame,
+    nod_df: pd.DataFrame,
+    freq: float,
+    chunk=600,
+    step_size=50,
+) -> pd.DataFrame:
+    """
+    Compute correlation in an optimized fashion given an edge list.
+
+    This function implements :func:`graph_optimize_corr` with the computation
+    graph represented as integer edge list and node table, so that large graphs
+    can be handled without constructing a :class:`networkx.Graph`.
+
+    Parameters
+    ----------
+    varr : xr.DataArray
+        Input timeseries. Should have "frame" dimension in addition to the
+        columns of `nod_df`.
+    eg_df : pd.DataFrame
+        Edge list representing the desired correlations. Should have column
+        "source" and "target" containing the positional index of nodes in
+        `nod_df`. Each edge should appear only once.
+    nod_df : pd.DataFrame
+        Node attributes used to index the timeseries in `varr`. Should only
+        contain columns relevant to index the time series.
+    freq : float
+        Cut-off frequency for the optional smoothing. If `None` then no
+        smoothing will be done.
+    chunk : int, optional
+        Chunk size of each computation. By default `600`.
+    step_size : int, optional
+        Step size to iterate through all edges. By default `50`.
+
+    Returns
+    -------
+    eg_df : pd.DataFrame
+        The input edge list with an additional column "corr" containing the
+        computed value of correlation.
+
+    See Also
+    -------
+    graph_optimize_corr : for detailed explanation of the algorithm
+    """
+    if not len(eg_df):
+        eg_df = eg_df[["source", "target"]].copy()
+        eg_df["corr"] = np.zeros(0)
+        return eg_df
+    nnod = len(nod_df)
+    src, tgt = eg_df["source"].values, eg_df["target"].values
+    adj = scipy.sparse.csr_matrix(
+        (
+            np.ones(2 * len(src)),
+            (np.concatenate([src, tgt]), np.concatenate([tgt, src])),
+        ),
+        shape=(nnod, nnod),
+    )
     # a heuristic to make number of partitions scale with nodes
     n_cuts, membership = pymetis.part_graph(
-        max(int(np.ceil(G.number_of_nodes() / chunk)), 1), adjacency=adj_list(G)
+        max(int(np.ceil(nnod / chunk)), 1), xadj=adj.indptr, adjncy=adj.indices
     )
-    nx.set_node_attributes(
-        G, {k: {"part": v} for k, v in zip(sorted(G.nodes), membership)}
-    )
-    eg_df = nx.to_pandas_edgelist(G)
-    part_map = nx.get_node_attributes(G, "part")
-    eg_df["part_src"] = eg_df["source"].map(part_map)
-    eg_df["part_tgt"] = eg_df["target"].map(part_map)
+    membership = np.array(membership)
+    eg_df = eg_df[["source", "target"]].copy()
+    eg_df["part_src"] = membership[src]
+    eg_df["part_tgt"] = membership[tgt]
     eg_df["part_diff"] = (eg_df["part_src"] - eg_df["part_tgt"]).astype(bool)
     corr_ls = []
     idx_ls = []
     npxs = []
     egd_same, egd_diff = eg_df[~eg_df["part_diff"]], eg_df[eg_df["part_diff"]]
-    idx_dict = {d: nx.get_node_attributes(G, d) for d in idx_dims}
 
     def construct_comput(edf, pxs):
         px_map = {k: v for v, k in enumerate(pxs)}
         ridx = edf["source"].map(px_map).values
         cidx = edf["target"].map(px_map).values
         idx_arr = {
-            d: xr.DataArray([dd[p] for p in pxs], dims="pixels")
-            for d, dd in idx_dict.items()
+            d: xr.DataArray(nod_df[d].values[pxs], dims="pixels")
+            for d in nod_df.columns
         }
         vsub = varr.sel(**idx_arr).data
         if len(idx_arr) > 1:  # vectorized indexing
@@ -1799,7 +2933,7 @@ def graph_optimize_corr(
             npxs.append(len(pixels))
             pixels = set()
             eg_ls = []
-    print("pixel recompute ratio: {}".format(sum(npxs) / G.number_of_nodes()))
+    print("pixel recompute ratio: {}".format(sum(npxs) / nnod))
     print("computing correlations")
     corr_ls = da.compute(corr_ls)[0]
     corr = pd.Series(np.concatenate(corr_ls), index=np.concatenate(idx_ls), name="corr")
@@ -1814,8 +2948,8 @@ def adj_corr(
     Compute correlation in an optimized fashion given an adjacency matrix and
     node attributes.
 
-    Wraps around :func:`graph_optimize_corr` and construct computation graph
-    from `adj` and `nod_df`. Also convert the result into a sparse matrix with
+    Wraps around :func:`edge_optimize_corr` and construct the edge list from
+    `adj` and `nod_df`. Also convert the result into a sparse matrix with
     same shape as `adj`.
 
     Parameters
@@ -1838,10 +2972,9 @@ def adj_corr(
         Sparse matrix of the same shape as `adj` but with values corresponding
         the computed correlation.
     """
-    G = nx.Graph()
-    G.add_nodes_from([(i, d) for i, d in enumerate(nod_df.to_dict("records"))])
-    G.add_edges_from([(s, t) for s, t in zip(*adj.nonzero())])
-    corr_df = graph_optimize_corr(varr, G, freq, idx_dims=nod_df.columns)
+    eg = np.unique(np.sort(np.stack(adj.nonzero(), axis=1), axis=1), axis=0)
+    eg_df = pd.DataFrame({"source": eg[:, 0], "target": eg[:, 1]})
+    corr_df = edge_optimize_corr(varr, eg_df, nod_df.reset_index(drop=True), freq)
     return scipy.sparse.csr_matrix(
         (corr_df["corr"], (corr_df["source"], corr_df["target"])), shape=adj.shape
     )
@@ -1,26 +1,38 @@
 import functools as fct
-import itertools as itt
 import os
+import shutil
 from typing import Optional, Tuple, Union
 
 import cv2
 import dask as da
 import dask.array as darr
-import networkx as nx
 import numpy as np
 import pandas as pd
 import sparse
 import xarray as xr
 from scipy.ndimage.measurements import label
 from scipy.signal import butter, lfilter
-from scipy.sparse import csc_matrix
-from scipy.stats import kstest, zscore
+from scipy.sparse import csc_matrix, csr_matrix
+from scipy.special import ndtr
+from scipy.stats import kstest, kstwo, zscore
 from skimage.morphology import disk
 from sklearn.mixture import GaussianMixture
-from sklearn.neighbors import KDTree, radius_neighbors_graph
-
-from .cnmf import adj_corr, filt_fft, graph_optimize_corr, label_connected
-from .utilities import local_extreme, med_baseline, save_minian, sps_lstsq
+from sklearn.neighbors import radius_neighbors_graph
+
+from .cnmf import (
+    adj_corr,
+    edge_optimize_corr,
+    filt_fft,
+    filt_fft_vec,
+    label_connected,
+)
+from .utilities import (
+    is_sparse,
+    med_baseline,
+    save_minian,
+    sps_lstsq,
+    sps_lstsq_gram,
+)
 
 
 def seeds_init(
@@ -80,6 +92,8 @@ def seeds_init(
         maxima.
     """
     int_path = os.environ["MINIAN_INTERMEDIATE"]
+    # new seeds invalidate any cached seed traces
+    shutil.rmtree(os.path.join(int_path, "seed_traces.zarr"), ignore_errors=True)
     print("constructing chunks")
     idx_fm = varr.coords["frame"]
     nfm = len(idx_fm)
@@ -98,8 +112,11 @@ def seeds_init(
     elif method == "random":
         max_idx = [np.random.randint(0, nfm - 1, wnd_size) for _ in range(nchunk)]
     print("computing max projections")
-    res = [max_proj_frame(varr, cur_idx) for cur_idx in max_idx]
-    max_res = xr.concat(res, "sample")
+    if method == "rolling":
+        max_res = max_proj_rolling(varr, max_idx)
+    else:
+        res = [max_proj_frame(varr, cur_idx) for cur_idx in max_idx]
+        max_res = xr.concat(res, "sample")
     max_res = save_minian(max_res.rename("max_res"), int_path, overwrite=True)
     print("calculating local maximum")
     loc_max = xr.apply_ufunc(
@@ -137,17 +154,92 @@ def max_proj_frame(varr: xr.DataArray, idx: np.ndarray) -> xr.DataArray:
     return varr.isel(frame=idx).max("frame")
 
 
+def max_proj_rolling(varr: xr.DataArray, slices: list) -> xr.DataArray:
+    """
+    Compute max projections on overlapping windows of consecutive frames.
+
+    The frames are split into segments at every boundary of windows and chunks
+    along "frame" dimension. The max projection of each segment is computed in a
+    single pass over the movie, and the max projection of each window is then
+    reduced from the segments it covers, so that no single task holds more
+    than the segments of one window. Hence each frame is only read once
+    regardless of the overlap between windows.
+
+    Parameters
+    ----------
+    varr : xr.DataArray
+        The input movie data containing all frames.
+    slices : list of slice
+        Positional indices of frames in each window.
+
+    Returns
+    -------
+    max_proj : xr.DataArray
+        The max projections with dimensions "sample", "height" and "width".
+    """
+    arr = darr.asarray(varr.transpose("frame", "height", "width").data)
+    nfm = arr.shape[0]
+    chk_bnds = np.cumsum((0,) + arr.chunks[0])
+    wnd_bnds = np.array([(s.start, min(s.stop, nfm)) for s in slices])
+    bnds = np.unique(np.concatenate([wnd_bnds.reshape(-1), chk_bnds]))
+    seg_chks = tuple(
+        int(((bnds >= c0) & (bnds < c1)).sum())
+        for c0, c1 in zip(chk_bnds[:-1], chk_bnds[1:])
+    )
+    seg_max = darr.map_blocks(
+        max_proj_segment,
+        arr,
+        bnds=bnds,
+        dtype=arr.dtype,
+        chunks=(seg_chks,) + arr.chunks[1:],
+    )
+    wnd_seg = np.searchsorted(bnds, wnd_bnds)
+    max_proj = darr.stack([seg_max[s:e].max(axis=0) for s, e in wnd_seg])
+    return xr.DataArray(
+        max_proj,
+        dims=["sample", "height", "width"],
+        coords={d: varr.coords[d] for d in ["height", "width"]},
+    )
+
+
+def max_proj_segment(a: np.ndarray, bnds: np.ndarray, block_info=None) -> np.ndarray:
+    """
+    Compute max projections on consecutive segments of frames within a chunk.
+
+    Parameters
+    ----------
+    a : np.ndarray
+        A chunk of frames with "frame" as the first dimension.
+    bnds : np.ndarray
+        Sorted starting indices of all segments in the whole movie, which
+        should include the starting index of the chunk.
+    block_info : dict, optional
+        Block information passed in by :func:`dask.array.map_blocks`. By
+        default `None`.
+
+    Returns
+    -------
+    seg_max : np.ndarray
+        Max projections of each segment starting within the chunk.
+    """
+    c0, c1 = block_info[0]["array-location"][0]
+    idx = bnds[(bnds >= c0) & (bnds < c1)] - c0
+    return np.maximum.reduceat(a, idx, axis=0)
+
+
 def local_max_roll(
     fm: np.ndarray, k0: int, k1: int, diff: Union[int, float]
 ) -> np.ndarray:
     """
     Compute local maxima of a frame with a range of kernel size.
 
-    This function wraps around :func:`minian.utilities.local_extreme` and
-    compute local maxima of the input frame with kernels of size ranging from
-    `k0` to `k1`. It then takes the union of all the local maxima, and
-    additionally merge all the connecting local maxima by using the middle
-    pixel.
+    This function computes local maxima of the input frame with disk kernels of
+    radius ranging from `k0` to `k1` in the same way as
+    :func:`minian.utilities.local_extreme`. Since the disks are nested, the
+    dilation and erosion with each radius are computed incrementally from those
+    of the previous radius using only the ring of pixels added to the kernel.
+    It then takes the union of all the local maxima, and additionally merge all
+    the connecting local maxima by using the middle pixel.
 
     Parameters
     ----------
@@ -156,10 +248,10 @@ def local_max_roll(
     k0 : int
         The lower bound (inclusive) of the range of kernel sizes.
     k1 : int
-        The upper bound (inclusive) of the range of kernel sizes.
+        The upper bound (exclusive) of the range of kernel sizes.
     diff : Union[int, float]
         Intensity threshold for the difference between local maxima and its
-        neighbours, passed to :func:`minian.utilities.local_extreme`.
+        neighbours, see :func:`minian.utilities.local_extreme`.
 
     Returns
     -------
@@ -167,21 +259,34 @@ def local_max_roll(
         The image of local maxima. Has same shape as `fm`, and 1 at local
         maxima.
     """
-    max_ls = []
+    lmax = np.zeros(fm.shape, dtype=bool)
+    fm_max, fm_min = None, None
     for ksize in range(k0, k1):
         selem = disk(ksize)
-        fm_max = local_extreme(fm, selem, diff=diff)
-        max_ls.append(fm_max)
-    lmax = (np.stack(max_ls, axis=0).sum(axis=0) > 0).astype(np.uint8)
-    nlab, max_lab = cv2.connectedComponents(lmax)
-    max_res = np.zeros_like(lmax)
-    for lb in range(1, nlab):
-        area = max_lab == lb
-        if np.sum(area) > 1:
-            crds = tuple(int(np.median(c)) for c in np.where(area))
-            max_res[crds] = 1
+        if fm_max is None:
+            fm_max = cv2.dilate(fm, selem)
+            fm_min = cv2.erode(fm, selem)
         else:
-            max_res[np.where(area)] = 1
+            ring = selem.copy()
+            ring[1:-1, 1:-1] -= disk(ksize - 1)
+            fm_max = np.maximum(fm_max, cv2.dilate(fm, ring))
+            fm_min = np.minimum(fm_min, cv2.erode(fm, ring))
+        lmax |= (fm == fm_max) & ((fm_max - fm_min) > diff)
+    nlab, max_lab = cv2.connectedComponents(lmax.astype(np.uint8))
+    max_res = np.zeros(fm.shape, dtype=np.uint8)
+    if nlab > 1:
+        # median coordinates of all labels, where the median of an even number
+        # of pixels is the floor of the average of the two middle pixels
+        lab = max_lab[lmax]
+        crds = np.nonzero(lmax)
+        cnt = np.bincount(lab)[1:]
+        start = np.cumsum(cnt) - cnt
+        lo, hi = start + (cnt - 1) // 2, start + cnt // 2
+        med = []
+        for c in crds:
+            c_sort = c[np.lexsort((c, lab))]
+            med.append(((c_sort[lo] + c_sort[hi]) // 2).astype(int))
+        max_res[tuple(med)] = 1
     return max_res
 
 
@@ -244,23 +349,14 @@ def gmm_refine(
     print("selecting seeds")
     varr_sub = varr.sel(spatial=[tuple(hw) for hw in seeds[["height", "width"]].values])
     print("computing peak-valley values")
-    varr_valley = xr.apply_ufunc(
-        np.percentile,
+    varr_pv = xr.apply_ufunc(
+        ptp_q_batch,
         varr_sub.chunk(dict(frame=-1)),
         input_core_dims=[["frame"]],
-        kwargs=dict(q=q[0], axis=-1),
+        kwargs=dict(q=q),
         dask="parallelized",
-        output_dtypes=[varr_sub.dtype],
-    )
-    varr_peak = xr.apply_ufunc(
-        np.percentile,
-        varr_sub.chunk(dict(frame=-1)),
-        input_core_dims=[["frame"]],
-        kwargs=dict(q=q[1], axis=-1),
-        dask="parallelized",
-        output_dtypes=[varr_sub.dtype],
+        output_dtypes=[float],
     )
-    varr_pv = varr_peak - varr_valley
     varr_pv = varr_pv.compute()
     print("fitting GMM models")
     dat = varr_pv.values.reshape(-1, 1)
@@ -275,6 +371,115 @@ def gmm_refine(
     return seeds, varr_pv, gmm
 
 
+def get_seed_traces(varr: xr.DataArray, seeds: pd.DataFrame) -> xr.DataArray:
+    """
+    Extract fluorescence traces of seeds with a single pass over the movie.
+
+    Seeds are grouped by the chunk of `varr` they fall in, so that each chunk
+    is read once and all the seeds within it are gathered together. If the
+    environment variable `MINIAN_INTERMEDIATE` is set, the traces are saved as
+    "seed_traces" in the intermediate folder and reused by subsequent calls as
+    long as all the requested seeds are found there and `varr` has the same
+    token as given by :func:`dask.base.tokenize`. Since dask cannot tokenize
+    zarr arrays deterministically, a movie opened from disk (e.g. with
+    :func:`minian.utilities.open_minian`) gets a new token every time it is
+    opened. Hence the cache is only reused across calls passing the same
+    `varr`, and never across sessions. The cache is also cleared whenever
+    :func:`seeds_init` is called.
+
+    Parameters
+    ----------
+    varr : xr.DataArray
+        Input movie data. Should have dimensions "height", "width" and "frame".
+    seeds : pd.DataFrame
+        Seeds dataframe. Should have column "height" and "width".
+
+    Returns
+    -------
+    traces : xr.DataArray
+        Fluorescence traces of seeds with dimensions "index" and "frame", where
+        "index" follows the index of `seeds`. Also has coordinates "height" and
+        "width" along the "index" dimension.
+
+    Raises
+    ------
+    KeyError
+        if any seed is not located on the coordinates of `varr`
+    """
+    int_path = os.environ.get("MINIAN_INTERMEDIATE")
+    px_req = pd.MultiIndex.from_frame(seeds[["height", "width"]])
+    token = da.base.tokenize(varr)
+    traces = None
+    if int_path is not None and os.path.exists(
+        os.path.join(int_path, "seed_traces.zarr")
+    ):
+        traces = xr.open_zarr(os.path.join(int_path, "seed_traces.zarr"))
+        traces = traces["seed_traces"]
+        px_cache = pd.MultiIndex.from_arrays(
+            [traces.coords["height"].values, traces.coords["width"].values]
+        )
+        pos = px_cache.get_indexer(px_req)
+        if traces.attrs.get("source") != token or (pos < 0).any():
+            traces = None
+    if traces is None:
+        px_uniq = px_req.unique()
+        arr = darr.asarray(varr.transpose("frame", "height", "width").data)
+        hpos = varr.indexes["height"].get_indexer(px_uniq.get_level_values(0))
+        wpos = varr.indexes["width"].get_indexer(px_uniq.get_level_values(1))
+        if (hpos < 0).any() or (wpos < 0).any():
+            raise KeyError(
+                "seeds not found in `varr`: {}".format(
+                    list(px_uniq[(hpos < 0) | (wpos < 0)])
+                )
+            )
+        hbnd = np.cumsum((0,) + arr.chunks[1])
+        wbnd = np.cumsum((0,) + arr.chunks[2])
+        hblk = np.searchsorted(hbnd, hpos, side="right") - 1
+        wblk = np.searchsorted(wbnd, wpos, side="right") - 1
+        blocks = arr.to_delayed()
+        order, trace_ls = [], []
+        for (ih, iw), px_df in pd.DataFrame({"ih": hblk, "iw": wblk}).groupby(
+            ["ih", "iw"]
+        ):
+            idx = px_df.index.values
+            hh, ww = hpos[idx] - hbnd[ih], wpos[idx] - wbnd[iw]
+            trace_ls.append(
+                darr.concatenate(
+                    [
+                        darr.from_delayed(
+                            blocks[ifm, ih, iw][:, hh, ww],
+                            shape=(nfm, len(idx)),
+                            dtype=arr.dtype,
+                        )
+                        for ifm, nfm in enumerate(arr.chunks[0])
+                    ],
+                    axis=0,
+                )
+            )
+            order.append(idx)
+        order = np.concatenate(order)
+        # split seeds into about 128 chunks, with chunk size no greater than 100
+        chk_size = max(min(int(len(order) / 128), 100), 1)
+        traces = xr.DataArray(
+            darr.concatenate(trace_ls, axis=1).T.rechunk({0: chk_size, 1: -1}),
+            dims=["index", "frame"],
+            coords={
+                "index": np.arange(len(order)),
+                "frame": varr.coords["frame"].values,
+                "height": ("index", px_uniq.get_level_values(0)[order]),
+                "width": ("index", px_uniq.get_level_values(1)[order]),
+            },
+            name="seed_traces",
+            attrs={"source": token},
+        )
+        if int_path is not None:
+            traces = save_minian(traces, int_path, overwrite=True)
+        pos = pd.MultiIndex.from_arrays(
+            [traces.coords["height"].values, traces.coords["width"].values]
+        ).get_indexer(px_req)
+    return traces.isel(index=pos).assign_coords(index=seeds.index.values)
+
+
 def pnr_refine(
     varr: xr.DataArray,
     seeds: pd.DataFrame,
@@ -333,19 +538,10 @@ def pnr_refine(
         unless `thres` is `"auto"`.
     """
     print("selecting seeds")
-    # vectorized indexing on dask arrays produce a single chunk.
-    # to memory issue, split seeds into 128 chunks, with chunk size no greater than 100
-    chk_size = min(int(len(seeds) / 128), 100)
-    vsub_ls = []
-    for _, seed_sub in seeds.groupby(np.arange(len(seeds)) // chk_size):
-        vsub = varr.sel(
-            height=seed_sub["height"].to_xarray(), width=seed_sub["width"].to_xarray()
-        )
-        vsub_ls.append(vsub)
-    varr_sub = xr.concat(vsub_ls, "index")
+    varr_sub = get_seed_traces(varr, seeds)
     if med_wnd:
         print("removing baseline")
-        varr = xr.apply_ufunc(
+        varr_sub = xr.apply_ufunc(
             med_baseline,
             varr_sub,
             input_core_dims=[["frame"]],
@@ -357,12 +553,11 @@ def pnr_refine(
         )
     print("computing peak-noise ratio")
     pnr = xr.apply_ufunc(
-        pnr_perseed,
+        pnr_batch,
         varr_sub,
         input_core_dims=[["frame"]],
         output_core_dims=[[]],
         kwargs={"freq": noise_freq, "q": q},
-        vectorize=True,
         dask="parallelized",
         output_dtypes=[float],
     ).compute()
@@ -427,6 +622,62 @@ def pnr_perseed(a: np.ndarray, freq: float, q: tuple) -> float:
     return ptp / ptp_noise
 
 
+def ptp_q_batch(a: np.ndarray, q: tuple) -> np.ndarray:
+    """
+    Compute peak-to-peak values of a batch of timeseries with percentile
+    values.
+
+    Parameters
+    ----------
+    a : np.ndarray
+        Input timeseries with time as the last dimension.
+    q : tuple
+        Tuple specifying low and high percentile values.
+
+    Returns
+    -------
+    ptp : np.ndarray
+        The peak-to-peak values.
+
+    See Also
+    -------
+    ptp_q
+    """
+    pct = np.percentile(a, q, axis=-1)
+    return pct[1] - pct[0]
+
+
+def pnr_batch(a: np.ndarray, freq: float, q: tuple) -> np.ndarray:
+    """
+    Compute peak-to-noise ratio of a batch of timeseries.
+
+    The noise of all timeseries is computed with a single batched fft.
+
+    Parameters
+    ----------
+    a : np.ndarray
+        Input timeseries. Should have 2 dimensions with time as the last
+        dimension.
+    freq : float
+        Cut-off frequency of the high-pass filtering used to define noise.
+    q : tuple
+        Percentile used to compute peak-to-peak values.
+
+    Returns
+    -------
+    pnr : np.ndarray
+        Peak-to-noise ratio of each timeseries.
+
+    See Also
+    -------
+    pnr_perseed
+    """
+    ptp = ptp_q_batch(a, q)
+    a = filt_fft_vec(a.astype(float), freq, "high")
+    ptp_noise = ptp_q_batch(a, q)
+    return ptp / ptp_noise
+
+
 def intensity_refine(
     varr: xr.DataArray, seeds: pd.DataFrame, thres_mul=2
 ) -> pd.DataFrame:
@@ -502,23 +753,13 @@ def ks_refine(varr: xr.DataArray, seeds: pd.DataFrame, sig=0.01) -> pd.DataFrame
         column already exists in input `seeds` it will be overwritten.
     """
     print("selecting seeds")
-    # vectorized indexing on dask arrays produce a single chunk.
-    # to memory issue, split seeds into 128 chunks, with chunk size no greater than 100
-    chk_size = min(int(len(seeds) / 128), 100)
-    vsub_ls = []
-    for _, seed_sub in seeds.groupby(np.arange(len(seeds)) // chk_size):
-        vsub = varr.sel(
-            height=seed_sub["height"].to_xarray(), width=seed_sub["width"].to_xarray()
-        )
-        vsub_ls.append(vsub)
-    varr_sub = xr.concat(vsub_ls, "index")
+    varr_sub = get_seed_traces(varr, seeds)
     print("performing KS test")
     ks = xr.apply_ufunc(
-        ks_perseed,
+        ks_batch,
         varr_sub,
         input_core_dims=[["frame"]],
         output_core_dims=[[]],
-        vectorize=True,
         dask="parallelized",
         output_dtypes=[float],
     ).compute()
@@ -549,6 +790,38 @@ def ks_perseed(a: np.ndarray) -> float:
     return kstest(a, "norm")[1]
 
 
+def ks_batch(a: np.ndarray) -> np.ndarray:
+    """
+    Perform KS test on a batch of timeseries and return the p-values.
+
+    Each timeseries is z-scored and tested against the standard normal
+    distribution. The two-sided KS statistic of all timeseries is computed at
+    once, and the p-values are given by the exact distribution of the
+    statistic.
+
+    Parameters
+    ----------
+    a : np.ndarray
+        Input data. Should have 2 dimensions with samples along the last
+        dimension.
+
+    Returns
+    -------
+    p : np.ndarray
+        The p-values of the KS test.
+
+    See Also
+    -------
+    ks_perseed
+    """
+    a = np.sort(zscore(a, axis=-1), axis=-1)
+    n = a.shape[-1]
+    cdf = ndtr(a)
+    d_plus = (np.arange(1, n + 1) / n - cdf).max(axis=-1)
+    d_minus = (cdf - np.arange(n) / n).max(axis=-1)
+    return kstwo.sf(np.maximum(d_plus, d_minus), n)
+
+
 def seeds_merge(
     varr: xr.DataArray,
     max_proj: xr.DataArray,
@@ -595,29 +868,23 @@ def seeds_merge(
     print("computing distance")
     nng = radius_neighbors_graph(seeds[["height", "width"]], thres_dist)
     print("computing correlations")
-    adj = adj_corr(varr, nng, seeds[["height", "width"]], noise_freq)
+    idx = pd.DataFrame({"index": np.arange(len(seeds))})
+    traces = get_seed_traces(varr, seeds).assign_coords(index=idx["index"].values)
+    adj = adj_corr(traces, nng, idx, noise_freq)
     print("merging seeds")
     adj = adj > thres_corr
     adj = adj + adj.T
     labels = label_connected(adj, only_connected=True)
-    iso = np.where(labels < 0)[0]
-    seeds_final = set(iso.tolist())
-    for cur_cmp in np.unique(labels):
-        if cur_cmp < 0:
-            continue
-        cur_smp = np.where(labels == cur_cmp)[0]
-        cur_max = np.array(
-            [
-                max_proj.sel(
-                    height=seeds.iloc[s]["height"], width=seeds.iloc[s]["width"]
-                )
-                for s in cur_smp
-            ]
-        )
-        max_seed = cur_smp[np.argmax(cur_max)]
-        seeds_final.add(max_seed)
-    seeds["mask_mrg"] = False
-    seeds.loc[list(seeds_final), "mask_mrg"] = True
+    # keep isolated seeds and the brightest seed within each connected group
+    max_val = max_proj.sel(
+        height=xr.DataArray(seeds["height"].values, dims="index"),
+        width=xr.DataArray(seeds["width"].values, dims="index"),
+    ).values
+    lab_df = pd.DataFrame({"label": labels, "max_val": max_val})
+    lab_df = lab_df[lab_df["label"] >= 0]
+    mask = labels < 0
+    mask[lab_df.groupby("label")["max_val"].idxmax().values] = True
+    seeds["mask_mrg"] = mask
     return seeds
 
 
@@ -662,85 +929,67 @@ def initA(
 
     See Also
     -------
-    minian.cnmf.graph_optimize_corr :
+    minian.cnmf.edge_optimize_corr :
         for how the correlation are computed in an out-of-core fashion
     """
     print("optimizing computation graph")
+    seeds = seeds.sort_values(["height", "width"])
+    nh, nw = varr.sizes["height"], varr.sizes["width"]
+    sd_h = varr.indexes["height"].get_indexer(seeds["height"])
+    sd_w = varr.indexes["width"].get_indexer(seeds["width"])
+    # integer offsets of pixels within the disk window
+    off_h, off_w = np.nonzero(disk(wnd))
+    off_h, off_w = off_h - wnd, off_w - wnd
+    nb_h = sd_h[:, np.newaxis] + off_h[np.newaxis, :]
+    nb_w = sd_w[:, np.newaxis] + off_w[np.newaxis, :]
+    sd_px = np.ravel_multi_index((sd_h, sd_w), (nh, nw))
+    valid = (nb_h >= 0) & (nb_h < nh) & (nb_w >= 0) & (nb_w < nw)
+    nb_px = np.where(valid, nb_h * nw + nb_w, -1)
+    valid &= nb_px != sd_px[:, np.newaxis]
+    # edges between seeds and their neighbouring pixels, each represented once
+    eg = np.stack(
+        [np.broadcast_to(sd_px[:, np.newaxis], nb_px.shape)[valid], nb_px[valid]]
+    )
+    eg = np.unique(np.sort(eg, axis=0), axis=1)
+    pxs = np.unique(np.concatenate([eg.reshape(-1), sd_px]))
+    eg = np.searchsorted(pxs, eg)
+    ih, iw = np.unravel_index(pxs, (nh, nw))
     nod_df = pd.DataFrame(
-        np.array(
-            list(itt.product(varr.coords["height"].values, varr.coords["width"].values))
-        ),
-        columns=["height", "width"],
-    ).merge(seeds.reset_index(), how="outer", on=["height", "width"])
-    seed_df = nod_df[nod_df["index"].notnull()]
-    nn_tree = KDTree(nod_df[["height", "width"]], leaf_size=(2 * wnd) ** 2)
-    nns_arr = nn_tree.query_radius(seed_df[["height", "width"]], r=wnd)
-    sdg = nx.Graph()
-    sdg.add_nodes_from(
-        [
-            (i, d)
-            for i, d in enumerate(
-                nod_df[["height", "width", "index"]].to_dict("records")
-            )
-        ]
+        {
+            "height": varr.coords["height"].values[ih],
+            "width": varr.coords["width"].values[iw],
+        }
     )
-    for isd, nns in enumerate(nns_arr):
-        cur_sd = seed_df.index[isd]
-        sdg.add_edges_from([(cur_sd, n) for n in nns if n != cur_sd])
-    sdg.remove_nodes_from(list(nx.isolates(sdg)))
-    sdg = nx.convert_node_labels_to_integers(sdg)
-    corr_df = graph_optimize_corr(varr, sdg, noise_freq)
+    eg_df = pd.DataFrame({"source": eg[0], "target": eg[1]})
+    corr_df = edge_optimize_corr(varr, eg_df, nod_df, noise_freq)
     print("building spatial matrix")
     corr_df = corr_df[corr_df["corr"] > thres_corr]
-    nod_df = pd.DataFrame.from_dict(dict(sdg.nodes(data=True)), orient="index")
-    seed_df = nod_df[nod_df["index"].notnull()].astype({"index": int})
-    A_ls = []
-    ih_dict = (
-        varr.coords["height"]
-        .to_series()
-        .reset_index(drop=True)
-        .reset_index()
-        .set_index("height")["index"]
-        .to_dict()
-    )
-    iw_dict = (
-        varr.coords["width"]
-        .to_series()
-        .reset_index(drop=True)
-        .reset_index()
-        .set_index("width")["index"]
-        .to_dict()
+    # symmetric correlation between nodes, with the seeds correlating to
+    # themselves with 1
+    sd_nod = np.searchsorted(pxs, sd_px)
+    sd_uniq = np.unique(sd_nod)
+    src, tgt = corr_df["source"].values, corr_df["target"].values
+    corr = csr_matrix(
+        (
+            np.concatenate([corr_df["corr"].values] * 2 + [np.ones(len(sd_uniq))]),
+            (
+                np.concatenate([src, tgt, sd_uniq]),
+                np.concatenate([tgt, src, sd_uniq]),
+            ),
+        ),
+        shape=(len(pxs), len(pxs)),
     )
-    Ashape = (varr.sizes["height"], varr.sizes["width"])
-    for seed_id, sd in seed_df.iterrows():
-        src_corr = corr_df[corr_df["target"] == seed_id].copy()
-        src_nods = nod_df.loc[src_corr["source"]]
-        src_corr["height"], src_corr["width"] = (
-            src_nods["height"].values,
-            src_nods["width"].values,
-        )
-        tgt_corr = corr_df[corr_df["source"] == seed_id].copy()
-        tgt_nods = nod_df.loc[tgt_corr["target"]]
-        tgt_corr["height"], tgt_corr["width"] = (
-            tgt_nods["height"].values,
-            tgt_nods["width"].values,
-        )
-        cur_corr = pd.concat([src_corr, tgt_corr]).append(
-            {"corr": 1, "height": sd["height"], "width": sd["width"]}, ignore_index=True
-        )
-        cur_corr["iheight"] = cur_corr["height"].map(ih_dict)
-        cur_corr["iwidth"] = cur_corr["width"].map(iw_dict)
-        cur_A = darr.array(
-            sparse.COO(
-                cur_corr[["iheight", "iwidth"]].T, cur_corr["corr"], shape=Ashape
-            )
-        )
-        A_ls.append(cur_A)
+    A = corr[sd_nod].tocoo()
+    A = sparse.COO(
+        np.stack([A.row, pxs[A.col]]), A.data, shape=(len(seeds), nh * nw)
+    ).reshape((len(seeds), nh, nw))
     A = xr.DataArray(
-        darr.stack(A_ls).map_blocks(lambda a: a.todense(), dtype=float),
+        darr.from_array(A, chunks=(1, -1, -1), asarray=False).map_blocks(
+            lambda a: a.todense(), dtype=float
+        ),
         dims=["unit_id", "height", "width"],
         coords={
-            "unit_id": seed_df["index"].values,
+            "unit_id": seeds.index.values,
             "height": varr.coords["height"].values,
             "width": varr.coords["width"].values,
         },
@@ -748,7 +997,7 @@ def initA(
     return A
 
 
-def initC(varr: xr.DataArray, A: xr.DataArray) -> xr.DataArray:
+def initC(varr: xr.DataArray, A: xr.DataArray, solver="lsqr") -> xr.DataArray:
     """
     Initialize temporal component given spatial footprints.
 
@@ -762,25 +1011,44 @@ def initC(varr: xr.DataArray, A: xr.DataArray) -> xr.DataArray:
         Input movie data. Should have dimensions ("height", "width", "frame").
     A : xr.DataArray
         Spatial footprints of cells. Should have dimensions ("unit_id",
-        "height", "width").
+        "height", "width"). Can be sparse-backed (see
+        :func:`minian.utilities.as_sparse`).
+    solver : str, optional
+        Method used to solve the least-square problem. If `"lsqr"`, then
+        :func:`scipy.sparse.linalg.lsqr` is run for 10 iterations on each frame.
+        If `"exact"`, then the exact solution is computed from the normal
+        equations, where the Gram matrix of spatial footprints is factorized
+        once for each chunk of frames, see
+        :func:`minian.utilities.sps_lstsq_gram`. By default `"lsqr"`.
 
     Returns
     -------
     C : xr.DataArray
         The initial estimation of temporal components for each cell. Should have
         dimensions ("unit_id", "frame").
+
+    Raises
+    ------
+    NotImplementedError
+        if `solver` is not "lsqr" or "exact"
     """
+    if solver not in ["lsqr", "exact"]:
+        raise NotImplementedError(solver)
     uids = A.coords["unit_id"]
     fms = varr.coords["frame"]
+    to_csc = (lambda a: a.tocsc()) if is_sparse(A) else csc_matrix
     A = (
         A.stack(spatial=["height", "width"])
         .transpose("spatial", "unit_id")
-        .data.map_blocks(csc_matrix)
+        .data.map_blocks(to_csc)
         .rechunk(-1)
         .persist()
     )
     varr = varr.stack(spatial=["height", "width"]).transpose("frame", "spatial").data
-    C = sps_lstsq(A, varr, iter_lim=10)
+    if solver == "lsqr":
+        C = sps_lstsq(A, varr, iter_lim=10)
+    else:
+        C = sps_lstsq_gram(A, varr)
     C = xr.DataArray(
         C, dims=["frame", "unit_id"], coords={"unit_id": uids, "frame": fms}
     ).transpose("unit_id", "frame")
@@ -1,22 +1,40 @@
 import functools as fct
 import itertools as itt
+import os
+import threading
 import warnings
-from typing import Optional, Tuple
+from collections import OrderedDict
+from typing import List, Optional, Tuple, Union
 
 import cv2
 import dask as da
 import dask.array as darr
+import numba as nb
 import numpy as np
+import pyfftw
+from scipy.signal.windows import tukey
 import SimpleITK as sitk
 import xarray as xr
-from skimage.registration import phase_cross_correlation
+import zarr as zr
 
-from .utilities import custom_arr_optimize, xrconcat_recursive
+from .utilities import custom_arr_optimize, save_minian, xrconcat_recursive
+
+
+QUALITY_METRICS = ["peak_corr", "leaf_temp_corr", "alt_diff"]
+"""
+Names of the registration quality metrics returned by :func:`estimate_motion`.
+"""
 
 
 def estimate_motion(
-    varr: xr.DataArray, dim="frame", npart=3, chunk_nfm: Optional[int] = None, **kwargs
-) -> xr.DataArray:
+    varr: xr.DataArray,
+    dim="frame",
+    npart=3,
+    chunk_nfm: Optional[int] = None,
+    return_quality=False,
+    reg_dim: Optional[str] = None,
+    **kwargs
+) -> Union[xr.DataArray, tuple]:
     """
     Estimate motion for each frame of the input movie data.
 
@@ -36,10 +54,23 @@ def estimate_motion(
     modelling the motion of each frame as translations of individual vertices of
     a smooth BSpline mesh. The estimation of the translations can then be find
     by gradient descent using correlation between frames as objective. This
-    feature is currently experimental. Additionally, various correction
-    procedures can be carry out to filter out frames not suited as template for
-    motion correction, or to correct for large false shifts when the quality of
-    templates are low.
+    feature is currently experimental. A faster non-rigid option is the
+    piecewise-rigid mode, where each frame is splitted into overlapping patches
+    and a rigid shift is estimated for each patch with phase correlation after a
+    rigid pre-alignment of the full frame. The patch-wise shifts are then
+    interpolated into a smooth shift field when applying the motion.
+    Additionally, various correction procedures can be carry out to filter out
+    frames not suited as template for motion correction, or to correct for
+    large false shifts when the quality of templates are low.
+
+    If `varr` has dimensions other than `dim`, "height" and "width", motion
+    estimation is carried out independently for each combination of labels of
+    the extra dimensions. If in addition `reg_dim` is specified, the final
+    templates of the recursive algorithm along `reg_dim` (for example
+    "session") are registered to each other with the same algorithm, resulting
+    in rigid offsets that align all labels of `reg_dim` to a common reference.
+    All of these are constructed as one dask graph, so that computing the
+    results together reuse the templates.
 
     Parameters
     ----------
@@ -55,6 +86,16 @@ def estimate_motion(
         Number of frames in each parallel task. Note that this only affects dask
         graph construction, but not the recursion of the algorithm. If `None`
         then the dask chunksize along `dim` will be used. By default `None`.
+    return_quality : bool, optional
+        Whether to also return quality metrics of registration for each frame.
+        `"peak_corr"` and `"alt_diff"` are computed from intermediate results
+        of the recursive algorithm, hence at little extra cost, while
+        `"leaf_temp_corr"` requires transforming every frame a second time. By
+        default `False`.
+    reg_dim : str, optional
+        An extra dimension of `varr` along which the final templates should be
+        registered to each other. If not `None`, then the offsets are returned
+        in addition to the motion. By default `None`.
 
     Keyword Arguments
     -----------------
@@ -76,9 +117,9 @@ def estimate_motion(
         How frames should be aggregated to generate the template for each chunk.
         Should be either "mean" or "max". By default `"mean"`.
     upsample : int, optional
-        The upsample factor passed to
-        :func:`skimage.registration.phase_cross_correlation` to achieve
-        sub-pixel accuracy.
+        The upsample factor of the local upsampled DFT used to refine the phase
+        correlation peak, which determines the sub-pixel accuracy of rigid
+        estimation. See :func:`phase_corr_batch`. By default `100`.
     circ_thres : float, optional
         The circularity threshold to check whether a frame can serve as a good
         template for estimating motion. If not `None`, then for each frame a
@@ -109,14 +150,75 @@ def estimate_motion(
         Significantly improve performance but sacrifice accuracy of estimation
         for dim regions. Only used if `mesh_size is not None`. By default
         `None`.
+    patch_size : Tuple[int, int], optional
+        Size of patches in pixels, specified in the order ("height", "width").
+        If not `None` then the piecewise-rigid motion estimation is enabled.
+        Cannot be used together with `mesh_size`. By default `None`.
+    patch_step : Tuple[int, int], optional
+        Distance between the starting pixels of consecutive patches. Only used
+        if `patch_size is not None`. If `None` then half of `patch_size` will be
+        used, so that consecutive patches overlap by half. By default `None`.
+    pyramid_level : int, optional
+        Number of levels of the Gaussian pyramid used for rigid estimation. If
+        not `None`, then the rigid motion between frames is first estimated to
+        pixel precision on frames downsampled by `2 ** pyramid_level` with
+        :func:`cv2.pyrDown`, then only refined locally at full resolution. This
+        reduces the cost of estimation on large frames, at the expense of
+        missing fine features that do not survive the downsampling. By default
+        `None`.
+    search_wnd : int, optional
+        Maximum absolute rigid motion between frames (or templates) in pixels
+        along each dimension. Peaks of the phase correlation beyond this window
+        are ignored. If `None` then all possible shifts are considered. By
+        default `None`.
 
     Returns
     -------
     motion : xr.DataArray
         Estimated motion for each frame. Has two dimensions `dim` and
-        `"shift_dim"` representing rigid shifts in each direction if `mesh_size
-        is None`, otherwise has four dimensions: `dim`, `"grid0"`, `"grid1"` and
-        `"shift_dim"` representing shifts for each mesh grid control point.
+        `"shift_dim"` representing rigid shifts in each direction if `mesh_size`
+        and `patch_size` are `None`, otherwise has four dimensions: `dim`,
+        `"shift_dim"`, `"grid0"` and `"grid1"` representing shifts for each mesh
+        grid control point or each patch. In the piecewise-rigid case, the
+        coordinates of `"grid0"` and `"grid1"` are the centers of patches in
+        pixels.
+    quality : xr.DataArray, optional
+        Quality metrics of registration for each frame. Only returned if
+        `return_quality=True`. Has two dimensions `dim` and `"metric"`, where
+        `"metric"` has the following coordinates:
+
+        `"peak_corr"`
+            Peak value of the cross-correlation when registering the frame to
+            its neighboring frame at the first level of recursion, normalized
+            as Pearson correlation of the two frames at the estimated shift,
+            where the frames are circularly shifted. The reference frame of
+            each chunk takes the highest peak among frames registered to it.
+            Low values indicate frames that are hard to register. `NaN` for
+            non-rigid estimation with `mesh_size`.
+        `"leaf_temp_corr"`
+            Pearson correlation between the motion-corrected frame and the
+            template of its chunk at the first level of recursion, which is not
+            the final template. This costs an extra transform pass over all
+            frames of each chunk.
+        `"alt_diff"`
+            Maximum absolute difference in pixels between the two alternative
+            estimations of motion across all levels of recursion involving the
+            frame. Large values indicate potentially wrong motion between
+            chunks. `NaN` if `alt_error` is `None`.
+    offset : xr.DataArray, optional
+        Rigid offsets of each label along `reg_dim` relative to the common
+        reference. Only returned if `reg_dim` is not `None`. Has dimensions
+        `reg_dim` and `"shift_dim"`, and the dimensions of `varr` other than
+        `dim`, `reg_dim`, "height" and "width". Can be applied to the data of
+        each label, such as the motion-corrected movie or spatial footprints
+        of cells, with :func:`apply_transform`, for example before computing
+        centroids with :func:`minian.cross_registration.calculate_centroids`.
+
+    Raises
+    ------
+    ValueError
+        if both `mesh_size` and `patch_size` are specified, or if `reg_dim` is
+        not one of the extra dimensions of `varr`
 
     See Also
     --------
@@ -125,22 +227,54 @@ def estimate_motion(
     """
     varr = varr.transpose(..., dim, "height", "width")
     loop_dims = list(set(varr.dims) - set(["height", "width", dim]))
+    if kwargs.get("mesh_size", None) and kwargs.get("patch_size", None):
+        raise ValueError("mesh_size and patch_size cannot be used together")
+    if reg_dim is not None and reg_dim not in loop_dims:
+        raise ValueError("reg_dim {} not in {}".format(reg_dim, loop_dims))
+    grid_crd = dict()
+    if kwargs.get("patch_size", None):
+        starts = get_patch_grid(
+            (varr.sizes["height"], varr.sizes["width"]),
+            kwargs["patch_size"],
+            kwargs.get("patch_step", None),
+        )
+        grid_crd = {
+            "grid{}".format(i): st + (psz - 1) / 2
+            for i, (st, psz) in enumerate(zip(starts, kwargs["patch_size"]))
+        }
     if npart is None:
         # by default use a npart that result in two layers of recursion
         npart = max(3, int(np.ceil((varr.sizes[dim] / chunk_nfm) ** (1 / 2))))
     if loop_dims:
         loop_labs = [varr.coords[d].values for d in loop_dims]
         res_dict = dict()
+        qual_dict = dict()
+        tmp_dict = dict()
         for lab in itt.product(*loop_labs):
             va = varr.sel({loop_dims[i]: lab[i] for i in range(len(loop_dims))})
-            vmax, sh = est_motion_part(va.data, npart, chunk_nfm, **kwargs)
-            if kwargs.get("mesh_size", None):
+            res = est_motion_part(
+                va.data, npart, chunk_nfm, return_quality=return_quality, **kwargs
+            )
+            sh = res[1]
+            # use the aggregated template if first/last frames are included
+            tmp_dict[lab] = res[0][0, 1] if res[0].ndim > 3 else res[0][0]
+            if return_quality:
+                qual = xr.DataArray(
+                    res[2],
+                    dims=[dim, "metric"],
+                    coords={dim: va.coords[dim].values, "metric": QUALITY_METRICS},
+                )
+                qual_dict[lab] = qual.assign_coords(
+                    **{k: v for k, v in zip(loop_dims, lab)}
+                )
+            if kwargs.get("mesh_size", None) or kwargs.get("patch_size", None):
                 sh = xr.DataArray(
                     sh,
                     dims=[dim, "shift_dim", "grid0", "grid1"],
                     coords={
                         dim: va.coords[dim].values,
                         "shift_dim": ["height", "width"],
+                        **grid_crd,
                     },
                 )
             else:
@@ -154,15 +288,27 @@ def estimate_motion(
                 )
             res_dict[lab] = sh.assign_coords(**{k: v for k, v in zip(loop_dims, lab)})
         sh = xrconcat_recursive(res_dict, loop_dims)
+        if return_quality:
+            qual = xrconcat_recursive(qual_dict, loop_dims)
     else:
-        vmax, sh = est_motion_part(varr.data, npart, chunk_nfm, **kwargs)
-        if kwargs.get("mesh_size", None):
+        res = est_motion_part(
+            varr.data, npart, chunk_nfm, return_quality=return_quality, **kwargs
+        )
+        sh = res[1]
+        if return_quality:
+            qual = xr.DataArray(
+                res[2],
+                dims=[dim, "metric"],
+                coords={dim: varr.coords[dim].values, "metric": QUALITY_METRICS},
+            )
+        if kwargs.get("mesh_size", None) or kwargs.get("patch_size", None):
             sh = xr.DataArray(
                 sh,
                 dims=[dim, "shift_dim", "grid0", "grid1"],
                 coords={
                     dim: varr.coords[dim].values,
                     "shift_dim": ["height", "width"],
+                    **grid_crd,
                 },
             )
         else:
@@ -174,12 +320,190 @@ def estimate_motion(
                     "shift_dim": ["height", "width"],
                 },
             )
+    ret = (sh,)
+    if return_quality:
+        ret = ret + (qual.rename("motion_quality"),)
+    if reg_dim is not None:
+        ireg = loop_dims.index(reg_dim)
+        grp_dims = [d for d in loop_dims if d != reg_dim]
+        off_dict = dict()
+        for glab in itt.product(*[varr.coords[d].values for d in grp_dims]):
+            labs = [
+                lab
+                for lab in tmp_dict
+                if tuple(lb for i, lb in enumerate(lab) if i != ireg) == glab
+            ]
+            temps = darr.stack([tmp_dict[lab] for lab in labs], axis=0)
+            res = da.delayed(est_motion_chunk)(
+                temps,
+                None,
+                npart=npart,
+                alt_error=None,
+                aggregation=kwargs.get("aggregation", "mean"),
+                upsample=kwargs.get("upsample", 100),
+            )
+            off = xr.DataArray(
+                darr.from_delayed(res[1], shape=(len(labs), 2), dtype=float),
+                dims=[reg_dim, "shift_dim"],
+                coords={
+                    reg_dim: [lab[ireg] for lab in labs],
+                    "shift_dim": ["height", "width"],
+                },
+            )
+            off_dict[glab] = off.assign_coords(**dict(zip(grp_dims, glab)))
+        if grp_dims:
+            offset = xrconcat_recursive(off_dict, grp_dims)
+        else:
+            offset = off_dict[()]
+        ret = ret + (offset.rename("offset"),)
+    if len(ret) > 1:
+        return ret
     return sh
 
 
+def motion_correct(
+    varr: xr.DataArray,
+    dpath: str,
+    dim="frame",
+    npart=3,
+    chunk_nfm: Optional[int] = None,
+    fill=0,
+    dtype: Optional[type] = None,
+    name="Y_fm_chk",
+    **kwargs
+) -> Tuple[xr.DataArray, xr.DataArray]:
+    """
+    Estimate and correct rigid motion in a single pass over the movie.
+
+    This function is equivalent to running :func:`estimate_motion` followed by
+    :func:`apply_transform` and saving the results with :func:`save_minian`,
+    except that each chunk of the movie is only loaded once. The chunks loaded
+    at the leaf level of the recursive algorithm are kept and reused to produce
+    the motion-corrected chunks once the upper levels of recursion resolve the
+    final motion. Both the motion-corrected movie and the motion are saved
+    under `dpath` in one computation.
+
+    Parameters
+    ----------
+    varr : xr.DataArray
+        Input movie data. Should have dimensions `dim`, "height" and "width".
+    dpath : str
+        The path to the directory where results should be saved.
+    dim : str, optional
+        The dimension along which motion estimation should be carried out. By
+        default `"frame"`.
+    npart : int, optional
+        Number of frames/chunks to combine for the recursive algorithm. By
+        default `3`.
+    chunk_nfm : int, optional
+        Number of frames in each parallel task. If `None` then the dask
+        chunksize along `dim` will be used. By default `None`.
+    fill : int, optional
+        Values used to fill in missing pixels (outside field of view). By
+        default `0`.
+    dtype : type, optional
+        Datatype of the motion-corrected movie. If `None` then the datatype of
+        `varr` will be used. By default `None`.
+    name : str, optional
+        Name of the motion-corrected movie when saved. The motion will be saved
+        with name "motion". By default `"Y_fm_chk"`.
+
+    Keyword Arguments
+    -----------------
+    **kwargs :
+        Additional keyword arguments passed to :func:`est_motion_chunk`. See
+        :func:`estimate_motion` for details. Only rigid motion correction is
+        supported.
+
+    Returns
+    -------
+    varr_sh : xr.DataArray
+        The motion-corrected movie loaded from `dpath`.
+    motion : xr.DataArray
+        Estimated motion loaded from `dpath`.
+
+    Raises
+    ------
+    NotImplementedError
+        if `mesh_size` or `patch_size` is specified, or `varr` has dimensions
+        other than `dim`, "height" and "width"
+
+    Notes
+    -----
+    The loaded chunks are only released once the motion of the full movie is
+    resolved, hence the workers should have enough memory or spill space to
+    hold the whole movie. Chunks that do not fit in memory are spilled to disk
+    by the workers, which is usually still cheaper than loading and
+    preprocessing them again.
+    """
+    if kwargs.get("mesh_size", None) or kwargs.get("patch_size", None):
+        raise NotImplementedError("only rigid motion correction is supported")
+    if set(varr.dims) != set([dim, "height", "width"]):
+        raise NotImplementedError(
+            "dimensions other than {} not supported".format([dim, "height", "width"])
+        )
+    varr = varr.transpose(dim, "height", "width")
+    arr = varr.data
+    if chunk_nfm is None:
+        chunk_nfm = arr.chunksize[0]
+    arr = arr.rechunk((chunk_nfm, None, None))
+    temps, shifts, blk_ls = est_motion_part(
+        arr, npart, chunk_nfm, return_blocks=True, **kwargs
+    )
+    if dtype is None:
+        dtype = varr.dtype
+    # the final level of recursion produce motion of all frames in one block
+    arr_opt = fct.partial(custom_arr_optimize, keep_patterns=["^est_motion_chunk"])
+    with da.config.set(array_optimize=arr_opt):
+        sh = shifts.to_delayed().ravel()[0]
+    shifts = darr.from_delayed(sh, shape=shifts.shape, dtype=shifts.dtype)
+    fm_ls = []
+    for blk, start, nfm in zip(blk_ls, np.cumsum((0,) + arr.chunks[0]), arr.chunks[0]):
+        fm = da.delayed(shift_frames)(blk, sh[start : start + nfm], fill=fill)
+        fm_ls.append(
+            darr.from_delayed(fm, shape=(nfm,) + arr.shape[1:], dtype=varr.dtype)
+        )
+    varr_sh = xr.DataArray(
+        darr.concatenate(fm_ls, axis=0).astype(dtype),
+        dims=varr.dims,
+        coords=varr.coords,
+        name=name,
+    )
+    motion = xr.DataArray(
+        shifts.rechunk((chunk_nfm, -1)),
+        dims=[dim, "shift_dim"],
+        coords={dim: varr.coords[dim].values, "shift_dim": ["height", "width"]},
+        name="motion",
+    )
+    # initialize the stores, then write both arrays in one computation so that
+    # tasks shared by the movie and the motion are only executed once
+    fps = []
+    for v in (varr_sh, motion):
+        save_minian(v, dpath, overwrite=True, compute=False)
+        fps.append(os.path.join(dpath, v.name + ".zarr"))
+    with da.config.set(array_optimize=arr_opt):
+        darr.store(
+            [varr_sh.data, motion.data],
+            [zr.open(fp)[v.name] for fp, v in zip(fps, (varr_sh, motion))],
+            lock=False,
+        )
+    res = []
+    for fp, v in zip(fps, (varr_sh, motion)):
+        arr = xr.open_zarr(fp)[v.name]
+        arr.data = darr.from_zarr(os.path.join(fp, v.name), inline_array=True)
+        res.append(arr)
+    return tuple(res)
+
+
 def est_motion_part(
-    varr: darr.Array, npart: int, chunk_nfm: int, alt_error=5, **kwargs
-) -> Tuple[darr.Array, darr.Array]:
+    varr: darr.Array,
+    npart: int,
+    chunk_nfm: int,
+    alt_error=5,
+    return_blocks=False,
+    return_quality=False,
+    **kwargs
+) -> tuple:
     """
     Construct dask graph for the recursive motion estimation algorithm.
 
@@ -194,6 +518,14 @@ def est_motion_part(
     alt_error : int, optional
         Error threshold between estimated shifts from two alternative methods,
         specified in pixels. By default `5`.
+    return_blocks : bool, optional
+        Whether to also return the blocks of movie data used at the leaf level
+        of the recursion. If `True`, each block is loaded by a single task, so
+        that further computation on the returned blocks reuse the loaded data.
+        By default `False`.
+    return_quality : bool, optional
+        Whether to also return quality metrics of registration for each frame.
+        By default `False`.
 
     Returns
     -------
@@ -201,6 +533,13 @@ def est_motion_part(
         Registration template for the movie.
     shifts : darr.Array
         Estimated motion.
+    quality : darr.Array, optional
+        Quality metrics of registration for each frame. Only returned if
+        `return_quality=True`.
+    blocks : List[da.delayed.Delayed], optional
+        Delayed blocks of movie data at the leaf level. Only returned if
+        `return_blocks=True`.
+
     See Also
     --------
     estimate_motion
@@ -211,42 +550,86 @@ def est_motion_part(
     arr_opt = fct.partial(custom_arr_optimize, keep_patterns=["^est_motion_chunk"])
     if kwargs.get("mesh_size", None):
         param = get_bspline_param(varr[0].compute(), kwargs["mesh_size"])
+    if kwargs.get("patch_size", None):
+        ngrid = tuple(
+            len(st)
+            for st in get_patch_grid(
+                varr.shape[1:], kwargs["patch_size"], kwargs.get("patch_step", None)
+            )
+        )
+    if return_blocks:
+        with da.config.set(array_optimize=arr_opt):
+            blk_ls = list(varr.to_delayed().ravel())
+    else:
+        blk_ls = list(varr.blocks)
     tmp_ls = []
     sh_ls = []
-    for blk in varr.blocks:
+    qual_ls = []
+    for blk, nfm in zip(blk_ls, varr.chunks[0]):
+        blk_shape = (nfm,) + varr.shape[1:]
         res = da.delayed(est_motion_chunk)(
-            blk, None, alt_error=alt_error, npart=npart, **kwargs
+            blk,
+            None,
+            alt_error=alt_error,
+            npart=npart,
+            return_quality=return_quality,
+            **kwargs
         )
         if alt_error:
             tmp = darr.from_delayed(
-                res[0], shape=(3, blk.shape[1], blk.shape[2]), dtype=blk.dtype
+                res[0], shape=(3, blk_shape[1], blk_shape[2]), dtype=varr.dtype
             )
         else:
             tmp = darr.from_delayed(
-                res[0], shape=(blk.shape[1], blk.shape[2]), dtype=blk.dtype
+                res[0], shape=(blk_shape[1], blk_shape[2]), dtype=varr.dtype
             )
         if kwargs.get("mesh_size", None):
             sh = darr.from_delayed(
                 res[1],
-                shape=(blk.shape[0], 2, int(param[1]), int(param[0])),
+                shape=(blk_shape[0], 2, int(param[1]), int(param[0])),
                 dtype=float,
             )
+        elif kwargs.get("patch_size", None):
+            sh = darr.from_delayed(res[1], shape=(blk_shape[0], 2) + ngrid, dtype=float)
         else:
-            sh = darr.from_delayed(res[1], shape=(blk.shape[0], 2), dtype=float)
+            sh = darr.from_delayed(res[1], shape=(blk_shape[0], 2), dtype=float)
         tmp_ls.append(tmp)
         sh_ls.append(sh)
+        if return_quality:
+            qual_ls.append(darr.from_delayed(res[2], shape=(nfm, 3), dtype=float))
     with da.config.set(array_optimize=arr_opt):
-        temps = da.optimize(darr.stack(tmp_ls, axis=0))[0]
-        shifts = da.optimize(darr.concatenate(sh_ls, axis=0))[0]
+        if return_quality:
+            temps, shifts, quality = da.optimize(
+                darr.stack(tmp_ls, axis=0),
+                darr.concatenate(sh_ls, axis=0),
+                darr.concatenate(qual_ls, axis=0),
+            )
+        else:
+            temps, shifts = da.optimize(
+                darr.stack(tmp_ls, axis=0), darr.concatenate(sh_ls, axis=0)
+            )
     while temps.shape[0] > 1:
         tmp_ls = []
         sh_ls = []
+        qual_ls = []
         for idx in np.arange(0, temps.numblocks[0], npart):
             tmps = temps.blocks[idx : idx + npart]
             sh_org = shifts.blocks[idx : idx + npart]
             sh_org_ls = [sh_org.blocks[i] for i in range(sh_org.numblocks[0])]
+            qual_kw = dict()
+            if return_quality:
+                qual_org = quality.blocks[idx : idx + npart]
+                qual_kw["qual_org"] = [
+                    qual_org.blocks[i] for i in range(qual_org.numblocks[0])
+                ]
             res = da.delayed(est_motion_chunk)(
-                tmps, sh_org_ls, alt_error=alt_error, npart=npart, **kwargs
+                tmps,
+                sh_org_ls,
+                alt_error=alt_error,
+                npart=npart,
+                return_quality=return_quality,
+                **qual_kw,
+                **kwargs
             )
             if alt_error:
                 tmp = darr.from_delayed(
@@ -259,9 +642,20 @@ def est_motion_part(
             sh_new = darr.from_delayed(res[1], shape=sh_org.shape, dtype=sh_org.dtype)
             tmp_ls.append(tmp)
             sh_ls.append(sh_new)
+            if return_quality:
+                qual_ls.append(
+                    darr.from_delayed(res[2], shape=qual_org.shape, dtype=float)
+                )
         temps = darr.stack(tmp_ls, axis=0)
         shifts = darr.concatenate(sh_ls, axis=0)
-    return temps, shifts
+        if return_quality:
+            quality = darr.concatenate(qual_ls, axis=0)
+    res = (temps, shifts)
+    if return_quality:
+        res = res + (quality,)
+    if return_blocks:
+        res = res + (blk_ls,)
+    return res
 
 
 def est_motion_chunk(
@@ -276,7 +670,13 @@ def est_motion_chunk(
     mesh_size: Optional[Tuple[int, int]] = None,
     niter=100,
     bin_thres: Optional[float] = None,
-) -> Tuple[np.ndarray, np.ndarray]:
+    patch_size: Optional[Tuple[int, int]] = None,
+    patch_step: Optional[Tuple[int, int]] = None,
+    pyramid_level: Optional[int] = None,
+    search_wnd: Optional[int] = None,
+    return_quality=False,
+    qual_org: Optional[List[np.ndarray]] = None,
+) -> Union[Tuple[np.ndarray, np.ndarray], Tuple[np.ndarray, np.ndarray, np.ndarray]]:
     """
     Carry out motion estimation per chunk.
 
@@ -309,6 +709,24 @@ def est_motion_chunk(
         Max number of iteration for the gradient descent process. By default `100`.
     bin_thres : float, optional
         Intensity threshold for binarizing the frames. By default `None`.
+    patch_size : Tuple[int, int], optional
+        Size of patches for piecewise-rigid motion estimation. By default
+        `None`.
+    patch_step : Tuple[int, int], optional
+        Distance between the starting pixels of consecutive patches. By default
+        `None`.
+    pyramid_level : int, optional
+        Number of levels of the Gaussian pyramid for coarse rigid estimation. By
+        default `None`.
+    search_wnd : int, optional
+        Maximum absolute rigid motion between frames in pixels. By default
+        `None`.
+    return_quality : bool, optional
+        Whether to also return quality metrics of registration for each frame.
+        By default `False`.
+    qual_org : List[np.ndarray], optional
+        Original quality metrics to be updated upon. Only used if
+        `return_quality=True`. By default `None`.
 
     Returns
     -------
@@ -316,6 +734,10 @@ def est_motion_chunk(
         The template of current chunk for further motion estimation.
     motions : np.ndarray
         Motions between frames within the chunk.
+    quality : np.ndarray, optional
+        Quality metrics for each frame with shape (frame, 3). Only returned if
+        `return_quality=True`. See :func:`estimate_motion` for the definition
+        of each metric.
 
     Raises
     ------
@@ -333,12 +755,24 @@ def est_motion_chunk(
             if mesh_size is not None:
                 # TODO handle non-rigid case
                 pass
+            elif patch_size is not None:
+                ngrid = tuple(
+                    len(st)
+                    for st in get_patch_grid(varr.shape[-2:], patch_size, patch_step)
+                )
+                motions = np.zeros((1, 2) + ngrid)
             else:
                 motions = np.array([0, 0])[np.newaxis, :]
         if alt_error:
             tmp = np.stack([varr[0]] * 3)
         else:
             tmp = varr[0]
+        if return_quality:
+            if qual_org is not None:
+                qual = qual_org[0]
+            else:
+                qual = np.array([[np.nan, 1, 0 if alt_error else np.nan]])
+            return tmp, motions, qual
         return tmp, motions
     while varr.shape[0] > npart:
         part_idx = np.array_split(
@@ -346,8 +780,9 @@ def est_motion_chunk(
         )
         tmp_ls = []
         sh_ls = []
+        qual_ls = []
         for idx in part_idx:
-            cur_tmp, cur_motions = est_motion_chunk(
+            res = est_motion_chunk(
                 varr[idx],
                 [sh_org[i] for i in idx] if sh_org is not None else None,
                 npart=npart,
@@ -359,21 +794,41 @@ def est_motion_chunk(
                 mesh_size=mesh_size,
                 niter=niter,
                 bin_thres=bin_thres,
+                patch_size=patch_size,
+                patch_step=patch_step,
+                pyramid_level=pyramid_level,
+                search_wnd=search_wnd,
+                return_quality=return_quality,
+                qual_org=[qual_org[i] for i in idx] if qual_org is not None else None,
             )
-            tmp_ls.append(cur_tmp)
-            sh_ls.append(cur_motions)
+            tmp_ls.append(res[0])
+            sh_ls.append(res[1])
+            if return_quality:
+                qual_ls.append(res[2])
         varr = np.stack(tmp_ls, axis=0)
         sh_org = sh_ls
+        if return_quality:
+            qual_org = qual_ls
     # varr could have 4 dimensions in which case the second dimension has length
     # 3 representing the first, aggregated and the last frame of a chunk
-    mask = np.ones_like(varr, dtype=bool)
-    if bin_thres is not None and varr.ndim <= 3:
-        for i, fm in enumerate(varr):
-            mask[i] = fm > bin_thres
+    # frames are processed in batches of this size to bound the peak memory
+    nbatch = 16
+    if mesh_size is not None:
+        mask = np.ones_like(varr, dtype=bool)
+        if bin_thres is not None and varr.ndim <= 3:
+            for i, fm in enumerate(varr):
+                mask[i] = fm > bin_thres
     good_fm = np.ones(varr.shape[0], dtype=bool)
     if circ_thres is not None and varr.ndim <= 3:
-        for i, fm in enumerate(varr):
-            good_fm[i] = check_temp(fm, max_sh) > circ_thres
+        good_fm = (
+            np.concatenate(
+                [
+                    check_temp_batch(varr[i : i + nbatch], max_sh)
+                    for i in range(0, varr.shape[0], nbatch)
+                ]
+            )
+            > circ_thres
+        )
     good_idxs = np.where(good_fm)[0].astype(int)
     prop_good = len(good_idxs) / len(good_fm)
     if prop_good < 0.9:
@@ -387,89 +842,154 @@ def est_motion_chunk(
         fm0 = varr[0, 0] if varr.ndim > 3 else varr[0]
         param = get_bspline_param(fm0, mesh_size)
         motions = np.zeros((varr.shape[0], 2, int(param[1]), int(param[0])))
+    elif patch_size is not None:
+        starts = get_patch_grid(varr.shape[-2:], patch_size, patch_step)
+        grid = tuple(st + (psz - 1) / 2 for st, psz in zip(starts, patch_size))
+        motions = np.zeros((varr.shape[0], 2) + tuple(len(st) for st in starts))
     else:
         motions = np.zeros((varr.shape[0], 2))
-    for i, fm in enumerate(varr):
-        if i < mid:
-            if varr.ndim > 3:
-                src, dst = varr[i][1], varr[i + 1][1]
-                src_ma, dst_ma = mask[i][1], mask[i + 1][1]
-                if alt_error:
-                    src_alt, dst_alt = varr[i][2], varr[i + 1][0]
-                    src_alt_ma, dst_alt_ma = mask[i][2], mask[i + 1][0]
-            else:
-                # select the next good frame as template
-                didx = good_idxs[good_idxs - (i + 1) >= 0][0]
-                src, dst = varr[i], varr[didx]
-                src_ma, dst_ma = mask[i], mask[didx]
-            slc = slice(0, i + 1)
-        elif i > mid:
-            if varr.ndim > 3:
-                src, dst = varr[i][1], varr[i - 1][1]
-                src_ma, dst_ma = mask[i][1], mask[i - 1][1]
-                if alt_error:
-                    src_alt, dst_alt = varr[i][0], varr[i - 1][2]
-                    src_alt_ma, dst_alt_ma = mask[i][0], mask[i - 1][2]
-            else:
-                # select the previous good frame as template
-                didx = good_idxs[good_idxs - (i - 1) <= 0][-1]
-                src, dst = varr[i], varr[didx]
-                src_ma, dst_ma = mask[i], mask[didx]
-            slc = slice(i, None)
+    if patch_size is None:
+        grid = None
+    # collect pairs of frames to be registered, indexed into flattened frames
+    fms = varr.reshape((-1,) + varr.shape[-2:])
+    if mesh_size is not None:
+        fms_ma = mask.reshape((-1,) + mask.shape[-2:])
+    idxs = np.array([i for i in range(varr.shape[0]) if i != mid], dtype=int)
+    if varr.ndim > 3:
+        nsub = varr.shape[1]
+        nb_idxs = np.where(idxs < mid, idxs + 1, idxs - 1)
+        src_idx, dst_idx = idxs * nsub + 1, nb_idxs * nsub + 1
+        if alt_error:
+            src_alt = idxs * nsub + np.where(idxs < mid, 2, 0)
+            dst_alt = nb_idxs * nsub + np.where(idxs < mid, 0, 2)
+            # interleave the alternative pairs so that frames are shared in batch
+            src_idx = np.stack([src_idx, src_alt], axis=1).reshape(-1)
+            dst_idx = np.stack([dst_idx, dst_alt], axis=1).reshape(-1)
+    else:
+        # select the next/previous good frame as template
+        nb_idxs = [
+            good_idxs[good_idxs - (i + 1) >= 0][0]
+            if i < mid
+            else good_idxs[good_idxs - (i - 1) <= 0][-1]
+            for i in idxs
+        ]
+        src_idx, dst_idx = idxs, np.array(nb_idxs, dtype=int)
+    if return_quality:
+        if sh_org is None:
+            qual = np.full((varr.shape[0], 3), np.nan)
+            if alt_error:
+                qual[:, 2] = 0
         else:
-            continue
-        mo = est_motion_perframe(src, dst, upsample, src_ma, dst_ma, mesh_size, niter)
-        if alt_error and varr.ndim > 3:
-            mo_alt = est_motion_perframe(
-                src_alt, dst_alt, upsample, src_alt_ma, dst_alt_ma, mesh_size, niter
+            qual_org = [q.copy() for q in qual_org]
+    if mesh_size is None:
+        mos = est_motion_batch(
+            fms,
+            src_idx,
+            dst_idx,
+            upsample,
+            pyramid_level=pyramid_level,
+            search_wnd=search_wnd,
+            return_peak=return_quality,
+        )
+        if return_quality:
+            mos, peaks = mos
+            if sh_org is None and len(idxs) > 0:
+                qual[idxs, 0] = peaks
+                # cross-correlation is symmetric, hence the reference frame
+                # takes the best peak among frames registered to it
+                if (dst_idx == mid).any():
+                    qual[mid, 0] = peaks[dst_idx == mid].max()
+        if patch_size is not None:
+            mos = est_motion_patch(
+                fms, src_idx, dst_idx, mos, upsample, patch_size, patch_step
+            )
+    else:
+        mos = [
+            est_motion_perframe(
+                fms[si], fms[di], upsample, fms_ma[si], fms_ma[di], mesh_size, niter
             )
+            for si, di in zip(src_idx, dst_idx)
+        ]
+    if alt_error and varr.ndim > 3:
+        mos = list(zip(mos[0::2], mos[1::2]))
+    for i, nb, mo in zip(idxs, nb_idxs, mos):
+        if alt_error and varr.ndim > 3:
+            mo, mo_alt = mo
+            if return_quality:
+                # the disagreement involves both chunks of the pair
+                for j in (i, nb):
+                    qual_org[j][:, 2] = np.fmax(
+                        qual_org[j][:, 2], np.abs(mo - mo_alt).max()
+                    )
             if ((np.abs(mo - mo_alt) > alt_error).any()) and (
                 np.abs(mo).sum() > np.abs(mo_alt).sum()
             ):
                 mo = mo_alt
+        slc = slice(0, i + 1) if i < mid else slice(i, None)
         # only add to the rest if current frame is good
         if good_fm[i]:
             motions[slc] = motions[slc] + mo
         else:
             motions[i] = motions[i] + mo
     # center shifts
-    if mesh_size is not None:
+    if motions.ndim > 2:
         motions -= motions.mean(axis=(0, 2, 3), keepdims=True)
     else:
         motions -= motions.mean(axis=0)
-    for i, v in enumerate(varr):
-        if i not in good_idxs:
-            continue
-        if v.ndim > 2:
-            for j, fm in enumerate(v):
-                varr[i][j] = transform_perframe(fm, motions[i], fill=0)
-        else:
-            varr[i] = transform_perframe(v, motions[i], fill=0)
-    varr = varr[good_idxs]
-    if aggregation == "max":
-        if varr.ndim > 3:
-            tmp = varr.max(axis=(0, 1))
-        else:
-            tmp = varr.max(axis=0)
-    elif aggregation == "mean":
-        if varr.ndim > 3:
-            tmp = varr.mean(axis=(0, 1))
-        else:
-            tmp = varr.mean(axis=0)
-    else:
+    # aggregate the transformed good frames with a running reduction so that
+    # only a batch of transformed frames is held in memory at any time
+    if aggregation not in ("mean", "max"):
         raise ValueError("does not understand aggregation: {}".format(aggregation))
-    if alt_error:
-        if varr.ndim > 3:
-            tmp0 = varr[0][0]
-            tmp1 = varr[-1][-1]
+    tmp = None
+    for ib in range(0, len(good_idxs), nbatch):
+        idx = good_idxs[ib : ib + nbatch]
+        fms_sh = transform_batch(varr[idx], motions[idx], grid, mesh_size is not None)
+        if alt_error:
+            if ib == 0:
+                tmp0 = fms_sh[0][0] if varr.ndim > 3 else fms_sh[0]
+            # the end template of leaf chunks is the second good frame, which
+            # the reference results of the pipeline are generated with
+            if varr.ndim > 3 and ib + nbatch >= len(good_idxs):
+                tmp1 = fms_sh[-1][-1]
+            elif varr.ndim == 3 and ib <= 1 < ib + nbatch:
+                tmp1 = fms_sh[1 - ib]
+        fms_sh = fms_sh.reshape((-1,) + fms_sh.shape[-2:])
+        if aggregation == "max":
+            agg = fms_sh.max(axis=0)
+            tmp = agg if tmp is None else np.maximum(tmp, agg)
         else:
-            tmp0 = varr[0]
-            tmp1 = varr[1]
+            agg = fms_sh.sum(axis=0, dtype=float)
+            tmp = agg if tmp is None else tmp + agg
+    if aggregation == "mean":
+        nfm = len(good_idxs) * int(np.prod(varr.shape[1:-2]))
+        tmp = tmp / nfm
+        if np.issubdtype(varr.dtype, np.floating):
+            tmp = tmp.astype(varr.dtype, copy=False)
+    if return_quality and sh_org is None:
+        # frames are transformed again to correlate with the leaf template,
+        # since the template is only known once all frames are aggregated
+        tmp_flt = tmp.reshape(-1) - tmp.mean()
+        for ib in range(0, varr.shape[0], nbatch):
+            idx = np.arange(ib, min(ib + nbatch, varr.shape[0]))
+            fms_sh = transform_batch(
+                varr[idx], motions[idx], grid, mesh_size is not None
+            )
+            fms_sh = fms_sh.reshape((len(idx), -1)).astype(float)
+            fms_sh -= fms_sh.mean(axis=1, keepdims=True)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                qual[idx, 1] = (fms_sh @ tmp_flt) / (
+                    np.linalg.norm(fms_sh, axis=1) * np.linalg.norm(tmp_flt)
+                )
+    if alt_error:
         tmp = np.stack([tmp0, tmp, tmp1], axis=0)
     if sh_org is not None:
         motions = np.concatenate(
             [motions[i] + sh for i, sh in enumerate(sh_org)], axis=0
         )
+    if return_quality:
+        if sh_org is not None:
+            qual = np.concatenate(qual_org, axis=0)
+        return tmp, motions, qual
     return tmp, motions
 
 
@@ -515,12 +1035,7 @@ def est_motion_perframe(
     --------
     estimate_motion : for detailed explanation of parameters
     """
-    sh = phase_cross_correlation(
-        src,
-        dst,
-        upsample_factor=upsample,
-        return_error=False,
-    )
+    sh = -est_motion_batch(np.stack([src, dst]), [0], [1], upsample)[0]
     if mesh_size is None:
         return -sh
     src = sitk.GetImageFromArray(src.astype(np.float32))
@@ -550,6 +1065,710 @@ def est_motion_perframe(
     return coef
 
 
+def estimate_motion_online(
+    varr: xr.DataArray,
+    dim="frame",
+    upsample=100,
+    decay=0.05,
+    ninit=100,
+    npart=3,
+    chunk_nfm: Optional[int] = None,
+    apply=False,
+    fill=0,
+) -> Union[xr.DataArray, Tuple[xr.DataArray, xr.DataArray]]:
+    """
+    Estimate rigid motion for each frame sequentially against a running template.
+
+    This is an online alternative to :func:`estimate_motion`. An initial
+    template is generated from the first `ninit` frames with the recursive
+    algorithm in :func:`est_motion_chunk`. Then each frame is registered to the
+    current template with the same phase correlation engine as the batch
+    algorithm (:func:`phase_corr_batch`), and the template is updated as an
+    exponentially weighted average of the registered frames. The template is
+    kept in the frequency domain and the registered frames are shifted with
+    a phase ramp, so only one FFT is needed per frame. The frames are processed
+    in a chain of tasks with `chunk_nfm` frames each, and the estimated motion
+    of each chunk is available as soon as the chunk and all chunks before it
+    are processed. Optionally the motion-corrected frames can be produced in
+    the same pass.
+
+    Parameters
+    ----------
+    varr : xr.DataArray
+        Input movie data.
+    dim : str, optional
+        The dimension along which motion estimation should be carried out. By
+        default `"frame"`.
+    upsample : int, optional
+        The upsample factor. See :func:`phase_corr_batch`. By default `100`.
+    decay : float, optional
+        Weight of each newly registered frame when updating the template. Larger
+        values allow the template to follow slow changes of the field of view
+        more quickly but make it noisier. By default `0.05`.
+    ninit : int, optional
+        Number of frames used to generate the initial template. By default
+        `100`.
+    npart : int, optional
+        Number of frames to combine for the recursive algorithm when generating
+        the initial template. By default `3`.
+    chunk_nfm : int, optional
+        Number of frames in each task. If `None` then the dask chunksize along
+        `dim` will be used. By default `None`.
+    apply : bool, optional
+        Whether to also return the motion-corrected movie. By default `False`.
+    fill : int, optional
+        Values used to fill in missing pixels (outside field of view) of the
+        motion-corrected movie. Only used if `apply=True`. By default `0`.
+
+    Returns
+    -------
+    motion : xr.DataArray
+        Estimated motion for each frame, with the same dimensions as the rigid
+        result of :func:`estimate_motion`. Note that the motion is relative to
+        the running template and is not centered.
+    varr_sh : xr.DataArray, optional
+        Motion-corrected movie. Only returned if `apply=True`. It shares the
+        same tasks with `motion`, hence both should be computed or saved
+        together to avoid repeating the estimation.
+
+    See Also
+    --------
+    estimate_motion
+    """
+    varr = varr.transpose(..., dim, "height", "width")
+    loop_dims = list(set(varr.dims) - set(["height", "width", dim]))
+    if loop_dims:
+        loop_labs = [varr.coords[d].values for d in loop_dims]
+        sh_dict, va_dict = dict(), dict()
+        for lab in itt.product(*loop_labs):
+            va = varr.sel({loop_dims[i]: lab[i] for i in range(len(loop_dims))})
+            res = estimate_motion_online(
+                va, dim, upsample, decay, ninit, npart, chunk_nfm, apply, fill
+            )
+            if apply:
+                res, va_sh = res
+                va_dict[lab] = va_sh.assign_coords(
+                    **{k: v for k, v in zip(loop_dims, lab)}
+                )
+            sh_dict[lab] = res.assign_coords(**{k: v for k, v in zip(loop_dims, lab)})
+        sh = xrconcat_recursive(sh_dict, loop_dims)
+        if apply:
+            varr_sh = xrconcat_recursive(va_dict, loop_dims)
+            if isinstance(varr_sh, xr.Dataset):
+                varr_sh = varr_sh[varr.name]
+            return sh, varr_sh
+        return sh
+    arr = varr.data
+    if chunk_nfm is None:
+        chunk_nfm = arr.chunksize[0]
+    arr = arr.rechunk((chunk_nfm, None, None))
+    arr_opt = fct.partial(
+        custom_arr_optimize, keep_patterns=["^est_motion_online_chunk"]
+    )
+    temp = da.delayed(est_motion_chunk)(
+        arr[:ninit], None, npart=npart, alt_error=None, upsample=upsample
+    )[0]
+    temp_freq = da.delayed(rfft_frames)(temp)
+    sh_ls, fm_ls = [], []
+    for blk in arr.blocks:
+        res = da.delayed(est_motion_online_chunk)(
+            blk, temp_freq, upsample=upsample, decay=decay, apply=apply, fill=fill
+        )
+        temp_freq = res[0]
+        sh_ls.append(darr.from_delayed(res[1], shape=(blk.shape[0], 2), dtype=float))
+        if apply:
+            fm_ls.append(darr.from_delayed(res[2], shape=blk.shape, dtype=blk.dtype))
+    with da.config.set(array_optimize=arr_opt):
+        sh = da.optimize(darr.concatenate(sh_ls, axis=0))[0]
+    sh = xr.DataArray(
+        sh,
+        dims=[dim, "shift_dim"],
+        coords={dim: varr.coords[dim].values, "shift_dim": ["height", "width"]},
+    )
+    if apply:
+        varr_sh = varr.copy(data=darr.concatenate(fm_ls, axis=0))
+        return sh, varr_sh
+    return sh
+
+
+def est_motion_online_chunk(
+    fms: np.ndarray,
+    temp_freq: np.ndarray,
+    upsample: int,
+    decay: float,
+    apply=False,
+    fill=0,
+    nbatch=16,
+) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    """
+    Register a chunk of frames sequentially against a running template.
+
+    Parameters
+    ----------
+    fms : np.ndarray
+        Input chunk of movie.
+    temp_freq : np.ndarray
+        Half spectrum of the current template, with shape (height, width // 2 +
+        1).
+    upsample : int
+        Upsample factor.
+    decay : float
+        Weight of each newly registered frame when updating the template.
+    apply : bool, optional
+        Whether to return the motion-corrected frames. By default `False`.
+    fill : int, optional
+        Values used to fill in missing pixels (outside field of view). By
+        default `0`.
+    nbatch : int, optional
+        Number of frames whose spectrums are computed at once. By default `16`.
+
+    Returns
+    -------
+    temp_freq : np.ndarray
+        Half spectrum of the updated template.
+    motions : np.ndarray
+        Motions of each frame relative to the running template.
+    fms_sh : np.ndarray, optional
+        Motion-corrected frames. `None` if `apply=False`.
+
+    See Also
+    --------
+    estimate_motion_online
+    """
+    shape = fms.shape[-2:]
+    ramp = np.stack(
+        np.meshgrid(
+            np.fft.fftfreq(shape[0]),
+            np.fft.rfftfreq(shape[1]),
+            indexing="ij",
+        )
+    )
+    motions = np.zeros((fms.shape[0], 2))
+    for ib in range(0, fms.shape[0], nbatch):
+        freq = rfft_frames(fms[ib : ib + nbatch])
+        for i, fq in enumerate(freq):
+            mo = -phase_corr_batch(fq[np.newaxis], temp_freq, shape, upsample)[0]
+            fq_sh = fq * np.exp(-2j * np.pi * (ramp * mo[:, None, None]).sum(axis=0))
+            temp_freq = (1 - decay) * temp_freq + decay * fq_sh
+            motions[ib + i] = mo
+    if apply:
+        fms_sh = np.stack(
+            [transform_perframe(fm, mo, fill=fill) for fm, mo in zip(fms, motions)]
+        )
+    else:
+        fms_sh = None
+    return temp_freq, motions, fms_sh
+
+
+def est_motion_batch(
+    fms: np.ndarray,
+    src_idx: np.ndarray,
+    dst_idx: np.ndarray,
+    upsample: int,
+    nbatch=16,
+    pyramid_level: Optional[int] = None,
+    search_wnd: Optional[int] = None,
+    return_peak=False,
+) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Estimate rigid motion for multiple pairs of frames.
+
+    The pairs are processed in batches of `nbatch`. Within each batch, the
+    spectrum of every unique frame is computed only once with
+    :func:`rfft_frames` and reused across all pairs referencing the frame.
+
+    If `pyramid_level` is specified, the motion is first estimated to pixel
+    precision on frames downsampled `pyramid_level` times with
+    :func:`cv2.pyrDown`. The cross-correlation at full resolution is then only
+    evaluated within `2 ** pyramid_level` pixels around the upscaled coarse
+    estimation, and the sub-pixel refinement is carried out in two stages. See
+    :func:`phase_corr_batch`.
+
+    Parameters
+    ----------
+    fms : np.ndarray
+        Stack of frames with shape (frame, height, width).
+    src_idx : np.ndarray
+        Index of the frame to be registered for each pair.
+    dst_idx : np.ndarray
+        Index of the destination frame of registration for each pair.
+    upsample : int
+        Upsample factor.
+    nbatch : int, optional
+        Number of pairs processed at once. Bounds the number of spectra held in
+        memory. By default `16`.
+    pyramid_level : int, optional
+        Number of levels of the Gaussian pyramid used for coarse estimation. By
+        default `None`.
+    search_wnd : int, optional
+        Maximum absolute motion in pixels along each dimension. By default
+        `None`.
+    return_peak : bool, optional
+        Whether to also return the normalized cross-correlation peak for each
+        pair. By default `False`.
+
+    Returns
+    -------
+    motions : np.ndarray
+        Estimated motion for each pair, with shape (pair, 2). Same as
+        :func:`est_motion_perframe` called on each pair if `pyramid_level` and
+        `search_wnd` are `None`.
+    peaks : np.ndarray, optional
+        Normalized cross-correlation peak for each pair. Only returned if
+        `return_peak=True`.
+
+    See Also
+    --------
+    phase_corr_batch
+    """
+    src_idx = np.asarray(src_idx, dtype=int)
+    dst_idx = np.asarray(dst_idx, dtype=int)
+    motions = np.zeros((len(src_idx), 2))
+    peaks = np.zeros(len(src_idx))
+    for ib in range(0, len(src_idx), nbatch):
+        src, dst = src_idx[ib : ib + nbatch], dst_idx[ib : ib + nbatch]
+        fidx, inv = np.unique(np.concatenate([src, dst]), return_inverse=True)
+        freq = rfft_frames(fms[fidx])
+        isrc, idst = inv[: len(src)], inv[len(src) :]
+        if pyramid_level:
+            scl = 2 ** pyramid_level
+            fms_ds = []
+            for fm in fms[fidx]:
+                fm = fm.astype(np.float32)
+                for _ in range(pyramid_level):
+                    fm = cv2.pyrDown(fm)
+                fms_ds.append(fm)
+            fms_ds = np.stack(fms_ds)
+            freq_ds = rfft_frames(fms_ds)
+            sh = phase_corr_batch(
+                freq_ds[isrc],
+                freq_ds[idst],
+                fms_ds.shape[-2:],
+                1,
+                search_wnd=int(np.ceil(search_wnd / scl)) if search_wnd else None,
+            )
+            sh = phase_corr_batch(
+                freq[isrc],
+                freq[idst],
+                fms.shape[-2:],
+                upsample,
+                search_wnd=scl,
+                init=(sh * scl).astype(int),
+                multiscale=True,
+                return_peak=return_peak,
+            )
+        else:
+            sh = phase_corr_batch(
+                freq[isrc],
+                freq[idst],
+                fms.shape[-2:],
+                upsample,
+                search_wnd=search_wnd,
+                return_peak=return_peak,
+            )
+        if return_peak:
+            sh, peaks[ib : ib + nbatch] = sh
+        motions[ib : ib + nbatch] = -sh
+    if return_peak:
+        return motions, peaks
+    return motions
+
+
+def est_motion_patch(
+    fms: np.ndarray,
+    src_idx: np.ndarray,
+    dst_idx: np.ndarray,
+    motions: np.ndarray,
+    upsample: int,
+    patch_size: Tuple[int, int],
+    patch_step: Optional[Tuple[int, int]] = None,
+) -> np.ndarray:
+    """
+    Estimate piecewise-rigid motion for multiple pairs of frames.
+
+    For each pair, the patches of the destination frame are matched with
+    patches of the source frame displaced by the rigid `motions` rounded to
+    whole pixels, so that only the residual motion of each patch has to be
+    estimated. Each patch is demeaned and tapered with a Tukey window, since
+    otherwise the borders of patches, which do not move with the content,
+    bias the residual motion towards zero. The residual motions of all patches
+    of all pairs are then estimated at once with :func:`est_motion_batch`.
+
+    Parameters
+    ----------
+    fms : np.ndarray
+        Stack of frames with shape (frame, height, width).
+    src_idx : np.ndarray
+        Index of the frame to be registered for each pair.
+    dst_idx : np.ndarray
+        Index of the destination frame of registration for each pair.
+    motions : np.ndarray
+        Rigid motion for each pair with shape (pair, 2).
+    upsample : int
+        Upsample factor.
+    patch_size : Tuple[int, int]
+        Size of patches.
+    patch_step : Tuple[int, int], optional
+        Distance between the starting pixels of consecutive patches. By default
+        `None`.
+
+    Returns
+    -------
+    motions : np.ndarray
+        Estimated motion for each patch of each pair, with shape (pair, 2,
+        grid0, grid1).
+
+    See Also
+    --------
+    estimate_motion : for detailed explanation of parameters
+    """
+    h, w = fms.shape[-2:]
+    ph, pw = patch_size
+    st_h, st_w = get_patch_grid((h, w), patch_size, patch_step)
+    offset = np.around(np.asarray(motions)).astype(int)
+    src_ls, dst_ls, base = [], [], []
+    for si, di, (oh, ow) in zip(src_idx, dst_idx, offset):
+        for sh in st_h:
+            ah = min(max(sh - oh, 0), h - ph)
+            for sw in st_w:
+                aw = min(max(sw - ow, 0), w - pw)
+                src_ls.append(fms[si, ah : ah + ph, aw : aw + pw])
+                dst_ls.append(fms[di, sh : sh + ph, sw : sw + pw])
+                base.append((sh - ah, sw - aw))
+    npatch = len(src_ls)
+    if not npatch:
+        return np.zeros((0, 2, len(st_h), len(st_w)))
+    win = np.outer(tukey(ph, 0.5), tukey(pw, 0.5))
+    pchs = np.stack(src_ls + dst_ls).astype(float)
+    pchs = (pchs - pchs.mean(axis=(1, 2), keepdims=True)) * win
+    mos = est_motion_batch(
+        pchs,
+        np.arange(npatch),
+        np.arange(npatch, 2 * npatch),
+        upsample,
+    )
+    mos = mos + np.array(base)
+    return mos.reshape((-1, len(st_h), len(st_w), 2)).transpose((0, 3, 1, 2))
+
+
+def phase_corr_batch(
+    src_freq: np.ndarray,
+    dst_freq: np.ndarray,
+    shape: Tuple[int, int],
+    upsample: int,
+    search_wnd: Optional[int] = None,
+    init: Optional[np.ndarray] = None,
+    multiscale=False,
+    return_peak=False,
+) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Phase correlation with sub-pixel refinement for a batch of frame pairs.
+
+    This is a batched implementation of the algorithm in
+    :func:`skimage.registration.phase_cross_correlation` operating on
+    precomputed half spectrums. The cross-correlation is computed with inverse
+    FFT to locate the peak to pixel precision, which is then refined by
+    computing the upsampled cross-correlation in a `1.5` pixels neighborhood
+    around the peak with matrix-multiply DFT. If `init` is provided, the
+    cross-correlation is only computed within `search_wnd` pixels around `init`
+    with matrix-multiply DFT instead of inverse FFT of the full frames.
+
+    Parameters
+    ----------
+    src_freq : np.ndarray
+        Half spectrum of the frames to be registered, with shape (pair, height,
+        width // 2 + 1).
+    dst_freq : np.ndarray
+        Half spectrum of the destination frames, with the same shape as
+        `src_freq`.
+    shape : Tuple[int, int]
+        Shape of the frames in the spatial domain.
+    upsample : int
+        Upsample factor.
+    search_wnd : int, optional
+        Maximum absolute shift in pixels along each dimension. If `None` then
+        all shifts are considered. By default `None`.
+    init : np.ndarray, optional
+        Integer shifts with shape (pair, 2) around which the peak is searched.
+        Requires `search_wnd`. By default `None`.
+    multiscale : bool, optional
+        Whether to refine the sub-pixel peak in two stages, first with upsample
+        factor `sqrt(upsample)` in the `1.5` pixels neighborhood, then with
+        `upsample` in the `1.5` neighborhood of the first stage. This
+        drastically reduce the size of the upsampled regions. By default
+        `False`.
+    return_peak : bool, optional
+        Whether to also return the value of the cross-correlation peak for each
+        pair, normalized as Pearson correlation of the circularly shifted
+        frames. By default `False`.
+
+    Returns
+    -------
+    shifts : np.ndarray
+        Shifts required to register the destination frames with the frames in
+        `src_freq`, with shape (pair, 2).
+    peak : np.ndarray, optional
+        Normalized cross-correlation at the estimated shifts for each pair, with
+        shape (pair,). Only returned if `return_peak=True`.
+
+    See Also
+    --------
+    est_motion_batch
+    """
+    shape = np.array(shape)
+    npair = src_freq.shape[0]
+    prod = src_freq * dst_freq.conj()
+    if init is not None or upsample > 1:
+        prod_conj = prod.conj()
+    mid = np.fix(shape / 2)
+    if init is not None:
+        reg_sz = 2 * search_wnd + 1
+        cor = upsampled_dft_batch(prod_conj, tuple(shape), reg_sz, 1, search_wnd - init)
+        imax = np.abs(cor.reshape((npair, -1))).argmax(axis=1)
+        maxima = np.stack(np.unravel_index(imax, cor.shape[1:]), axis=1)
+        shifts = init + maxima - search_wnd
+        cor = cor / np.prod(shape)
+    else:
+        cor = irfft_frames(prod, tuple(shape))
+        if search_wnd is not None:
+            sh_h, sh_w = [
+                np.abs(np.where(np.arange(sz) > m, np.arange(sz) - sz, np.arange(sz)))
+                for sz, m in zip(shape, mid)
+            ]
+            out_wnd = (sh_h[:, np.newaxis] > search_wnd) | (sh_w > search_wnd)
+            cor[:, out_wnd] = 0
+        imax = np.abs(cor.reshape((npair, -1))).argmax(axis=1)
+        shifts = np.stack(np.unravel_index(imax, tuple(shape)), axis=1)
+        shifts = np.where(shifts > mid, shifts - shape, shifts)
+    shifts = shifts.astype(float)
+    if upsample > 1:
+        if multiscale:
+            ups_ls = [int(np.ceil(np.sqrt(upsample))), upsample]
+        else:
+            ups_ls = [upsample]
+        wnd = 1.5
+        for ups in ups_ls:
+            shifts = np.round(shifts * ups) / ups
+            reg_sz = int(np.ceil(ups * wnd))
+            dftshift = np.fix(reg_sz / 2)
+            cor = upsampled_dft_batch(
+                prod_conj, tuple(shape), reg_sz, ups, dftshift - shifts * ups
+            )
+            imax = np.abs(cor.reshape((npair, -1))).argmax(axis=1)
+            maxima = np.stack(np.unravel_index(imax, cor.shape[1:]), axis=1) - dftshift
+            shifts = shifts + maxima / ups
+            wnd = 1.5 / ups
+        cor = cor / np.prod(shape)
+    shifts[:, shape == 1] = 0
+    if return_peak:
+        # excluding the zero frequency gives the correlation of mean-subtracted
+        # frames, where the interior columns of half spectrums represent two
+        # conjugate frequencies
+        npx = np.prod(shape)
+        wt = np.full(src_freq.shape[-1], 2)
+        wt[0] = 1
+        if shape[1] % 2 == 0:
+            wt[-1] = 1
+        eng_src, eng_dst = [
+            ((np.abs(f) ** 2 * wt).sum(axis=(1, 2)) - np.abs(f[:, 0, 0]) ** 2) / npx
+            for f in (src_freq, dst_freq)
+        ]
+        cor = cor.reshape((npair, -1))
+        peak = cor[np.arange(npair), np.abs(cor).argmax(axis=1)].real
+        peak = peak - prod[:, 0, 0].real / npx
+        with np.errstate(divide="ignore", invalid="ignore"):
+            peak = peak / np.sqrt(eng_src * eng_dst)
+        return shifts, peak
+    return shifts
+
+
+def upsampled_dft_batch(
+    data: np.ndarray,
+    shape: Tuple[int, int],
+    reg_sz: int,
+    upsample: int,
+    offsets: np.ndarray,
+) -> np.ndarray:
+    """
+    Batched upsampled DFT of hermitian spectrums in a local region.
+
+    Equivalent to the matrix-multiply upsampled DFT in scikit-image
+    applied to the full spectrums, but only operates on the half spectrums.
+    Since the spectrums are hermitian, the contribution of each pair of
+    conjugate frequencies is twice the real part of either one, except for the
+    zero and Nyquist frequencies, which are handled separately. This halves
+    the cost of the matrix multiplications.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Half spectrums with shape (pair, height, width // 2 + 1).
+    shape : Tuple[int, int]
+        Shape of the full spectrums.
+    reg_sz : int
+        Size of the upsampled region.
+    upsample : int
+        Upsample factor.
+    offsets : np.ndarray
+        Offsets of the upsampled region for each pair, with shape (pair, 2).
+
+    Returns
+    -------
+    cor : np.ndarray
+        Upsampled DFT with shape (pair, reg_sz, reg_sz).
+    """
+    h, w = shape
+    npair = data.shape[0]
+    ups = np.arange(reg_sz)
+    fh = np.fft.fftfreq(h, upsample)
+    fw = np.fft.fftfreq(w, upsample)[: data.shape[-1]]
+    # the kernels are separable into a shared part and a per-pair phase ramp,
+    # so that each contraction is a single matrix multiplication for all pairs
+    kh = np.exp(-2j * np.pi * ups[:, np.newaxis] * fh)
+    kw = np.exp(-2j * np.pi * ups[:, np.newaxis] * fw)
+    ph_h = np.exp(2j * np.pi * offsets[:, [0]] * fh)
+    ph_w = np.exp(2j * np.pi * offsets[:, [1]] * fw)
+
+    def contract(dat, k_h, cols):
+        dat = (ph_h[:, :, np.newaxis] * dat).transpose((1, 0, 2)).reshape((h, -1))
+        dat = (k_h @ dat).reshape((reg_sz, npair, len(cols))).transpose((1, 0, 2))
+        dat = dat * ph_w[:, np.newaxis, cols]
+        return dat @ kw[:, cols].T
+
+    # columns that are their own conjugate
+    icol = [0, w // 2] if w % 2 == 0 else [0]
+    cor = contract(data[:, :, icol], kh, icol)
+    iint = np.arange(1, (w - 1) // 2 + 1)
+    if len(iint) > 0:
+        kh_int = kh
+        if h % 2 == 0:
+            kh_int = kh.copy()
+            kh_int[:, h // 2] = 0
+            nyq = (data[:, h // 2, iint] * ph_w[:, iint]) @ kw[:, iint].T
+            nyq_h = kh[np.newaxis, :, h // 2] * ph_h[:, [h // 2]]
+            cor += nyq_h[:, :, np.newaxis] * 2 * nyq.real[:, np.newaxis, :]
+        cor += 2 * contract(data[:, :, iint], kh_int, iint).real
+    return cor
+
+
+FFTW_PLANS = threading.local()
+"""
+Thread-local cache of `pyfftw` plans used by :func:`rfft_frames` and
+:func:`irfft_frames`.
+"""
+
+
+def get_fftw_plan(
+    kind: str, shape: tuple, s: Optional[tuple] = None, ncache=16, precision="double"
+):
+    """
+    Get a cached `pyfftw` plan for 2d real FFT over the last two axes.
+
+    Plans are cached per thread since they hold internal buffers, and the least
+    recently used plan is dropped once there are more than `ncache` plans.
+
+    Parameters
+    ----------
+    kind : str
+        Either `"rfft2"` or `"irfft2"`.
+    shape : tuple
+        Shape of the input array.
+    s : tuple, optional
+        Shape of the output frames. Only used if `kind == "irfft2"`. By default
+        `None`.
+    ncache : int, optional
+        Maximum number of cached plans. By default `16`.
+    precision : str, optional
+        Either `"double"` or `"single"`. By default `"double"`.
+
+    Returns
+    -------
+    plan : pyfftw.FFTW
+        The FFTW plan.
+    """
+    plans = getattr(FFTW_PLANS, "plans", None)
+    if plans is None:
+        plans = FFTW_PLANS.plans = OrderedDict()
+    key = (kind, shape, s, precision)
+    try:
+        plans.move_to_end(key)
+        return plans[key]
+    except KeyError:
+        pass
+    rdtype, cdtype = {
+        "double": ("float64", "complex128"),
+        "single": ("float32", "complex64"),
+    }[precision]
+    if kind == "rfft2":
+        plan = pyfftw.builders.rfft2(
+            pyfftw.empty_aligned(shape, dtype=rdtype),
+            axes=(-2, -1),
+            planner_effort="FFTW_ESTIMATE",
+        )
+    elif kind == "irfft2":
+        plan = pyfftw.builders.irfft2(
+            pyfftw.empty_aligned(shape, dtype=cdtype),
+            s=s,
+            axes=(-2, -1),
+            planner_effort="FFTW_ESTIMATE",
+        )
+    else:
+        raise ValueError("Don't understand {}".format(kind))
+    plans[key] = plan
+    while len(plans) > ncache:
+        plans.popitem(last=False)
+    return plan
+
+
+def rfft_frames(fms: np.ndarray, precision="double") -> np.ndarray:
+    """
+    Compute the half spectrums of a stack of frames.
+
+    Parameters
+    ----------
+    fms : np.ndarray
+        Stack of frames with shape (frame, height, width).
+    precision : str, optional
+        Either `"double"` or `"single"`. By default `"double"`.
+
+    Returns
+    -------
+    freq : np.ndarray
+        The half spectrums with shape (frame, height, width // 2 + 1).
+    """
+    fms = np.asarray(fms, dtype={"double": np.float64, "single": np.float32}[precision])
+    return get_fftw_plan("rfft2", fms.shape, precision=precision)(fms).copy()
+
+
+def irfft_frames(
+    freq: np.ndarray, shape: Tuple[int, int], precision="double"
+) -> np.ndarray:
+    """
+    Compute frames from a stack of half spectrums.
+
+    Parameters
+    ----------
+    freq : np.ndarray
+        Stack of half spectrums with shape (frame, height, width // 2 + 1).
+    shape : Tuple[int, int]
+        Shape of the frames.
+    precision : str, optional
+        Either `"double"` or `"single"`. By default `"double"`.
+
+    Returns
+    -------
+    fms : np.ndarray
+        The frames with shape (frame, height, width).
+    """
+    # c2r transforms destroy their input, hence always work on a copy
+    freq = np.array(
+        freq, dtype={"double": np.complex128, "single": np.complex64}[precision]
+    )
+    return get_fftw_plan("irfft2", freq.shape, tuple(shape), precision=precision)(
+        freq
+    ).copy()
+
+
 def match_temp(src, dst, max_sh, local, subpixel=False):
     dst = np.pad(dst, max_sh)
     cor = cv2.matchTemplate(
@@ -602,22 +1821,74 @@ def check_temp(fm: np.ndarray, max_sh: int) -> float:
     See Also
     --------
     estimate_motion
+    check_temp_batch
     """
-    fm_pad = np.pad(fm, max_sh)
-    cor = cv2.matchTemplate(
-        fm.astype(np.float32), fm_pad.astype(np.float32), cv2.TM_SQDIFF_NORMED
-    )
-    conts = cv2.findContours(
-        (cor < 1).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-    )[0]
-    if len(conts) != 1:
-        return 0
-    cont = conts[0]
-    perimeter = cv2.arcLength(cont, True)
-    if perimeter <= 0:
-        return 0
-    area = cv2.contourArea(cont)
-    circularity = 4 * np.pi * (area / (perimeter ** 2))
+    return check_temp_batch(fm[np.newaxis], max_sh)[0]
+
+
+def check_temp_batch(fms: np.ndarray, max_sh: int) -> np.ndarray:
+    """
+    Compute the circularity metric for a stack of frames.
+
+    The comparison image is the normalized squared difference between each
+    frame and its zero-padded version, as computed by
+    :func:`cv2.matchTemplate` with `cv2.TM_SQDIFF_NORMED`. Here the squared
+    difference at each shift is expanded into the energy of the frame, the
+    energy of the overlapping window, and the autocorrelation of the frame.
+    The autocorrelation of all frames is computed with one FFT per frame, and
+    the energy of the windows are computed from integral images.
+
+    Parameters
+    ----------
+    fms : np.ndarray
+        Input frames with shape (frame, height, width).
+    max_sh : int
+        Amount of zero padding when computing the comparison image.
+
+    Returns
+    -------
+    circularity : np.ndarray
+        The circularity metric for each frame, will be `0` if the comparison
+        image has more than one region with values `< 1`.
+
+    See Also
+    --------
+    estimate_motion
+    """
+    fms = np.asarray(fms, dtype=np.float32)
+    nfm, h, w = fms.shape
+    # pad enough to avoid circular wrapping, up to sizes efficient for FFT
+    hp = cv2.getOptimalDFTSize(h + min(max_sh, h))
+    wp = cv2.getOptimalDFTSize(w + min(max_sh, w))
+    fms_pad = np.zeros((nfm, hp, wp), dtype=np.float32)
+    fms_pad[:, :h, :w] = fms
+    freq = rfft_frames(fms_pad, precision="single")
+    freq = freq.real ** 2 + freq.imag ** 2
+    acorr = irfft_frames(freq, (hp, wp), precision="single")
+    lag = np.arange(-max_sh, max_sh + 1)
+    acorr = acorr[:, lag % hp][:, :, lag % wp].astype(float)
+    # energy of the window overlapping with the frame at each lag
+    intg = np.stack([cv2.integral2(fm, sdepth=cv2.CV_64F)[1] for fm in fms])
+    r0, r1 = np.clip(lag, 0, h)[:, np.newaxis], np.clip(h + lag, 0, h)[:, np.newaxis]
+    c0, c1 = np.clip(lag, 0, w), np.clip(w + lag, 0, w)
+    eng_wnd = intg[:, r1, c1] - intg[:, r0, c1] - intg[:, r1, c0] + intg[:, r0, c0]
+    eng = intg[:, -1, -1][:, np.newaxis, np.newaxis]
+    sqdiff = eng + eng_wnd - 2 * acorr
+    # lags without overlap are never `< 1`, which also masks wrapped lags
+    mask = (sqdiff < np.sqrt(eng * np.clip(eng_wnd, 0, None))) & (eng_wnd > 0)
+    circularity = np.zeros(nfm)
+    for i, ma in enumerate(mask):
+        conts = cv2.findContours(
+            ma.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+        )[0]
+        if len(conts) != 1:
+            continue
+        cont = conts[0]
+        perimeter = cv2.arcLength(cont, True)
+        if perimeter <= 0:
+            continue
+        area = cv2.contourArea(cont)
+        circularity[i] = 4 * np.pi * (area / (perimeter ** 2))
     return circularity
 
 
@@ -674,7 +1945,10 @@ def apply_transform(
     Apply necessary transform to correct for motion.
 
     This function can correct for both rigid and non-rigid motion depending on
-    the number of dimensions of input `trans`.
+    the number of dimensions of input `trans`. Rigid shifts are applied to
+    whole chunks of frames at once with :func:`shift_frames`, and
+    piecewise-rigid motion with :func:`warp_frames`, while BSpline transforms
+    are applied frame by frame with :func:`transform_perframe`.
 
     Parameters
     ----------
@@ -683,8 +1957,11 @@ def apply_transform(
     trans : xr.DataArray
         Estimated motion, if `trans.ndim > 2` then it is interpreted as shifts
         of control points of mesh grid, and BSpline transform will be
-        constructed. Otherwise it is interpreted as shifts in each direction of
-        rigid translation.
+        constructed. If in addition `trans` has coordinates `"grid0"` and
+        `"grid1"`, then it is interpreted as shifts of patches centered at
+        those coordinates, as returned by piecewise-rigid motion estimation.
+        Otherwise it is interpreted as shifts in each direction of rigid
+        translation.
     fill : int, optional
         Values used to fill in missing pixels (outside field of view). By default
         `0`.
@@ -699,15 +1976,37 @@ def apply_transform(
         Movie data after transform.
     """
     sh_dim = trans.coords["shift_dim"].values.tolist()
-    if "grid0" in trans.dims:
+    if "grid0" in trans.coords:
+        return xr.apply_ufunc(
+            warp_frames,
+            varr.chunk({d: -1 for d in sh_dim}),
+            trans,
+            input_core_dims=[sh_dim, ["shift_dim", "grid0", "grid1"]],
+            output_core_dims=[sh_dim],
+            dask="parallelized",
+            kwargs={
+                "fill": fill,
+                "grid": (trans.coords["grid0"].values, trans.coords["grid1"].values),
+            },
+            output_dtypes=[varr.dtype],
+        )
+    elif "grid0" in trans.dims:
         fm0 = varr.isel(frame=0).values
         if mesh_size is None:
             mesh_size = get_mesh_size(fm0)
         param = get_bspline_param(fm0, mesh_size)
         mdim = ["shift_dim", "grid0", "grid1"]
     else:
-        param = None
-        mdim = ["shift_dim"]
+        return xr.apply_ufunc(
+            shift_frames,
+            varr.chunk({d: -1 for d in sh_dim}),
+            trans,
+            input_core_dims=[sh_dim, ["shift_dim"]],
+            output_core_dims=[sh_dim],
+            dask="parallelized",
+            kwargs={"fill": fill},
+            output_dtypes=[varr.dtype],
+        )
     varr_sh = xr.apply_ufunc(
         transform_perframe,
         varr.chunk({d: -1 for d in sh_dim}),
@@ -722,12 +2021,190 @@ def apply_transform(
     return varr_sh
 
 
+def shifted_view(
+    varr: xr.DataArray, motion: xr.DataArray, fill=0, depth: Optional[int] = None
+) -> xr.DataArray:
+    """
+    Lazily correct motion of a movie, supporting chunks in all dimensions.
+
+    Unlike :func:`apply_transform`, the input movie does not need to be
+    rechunked to contain full frames in each chunk. Instead each chunk is read
+    along with a halo of `depth` pixels from neighboring chunks in the
+    "height" and "width" dimensions, and the motion is applied on the fly
+    before the halo is trimmed. Hence the result can be used as a drop-in
+    replacement of a saved motion-corrected movie, without materializing it on
+    disk. This is beneficial for steps that only read the movie once, while
+    steps that read the movie many times may still benefit from saving the
+    result with :func:`minian.utilities.save_minian`. For rigid motion, the
+    interpolation of each block is carried out in the coordinates of the full
+    frames, so that the result is identical to :func:`apply_transform`
+    regardless of chunks. For piecewise-rigid motion, the shift field is
+    computed in single precision on each block, hence the result is only the
+    same up to floating point rounding, which can amount to a difference of
+    `1` for integer dtypes. If `depth` is larger than the size of some chunks
+    along "height" or "width", then those chunks are merged with their
+    neighbors.
+
+    Parameters
+    ----------
+    varr : xr.DataArray
+        Input movie data. Should have dimensions "height" and "width", and the
+        other dimensions should match those of `motion`.
+    motion : xr.DataArray
+        Estimated rigid or piecewise-rigid motion. Will be loaded into memory.
+    fill : int, optional
+        Values used to fill in missing pixels (outside field of view). By
+        default `0`.
+    depth : int, optional
+        Size of the halo in pixels. Should be larger than the absolute motion.
+        If `None` then it will be determined from the maximum absolute motion.
+        By default `None`.
+
+    Returns
+    -------
+    varr_sh : xr.DataArray
+        Movie data after motion correction, with the same chunks as `varr`
+        unless some of them are merged.
+
+    Raises
+    ------
+    NotImplementedError
+        if `motion` represents BSpline transform
+    """
+    if "grid0" in motion.dims and "grid0" not in motion.coords:
+        raise NotImplementedError("BSpline transform not supported")
+    sp_dims = ["height", "width"]
+    lead_dims = [d for d in varr.dims if d not in sp_dims]
+    varr = varr.transpose(*lead_dims, *sp_dims)
+    motion = motion.transpose(*lead_dims, "shift_dim", ...).compute()
+    if depth is None:
+        depth = int(np.ceil(np.abs(motion).max().item())) + 1
+    if "grid0" in motion.coords:
+        grid = (motion.coords["grid0"].values, motion.coords["grid1"].values)
+    else:
+        grid = None
+    arr = varr.data
+    # flatten motion into the last dimension so that it broadcasts with the
+    # spatial blocks of the movie
+    mo = darr.from_array(
+        motion.values.reshape(varr.shape[:-2] + (1, -1)),
+        chunks=arr.chunks[:-2] + (1, -1),
+    )
+    ax_sp = {arr.ndim - 2: depth, arr.ndim - 1: depth}
+    if max(arr.numblocks[-2:]) > 1:
+        # merge chunks smaller than the halo beforehand, so that the location of
+        # each block is known
+        arr = arr.rechunk({ax: merge_chunks(arr.chunks[ax], depth) for ax in ax_sp})
+        starts = [np.cumsum((0,) + c[:-1]) for c in arr.chunks[-2:]]
+        arr = darr.overlap.overlap(arr, depth=ax_sp, boundary="none")
+    else:
+        starts = [np.zeros(1, dtype=int), np.zeros(1, dtype=int)]
+    arr_sh = darr.map_blocks(
+        shift_block,
+        arr,
+        mo,
+        fill=fill,
+        depth=depth,
+        starts=starts,
+        width=varr.sizes["width"],
+        grid=grid,
+        dtype=varr.dtype,
+    )
+    if max(arr.numblocks[-2:]) > 1:
+        arr_sh = darr.overlap.trim_internal(arr_sh, ax_sp, boundary="none")
+    return xr.DataArray(arr_sh, dims=varr.dims, coords=varr.coords, name=varr.name)
+
+
+def merge_chunks(chunks: Tuple[int, ...], size: int) -> Tuple[int, ...]:
+    """
+    Merge consecutive chunks until each of them is at least of a given size.
+
+    Parameters
+    ----------
+    chunks : Tuple[int, ...]
+        Chunk sizes along one dimension.
+    size : int
+        Minimum size of each chunk.
+
+    Returns
+    -------
+    chunks : Tuple[int, ...]
+        The merged chunk sizes. A single chunk is returned as-is even if it is
+        smaller than `size`.
+    """
+    merged = []
+    for c in chunks:
+        if merged and merged[-1] < size:
+            merged[-1] += c
+        else:
+            merged.append(c)
+    if len(merged) > 1 and merged[-1] < size:
+        last = merged.pop()
+        merged[-1] += last
+    return tuple(merged)
+
+
+def shift_block(
+    fms: np.ndarray,
+    mo: np.ndarray,
+    fill=0,
+    depth=0,
+    starts: Optional[List[np.ndarray]] = None,
+    width: Optional[int] = None,
+    grid: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+    block_info: Optional[dict] = None,
+) -> np.ndarray:
+    """
+    Apply motion to a block of movie with halo.
+
+    Parameters
+    ----------
+    fms : np.ndarray
+        Block of movie with shape (..., height, width), including the halo.
+    mo : np.ndarray
+        Motion for each frame in the block, flattened in the last dimension.
+    fill : int, optional
+        Values used to fill in missing pixels. By default `0`.
+    depth : int, optional
+        Size of the halo in pixels. By default `0`.
+    starts : List[np.ndarray], optional
+        Starting pixels of all blocks along "height" and "width" without halo.
+        By default `None`.
+    width : int, optional
+        Width of the full frames. Only used if `grid is None`. By default
+        `None`.
+    grid : Tuple[np.ndarray, np.ndarray], optional
+        Centers of patches for piecewise-rigid motion. If `None` then `mo` is
+        interpreted as rigid shifts. By default `None`.
+    block_info : dict, optional
+        Block information passed by :func:`dask.array.map_blocks`. By default
+        `None`.
+
+    Returns
+    -------
+    fms_sh : np.ndarray
+        The shifted block, including the halo.
+
+    See Also
+    --------
+    shifted_view
+    """
+    mo = mo.reshape(mo.shape[:-2] + (2,) + (tuple(map(len, grid)) if grid else ()))
+    loc = block_info[0]["chunk-location"][-2:]
+    # location of the block with halo in the full frame
+    org = [st[i] - depth if i > 0 else 0 for st, i in zip(starts, loc)]
+    if grid is None:
+        return shift_frames(fms, mo, fill=fill, org=org, width=width)
+    return warp_frames(fms, mo, (grid[0] - org[0], grid[1] - org[1]), fill=fill)
+
+
 def transform_perframe(
     fm: np.ndarray,
     tx_coef: np.ndarray,
     fill=0,
     param: Optional[np.ndarray] = None,
     mesh_size: Optional[Tuple[int, int]] = None,
+    grid: Optional[Tuple[np.ndarray, np.ndarray]] = None,
 ) -> np.ndarray:
     """
     Transform a single frame.
@@ -750,12 +2227,18 @@ def transform_perframe(
         `mesh_size` parameter used to estimate motion. If `None` and
         `tx_coef.ndim > 1`, then one will be computed using
         :func:`get_mesh_size`. By default `None`.
+    grid : Tuple[np.ndarray, np.ndarray], optional
+        Centers of patches. If not `None`, then `tx_coef` is interpreted as
+        piecewise-rigid shifts of patches and applied with :func:`warp_frames`.
+        By default `None`.
 
     Returns
     -------
     fm : np.ndarray
         The frame after transform.
     """
+    if grid is not None:
+        return warp_frames(fm[np.newaxis], tx_coef[np.newaxis], grid, fill=fill)[0]
     if tx_coef.ndim > 1:
         if param is None:
             if mesh_size is None:
@@ -764,12 +2247,262 @@ def transform_perframe(
         tx = sitk.BSplineTransform([sitk.GetImageFromArray(a) for a in tx_coef])
         tx.SetFixedParameters(param)
     else:
-        tx = sitk.TranslationTransform(2, -tx_coef[::-1])
+        return shift_frames(fm[np.newaxis], tx_coef[np.newaxis], fill=fill)[0]
     fm = sitk.GetImageFromArray(fm)
     fm = sitk.Resample(fm, fm, tx, sitk.sitkLinear, fill)
     return sitk.GetArrayFromImage(fm)
 
 
+def shift_frames(
+    fms: np.ndarray,
+    shifts: np.ndarray,
+    fill=0,
+    org: Tuple[int, int] = (0, 0),
+    width: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Apply rigid shifts to a stack of frames.
+
+    The result is equivalent to resampling each frame with a
+    :class:`SimpleITK.TranslationTransform` and linear interpolation as in
+    previous versions, without the per-frame conversion overhead. Each frame is
+    shifted with separable linear interpolation, first along "width" then
+    along "height", where neighbours are clamped at the border. Output pixels
+    that map to more than half a pixel outside the frame are filled with
+    `fill`. The interpolation follows the arithmetic of SimpleITK, including
+    truncation towards zero for integer dtypes, so that the results are
+    identical. If `fms` is a block of larger frames, `org` and `width` can be
+    used to carry out the arithmetic in the coordinates of the full frames, so
+    that the result is identical to the corresponding block of the shifted
+    full frames, except for pixels within `shifts` of the inner edges of the
+    block.
+
+    Parameters
+    ----------
+    fms : np.ndarray
+        Input frames with shape (..., height, width).
+    shifts : np.ndarray
+        Shifts with shape (..., 2), broadcastable with the leading dimensions
+        of `fms`. Positive shifts move the content of the frames towards larger
+        indices.
+    fill : int, optional
+        Values used to fill in missing pixels (outside field of view). By
+        default `0`.
+    org : Tuple[int, int], optional
+        Location of the first pixel of `fms` in the full frames. By default
+        `(0, 0)`.
+    width : int, optional
+        Width of the full frames. If `None` then the width of `fms` is used. By
+        default `None`.
+
+    Returns
+    -------
+    fms_sh : np.ndarray
+        The shifted frames, with the same shape and dtype as `fms`.
+    """
+    fms, shifts = np.asarray(fms), np.asarray(shifts, dtype=float)
+    lead = np.broadcast_shapes(fms.shape[:-2], shifts.shape[:-1])
+    h, w = fms.shape[-2:]
+    fms = np.broadcast_to(fms, lead + (h, w)).reshape((-1, h, w))
+    shifts = np.broadcast_to(shifts, lead + (2,)).reshape((-1, 2))
+    out = np.full_like(fms, fill)
+    if np.issubdtype(fms.dtype, np.integer):
+        info = np.iinfo(fms.dtype)
+        vrange = (info.min, info.max)
+    else:
+        vrange = (-np.inf, np.inf)
+    if width is None:
+        width = w
+    shift_frames_interp(fms, shifts, out, *vrange, org[0], org[1], width)
+    return out.reshape(lead + (h, w))
+
+
+@nb.jit(nopython=True, nogil=True, cache=True)
+def shift_frames_interp(
+    fms: np.ndarray,
+    shifts: np.ndarray,
+    out: np.ndarray,
+    vmin: float,
+    vmax: float,
+    oh: int,
+    ow: int,
+    wf: int,
+):
+    """
+    Shift frames with linear interpolation in place.
+
+    Output pixels that map to more than half a pixel outside the frame are
+    left untouched. Integer shifts are also interpolated, since SimpleITK
+    does not treat them exactly either. The indices are computed in the
+    coordinates of the full frames before being offset to `fms`, which is exact
+    and hence does not change the rounding errors.
+
+    Parameters
+    ----------
+    fms : np.ndarray
+        Input frames with shape (frame, height, width).
+    shifts : np.ndarray
+        Shifts with shape (frame, 2).
+    out : np.ndarray
+        Output array with the same shape as `fms`.
+    vmin : float
+        Minimum value of the output dtype.
+    vmax : float
+        Maximum value of the output dtype.
+    oh : int
+        Location of the first row of `fms` in the full frames.
+    ow : int
+        Location of the first column of `fms` in the full frames.
+    wf : int
+        Width of the full frames.
+
+    See Also
+    --------
+    shift_frames
+    """
+    h, w = fms.shape[1], fms.shape[2]
+    w0, w1 = np.zeros(w, dtype=np.int64), np.zeros(w, dtype=np.int64)
+    dw = np.zeros(w)
+    for i in range(fms.shape[0]):
+        # interpolate the index along each row between its two ends as
+        # itk::ResampleImageFilter does, so that rounding errors are identical
+        qs, qe = -shifts[i, 1], wf - shifts[i, 1]
+        x0, x1 = w, 0
+        for x in range(w):
+            qw = qs + ((x + ow) / wf) * (qe - qs) - ow
+            if qw >= -0.5 and qw < w - 0.5:
+                x0, x1 = min(x0, x), max(x1, x + 1)
+            fw = np.floor(qw)
+            dw[x] = qw - fw
+            w0[x] = min(max(int(fw), 0), w - 1)
+            w1[x] = min(max(int(fw) + 1, 0), w - 1)
+        for y in range(h):
+            qh = (y + oh) - shifts[i, 0] - oh
+            if qh < -0.5 or qh >= h - 0.5:
+                continue
+            fh = np.floor(qh)
+            dh = qh - fh
+            h0 = min(max(int(fh), 0), h - 1)
+            h1 = min(max(int(fh) + 1, 0), h - 1)
+            for x in range(x0, x1):
+                v00, v01 = np.float64(fms[i, h0, w0[x]]), np.float64(fms[i, h0, w1[x]])
+                v10, v11 = np.float64(fms[i, h1, w0[x]]), np.float64(fms[i, h1, w1[x]])
+                v0 = v00 + (v01 - v00) * dw[x]
+                v1 = v10 + (v11 - v10) * dw[x]
+                out[i, y, x] = min(max(v0 + (v1 - v0) * dh, vmin), vmax)
+
+
+def warp_frames(
+    fms: np.ndarray,
+    motions: np.ndarray,
+    grid: Tuple[np.ndarray, np.ndarray],
+    fill=0,
+) -> np.ndarray:
+    """
+    Apply piecewise-rigid motion to a stack of frames.
+
+    The shifts of patches are bilinearly interpolated between the centers of
+    patches into a smooth shift field, which is constant beyond the outermost
+    centers. Each frame is then resampled with :func:`cv2.remap` using linear
+    interpolation.
+
+    Parameters
+    ----------
+    fms : np.ndarray
+        Input frames with shape (..., height, width).
+    motions : np.ndarray
+        Shifts of patches with shape (..., 2, grid0, grid1), broadcastable with
+        the leading dimensions of `fms`.
+    grid : Tuple[np.ndarray, np.ndarray]
+        Centers of patches along "height" and "width" in pixels.
+    fill : int, optional
+        Values used to fill in missing pixels (outside field of view). By
+        default `0`.
+
+    Returns
+    -------
+    fms_sh : np.ndarray
+        The transformed frames, with the same shape and dtype as `fms`.
+    """
+    fms, motions = np.asarray(fms), np.asarray(motions, dtype=float)
+    lead = np.broadcast_shapes(fms.shape[:-2], motions.shape[:-3])
+    h, w = fms.shape[-2:]
+    fms = np.broadcast_to(fms, lead + (h, w)).reshape((-1, h, w))
+    motions = np.broadcast_to(motions, lead + motions.shape[-3:]).reshape(
+        (-1,) + motions.shape[-3:]
+    )
+    wh = np.stack(
+        [np.interp(np.arange(h), grid[0], e) for e in np.eye(len(grid[0]))], axis=1
+    )
+    ww = np.stack(
+        [np.interp(np.arange(w), grid[1], e) for e in np.eye(len(grid[1]))], axis=1
+    )
+    wh, ww = wh.astype(np.float32), ww.astype(np.float32)
+    yy, xx = np.mgrid[:h, :w].astype(np.float32)
+    out = np.empty_like(fms)
+    for i, (fm, mo) in enumerate(zip(fms, motions.astype(np.float32))):
+        out[i] = cv2.remap(
+            np.ascontiguousarray(fm),
+            xx - wh @ mo[1] @ ww.T,
+            yy - wh @ mo[0] @ ww.T,
+            cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=fill,
+        )
+    return out.reshape(lead + (h, w))
+
+
+def transform_batch(
+    fms: np.ndarray,
+    motions: np.ndarray,
+    grid: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+    mesh=False,
+    fill=0,
+) -> np.ndarray:
+    """
+    Apply motions to a batch of frames and return a transformed copy.
+
+    The type of motion is inferred from the arguments: BSpline if `mesh=True`,
+    piecewise-rigid if `grid` is not `None` and rigid otherwise.
+
+    Parameters
+    ----------
+    fms : np.ndarray
+        Input frames with shape (frame, height, width), or (frame, nsub, height,
+        width) in which case all sub-frames share the same motion.
+    motions : np.ndarray
+        Motions of each frame with "frame" as the first dimension.
+    grid : Tuple[np.ndarray, np.ndarray], optional
+        Centers of patches for piecewise-rigid motion. By default `None`.
+    mesh : bool, optional
+        Whether `motions` are coefficients of BSpline transforms. By default
+        `False`.
+    fill : int, optional
+        Values used to fill in missing pixels (outside field of view). By
+        default `0`.
+
+    Returns
+    -------
+    fms_sh : np.ndarray
+        The transformed frames, with the same shape and dtype as `fms`.
+    """
+    if mesh:
+        fms_sh = np.empty_like(fms)
+        for i, (fm, mo) in enumerate(zip(fms, motions)):
+            if fm.ndim > 2:
+                for j, f in enumerate(fm):
+                    fms_sh[i, j] = transform_perframe(f, mo, fill=fill)
+            else:
+                fms_sh[i] = transform_perframe(fm, mo, fill=fill)
+        return fms_sh
+    if fms.ndim > 3:
+        motions = motions[:, np.newaxis]
+    if grid is not None:
+        return warp_frames(fms, motions, grid, fill=fill)
+    else:
+        return shift_frames(fms, motions, fill=fill)
+
+
 def get_bspline_param(img: np.ndarray, mesh_size: Tuple[int, int]) -> np.ndarray:
     """
     Compute fixed parameters for the BSpline transform given a frame and mesh size.
@@ -791,6 +2524,53 @@ def get_bspline_param(img: np.ndarray, mesh_size: Tuple[int, int]) -> np.ndarray
     ).GetFixedParameters()
 
 
+def get_patch_grid(
+    shape: Tuple[int, int],
+    patch_size: Tuple[int, int],
+    patch_step: Optional[Tuple[int, int]] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the starting pixels of patches for piecewise-rigid motion.
+
+    Patches are placed every `patch_step` pixels along each dimension, and an
+    additional patch is appended if necessary so that the last patch always
+    ends at the border of the frame.
+
+    Parameters
+    ----------
+    shape : Tuple[int, int]
+        Shape of the frame.
+    patch_size : Tuple[int, int]
+        Size of patches.
+    patch_step : Tuple[int, int], optional
+        Distance between the starting pixels of consecutive patches. If `None`
+        then half of `patch_size` will be used. By default `None`.
+
+    Returns
+    -------
+    starts : Tuple[np.ndarray, np.ndarray]
+        Starting pixels of patches along each dimension.
+
+    Raises
+    ------
+    ValueError
+        if `patch_size` is larger than `shape`
+    """
+    if patch_step is None:
+        patch_step = tuple(max(psz // 2, 1) for psz in patch_size)
+    starts = []
+    for sz, psz, pst in zip(shape, patch_size, patch_step):
+        if psz > sz:
+            raise ValueError(
+                "patch_size {} larger than frame shape {}".format(patch_size, shape)
+            )
+        st = np.arange(0, sz - psz + 1, pst)
+        if st[-1] != sz - psz:
+            st = np.append(st, sz - psz)
+        starts.append(st)
+    return tuple(starts)
+
+
 def get_mesh_size(fm: np.ndarray) -> np.ndarray:
     """
     Compute suitable mesh size given a frame.
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+from scipy.signal import lfilter
+from sklearn.linear_model import LassoLars
+
+from ..cnmf import lasso_gram_cd, update_temporal_active_set, update_temporal_cvxpy
+
+
+def lasso_lars_px(C, y, alpha):
+    X = C.T - C.T.mean(axis=0)
+    nrm = np.sqrt((X ** 2).sum(axis=0))
+    clf = LassoLars(alpha=alpha, positive=True, fit_intercept=True)
+    return clf.fit(X / nrm, y - y.mean()).coef_ / nrm
+
+
+def lasso_obj(C, y, alpha, coef):
+    X = C.T - C.T.mean(axis=0)
+    nrm = np.sqrt((X ** 2).sum(axis=0))
+    res = y - y.mean() - X @ coef
+    return 0.5 * (res ** 2).mean() + alpha * (coef * nrm).sum()
+
+
+def test_lasso_gram_cd_matches_lasso_lars():
+    rng = np.random.default_rng(42)
+    nunit, nfm, npx = 8, 500, 16
+    # strongly correlated temporal components make the problem ill-conditioned
+    C = np.maximum(rng.standard_normal((nunit, nfm)).cumsum(axis=1) * 0.2, 0) + 1
+    C = 0.1 * C + 0.9 * np.maximum(rng.standard_normal(nfm).cumsum() * 0.2, 0)
+    sub = rng.random((npx, nunit)) < 0.6
+    A = rng.random((npx, nunit)) * sub
+    Y = A @ C + rng.standard_normal((npx, nfm)) * 0.3
+    alpha = rng.uniform(0.001, 0.05, npx) * Y.std(axis=1)
+    indptr = np.concatenate([[0], np.cumsum(sub.sum(axis=1))])
+    indices = np.nonzero(sub)[1]
+    coef = lasso_gram_cd(
+        C @ C.T,
+        C.sum(axis=1),
+        Y @ C.T,
+        Y.sum(axis=1),
+        alpha,
+        indptr,
+        indices,
+        np.zeros(len(indices)),
+        nfm,
+    )
+    for p in range(npx):
+        idx = indices[indptr[p] : indptr[p + 1]]
+        cf = coef[indptr[p] : indptr[p + 1]]
+        ref = lasso_lars_px(C[idx], Y[p], alpha[p])
+        # least angle regression loses a few digits on ill-conditioned problems,
+        # in which case the exact solution has a slightly lower objective
+        assert np.abs(cf - ref).max() <= 1e-4 * np.abs(ref).max()
+        obj = lasso_obj(C[idx], Y[p], alpha[p], cf)
+        assert obj <= lasso_obj(C[idx], Y[p], alpha[p], ref) * (1 + 1e-12)
+
+
+@pytest.mark.parametrize("g", [[0.9], [1.6, -0.65]])
+@pytest.mark.parametrize("use_cons", [False, True])
+def test_active_set_matches_cvxpy(g, use_cons):
+    rng = np.random.default_rng(42)
+    nfm = 400
+    s = (rng.random(nfm) < 0.03) * rng.exponential(1, nfm)
+    y = lfilter([1], np.concatenate([[1], -np.array(g)]), s)
+    # baseline jumps between two segments
+    bseg = (np.arange(nfm) >= nfm // 2).astype(int)
+    y = y + 1 + bseg + rng.standard_normal(nfm) * 0.3
+    kwargs = dict(
+        sparse_penal=1,
+        max_iters=200,
+        use_cons=use_cons,
+        scs_fallback=False,
+        zero_thres=1e-8,
+    )
+    res_cvx = update_temporal_cvxpy(y, np.array(g), np.array(0.3), bseg=bseg, **kwargs)
+    res_as = update_temporal_active_set(
+        y, np.array(g), np.array(0.3), bseg=bseg, **kwargs
+    )
+    for r_cvx, r_as in zip(res_cvx, res_as):
+        assert r_as.shape == r_cvx.shape
+        assert np.abs(r_as - r_cvx).max() <= 1e-4 * max(np.abs(r_cvx).max(), 1)
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from ..initialization import get_seed_traces, pnr_batch, pnr_refine
+from ..utilities import med_baseline
+
+
+@pytest.fixture
+def varr():
+    rng = np.random.default_rng(42)
+    nfm, h, w = 30, 20, 24
+    return xr.DataArray(
+        rng.random((nfm, h, w)),
+        dims=["frame", "height", "width"],
+        coords={
+            "frame": np.arange(nfm),
+            "height": np.arange(h) * 2,
+            "width": np.arange(w) + 5,
+        },
+    ).chunk({"frame": 7, "height": 6, "width": 10})
+
+
+def test_get_seed_traces(varr, monkeypatch):
+    monkeypatch.delenv("MINIAN_INTERMEDIATE", raising=False)
+    seeds = pd.DataFrame(
+        {"height": [0, 38, 12, 12, 0], "width": [5, 28, 14, 14, 27]},
+        index=[3, 1, 4, 0, 2],
+    )
+    traces = get_seed_traces(varr, seeds).compute()
+    assert traces.dims == ("index", "frame")
+    assert (traces.coords["index"].values == seeds.index.values).all()
+    assert (traces.coords["height"].values == seeds["height"].values).all()
+    assert (traces.coords["width"].values == seeds["width"].values).all()
+    exp = varr.sel(
+        height=seeds["height"].to_xarray(), width=seeds["width"].to_xarray()
+    ).transpose("index", "frame")
+    assert (traces.values == exp.values).all()
+
+
+def test_get_seed_traces_missing_seed(varr, monkeypatch):
+    monkeypatch.delenv("MINIAN_INTERMEDIATE", raising=False)
+    seeds = pd.DataFrame({"height": [0, 13], "width": [5, 14]})
+    with pytest.raises(KeyError):
+        get_seed_traces(varr, seeds)
+    seeds = pd.DataFrame({"height": [0, 12], "width": [5, 4]})
+    with pytest.raises(KeyError):
+        get_seed_traces(varr, seeds)
+
+
+def test_pnr_refine_med_wnd(monkeypatch):
+    monkeypatch.delenv("MINIAN_INTERMEDIATE", raising=False)
+    rng = np.random.default_rng(42)
+    nfm = 1000
+    mov = rng.standard_normal((nfm, 1, 2))
+    # seed 0: pure noise with an abrupt shift of baseline
+    mov[nfm // 2 :, 0, 0] += 10
+    # seed 1: noise with calcium transients
+    spk = np.zeros(nfm)
+    spk[rng.choice(nfm, 8, replace=False)] = 20
+    kn = np.exp(-np.arange(100) / 15) - np.exp(-np.arange(100) / 3)
+    mov[:, 0, 1] += np.convolve(spk, kn)[:nfm]
+    varr = xr.DataArray(
+        mov,
+        dims=["frame", "height", "width"],
+        coords={"frame": np.arange(nfm), "height": [0], "width": [0, 1]},
+    ).chunk()
+    seeds = pd.DataFrame({"height": [0, 0], "width": [0, 1]})
+    # without baseline removal the shift of baseline passes as a cell
+    seeds_org, pnr_org, _ = pnr_refine(varr, seeds.copy(), thres=2.5)
+    assert seeds_org["mask_pnr"].tolist() == [True, True]
+    seeds_med, pnr_med, _ = pnr_refine(varr, seeds.copy(), thres=2.5, med_wnd=201)
+    assert seeds_med["mask_pnr"].tolist() == [False, True]
+    trace = np.stack([med_baseline(mov[:, 0, i], 201) for i in range(2)])
+    assert np.allclose(pnr_med.values, pnr_batch(trace, 0.25, (0.1, 99.9)))
@@ -0,0 +1,162 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+import xarray as xr
+from scipy.ndimage import shift as nd_shift
+from skimage.registration import phase_cross_correlation
+
+from ..motion_correction import (
+    apply_transform,
+    est_motion_batch,
+    estimate_motion,
+    estimate_motion_online,
+    shift_frames,
+    shifted_view,
+)
+
+
+def blob_frame(h, w, ncell, rng):
+    yy, xx = np.mgrid[:h, :w]
+    fm = np.zeros((h, w))
+    for cy, cx, amp in zip(
+        rng.uniform(0, h, ncell), rng.uniform(0, w, ncell), rng.uniform(50, 150, ncell)
+    ):
+        fm += amp * np.exp(-((yy - cy) ** 2 + (xx - cx) ** 2) / 8)
+    return fm
+
+
+def to_varr(mov, chunk_nfm=20):
+    nfm, h, w = mov.shape
+    return xr.DataArray(
+        mov,
+        dims=["frame", "height", "width"],
+        coords={"frame": np.arange(nfm), "height": np.arange(h), "width": np.arange(w)},
+    ).chunk({"frame": chunk_nfm})
+
+
+def sitk_shift(fm, sh, fill):
+    img = sitk.GetImageFromArray(fm)
+    tx = sitk.TranslationTransform(2, -sh[::-1])
+    return sitk.GetArrayFromImage(sitk.Resample(img, img, tx, sitk.sitkLinear, fill))
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.int16, np.float32])
+def test_shift_frames_matches_sitk(dtype):
+    rng = np.random.default_rng(42)
+    fms = (rng.random((40, 30, 41)) * 250).astype(dtype)
+    shifts = np.round(rng.uniform(-8, 8, (40, 2)), 1)
+    shifts[0] = [0, 0]
+    shifts[1] = [3, -2]
+    shifts[2] = [0.5, -0.5]
+    shifts[3] = [40.3, 2.1]
+    fms_sh = shift_frames(fms, shifts, fill=3)
+    fms_ref = np.stack([sitk_shift(f, s, 3) for f, s in zip(fms, shifts)])
+    assert fms_sh.dtype == fms_ref.dtype
+    assert (fms_sh == fms_ref).all()
+
+
+@pytest.mark.parametrize(
+    "chunks",
+    [
+        {"frame": 7, "height": 30, "width": 50},
+        {"frame": -1, "height": 40, "width": -1},
+        {"frame": 3, "height": 5, "width": 4},
+    ],
+)
+def test_shifted_view_matches_apply_transform(chunks):
+    rng = np.random.default_rng(42)
+    nfm, h, w = 20, 100, 120
+    varr = xr.DataArray(
+        (rng.random((nfm, h, w)) * 250).astype(np.uint8),
+        dims=["frame", "height", "width"],
+        coords={"frame": np.arange(nfm), "height": np.arange(h), "width": np.arange(w)},
+    )
+    motion = xr.DataArray(
+        np.round(rng.uniform(-6, 6, (nfm, 2)), 2),
+        dims=["frame", "shift_dim"],
+        coords={"frame": np.arange(nfm), "shift_dim": ["height", "width"]},
+    )
+    varr_ref = apply_transform(varr.chunk({"frame": 5}), motion).compute()
+    varr_sh = shifted_view(varr.chunk(chunks), motion).compute()
+    assert varr_sh.dtype == varr_ref.dtype
+    assert (varr_sh.values == varr_ref.values).all()
+
+
+@pytest.mark.parametrize("upsample", [1, 10, 100])
+def test_est_motion_batch_matches_perframe(upsample):
+    rng = np.random.default_rng(42)
+    temp = blob_frame(60, 80, 30, rng)
+    fms = np.stack(
+        [nd_shift(temp, sh, order=3) for sh in rng.uniform(-5, 5, (12, 2))]
+    ) + rng.normal(size=(12, 60, 80))
+    # pairs repeating frames across batches of different size
+    src_idx, dst_idx = rng.integers(0, 12, 30), rng.integers(0, 12, 30)
+    mos = est_motion_batch(fms, src_idx, dst_idx, upsample, nbatch=7)
+    mos_ref = np.stack(
+        [
+            -phase_cross_correlation(
+                fms[si], fms[di], upsample_factor=upsample, return_error=False
+            )
+            for si, di in zip(src_idx, dst_idx)
+        ]
+    )
+    assert np.allclose(mos, mos_ref)
+
+
+def test_estimate_motion_online():
+    rng = np.random.default_rng(42)
+    nfm, ninit = 120, 30
+    temp = blob_frame(64, 96, 40, rng)
+    shifts = rng.uniform(-4, 4, (nfm, 2))
+    shifts[:ninit] = 0
+    mov = np.stack([nd_shift(temp, sh, order=3) for sh in shifts])
+    mov += rng.normal(size=mov.shape)
+    motion = estimate_motion_online(to_varr(mov), ninit=ninit).compute()
+    assert motion.dims == ("frame", "shift_dim")
+    assert np.abs(motion.values + shifts).max() < 0.1
+
+
+def test_estimate_motion_patch():
+    rng = np.random.default_rng(0)
+    nfm, h, w = 60, 96, 192
+    temp = blob_frame(h, w, 400, rng)
+    # a rigid shift of the second half of frames, on top of which the left and
+    # right half of the field of view move in opposite directions
+    rigid, local = np.array([3, -2]), np.array([0.5, -0.5])
+    mov = np.stack([temp] * nfm)
+    mov[nfm // 2 :, :, : w // 2] = nd_shift(temp, rigid + local, order=3)[:, : w // 2]
+    mov[nfm // 2 :, :, w // 2 :] = nd_shift(temp, rigid - local, order=3)[:, w // 2 :]
+    mov += rng.normal(size=mov.shape)
+    motion = estimate_motion(to_varr(mov), patch_size=(48, 48)).compute()
+    assert motion.dims == ("frame", "shift_dim", "grid0", "grid1")
+    assert (motion.coords["grid0"].values == [23.5, 47.5, 71.5]).all()
+    motion = motion - motion.isel(frame=0)
+    grid1 = motion.coords["grid1"]
+    left = motion.sel(grid1=grid1[grid1 + 24 <= w // 2])
+    right = motion.sel(grid1=grid1[grid1 - 24 >= w // 2])
+    assert np.abs(left.isel(frame=slice(nfm // 2)).values).max() < 0.25
+    assert np.abs(right.isel(frame=slice(nfm // 2)).values).max() < 0.25
+    exp_l = -(rigid + local)[:, np.newaxis, np.newaxis]
+    exp_r = -(rigid - local)[:, np.newaxis, np.newaxis]
+    assert np.abs(left.isel(frame=slice(nfm // 2, None)).values - exp_l).max() < 0.4
+    assert np.abs(right.isel(frame=slice(nfm // 2, None)).values - exp_r).max() < 0.4
+
+
+def test_estimate_motion_reg_dim():
+    rng = np.random.default_rng(42)
+    nfm, h, w = 60, 64, 96
+    temp = blob_frame(h, w, 40, rng)
+    mov = np.stack([nd_shift(temp, sh, order=3) for sh in rng.uniform(-1, 1, (nfm, 2))])
+    mov += rng.normal(size=mov.shape)
+    mov = np.stack([mov, np.stack([nd_shift(fm, (3, -2), order=3) for fm in mov])])
+    varr = xr.concat(
+        [to_varr(m).assign_coords(session=s) for m, s in zip(mov, ["a", "b"])],
+        "session",
+    )
+    motion, offset = estimate_motion(varr, reg_dim="session")
+    offset = offset.compute()
+    assert offset.dims == ("session", "shift_dim")
+    assert np.allclose(offset.sum("session"), 0)
+    # session "b" has to be moved back by the offset to align with session "a"
+    diff = (offset.sel(session="b") - offset.sel(session="a")).values
+    assert np.abs(diff - [-3, 2]).max() < 0.1
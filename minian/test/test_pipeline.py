@@ -5,7 +5,7 @@ import sys
 import numpy as np
 import pytest
 
-from ..utilities import open_minian
+from ..utilities import as_dense, is_sparse, open_minian
 
 
 @pytest.mark.flaky(reruns=3)
@@ -33,6 +33,7 @@ def test_pipeline_notebook():
     assert int(minian_ds["max_proj"].sum().compute()) == 1501505
     assert int(minian_ds["C"].sum().compute()) == 478444
     assert int(minian_ds["S"].sum().compute()) == 3943
-    assert int(minian_ds["A"].sum().compute()) == 41755
+    assert is_sparse(minian_ds["A"])
+    assert int(as_dense(minian_ds["A"]).sum().compute()) == 41755
     assert os.path.exists("./demo_movies/minian_mc.mp4")
     assert os.path.exists("./demo_movies/minian.mp4")
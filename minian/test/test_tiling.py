@@ -0,0 +1,131 @@
+import os
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from ..tiling import cnmf_patch, cnmf_tiled, get_patches, merge_patches
+from ..utilities import as_dense
+from .toy_data import ar_trace, gauss_cell
+
+
+def patch_result(A, C, height, width):
+    uids = np.arange(len(A)) + 10
+    return {
+        "A": xr.DataArray(
+            A.astype(float),
+            dims=["unit_id", "height", "width"],
+            coords={"unit_id": uids, "height": height, "width": width},
+        ).chunk(),
+        "C": xr.DataArray(
+            C, dims=["unit_id", "frame"], coords={"unit_id": uids}
+        ).chunk(),
+    }
+
+
+def test_merge_patches_removes_shared_cell():
+    rng = np.random.default_rng(42)
+    h, w, nfm = 20, 40, 200
+    height, width = np.arange(h) * 2, np.arange(w) + 100
+    patches = [
+        {"height": slice(0, h), "width": slice(0, 24)},
+        {"height": slice(0, h), "width": slice(16, w)},
+    ]
+    C_shared = rng.random(nfm)
+    # patch 0: a cell of its own and the shared cell centered at width 20
+    A0 = np.zeros((2, h, 24))
+    A0[0, 9:12, 4:7] = 1
+    A0[1, 9:12, 19:22] = 1
+    C0 = np.stack([rng.random(nfm), C_shared])
+    # patch 1: the shared cell, an uncorrelated cell overlapping with it, and a
+    # cell of its own
+    A1 = np.zeros((3, h, 24))
+    A1[0, 9:12, 3:6] = 1
+    A1[1, 10:13, 4:7] = 1
+    A1[2, 9:12, 18:21] = 1
+    C1 = np.stack([C_shared + rng.random(nfm) * 0.01, rng.random(nfm), rng.random(nfm)])
+    res_ls = [
+        patch_result(A0, C0, height, width[:24]),
+        patch_result(A1, C1, height, width[16:]),
+    ]
+    res = merge_patches(res_ls, patches, xr.DataArray(height), xr.DataArray(width))
+    assert set(res.keys()) == {"A", "C"}
+    # the copy from patch 0 is dropped since it lies closer to the border of its
+    # patch (3 pixels) than the copy from patch 1 (4 pixels)
+    assert list(res["A"].coords["unit_id"].values) == [0, 2, 3, 4]
+    assert list(res["C"].coords["unit_id"].values) == [0, 2, 3, 4]
+    A = as_dense(res["A"]).compute()
+    assert A.shape == (4, h, w)
+    assert (A.coords["height"].values == height).all()
+    assert (A.coords["width"].values == width).all()
+    A_exp = np.zeros((4, h, w))
+    A_exp[0, 9:12, 4:7] = 1
+    A_exp[1, 9:12, 19:22] = 1
+    A_exp[2, 10:13, 20:23] = 1
+    A_exp[3, 9:12, 34:37] = 1
+    assert (A.values == A_exp).all()
+    assert np.allclose(res["C"].values, np.concatenate([C0[:1], C1]))
+
+
+def test_cnmf_patch_requires_iterations():
+    with pytest.raises(ValueError):
+        cnmf_patch(None, n_iter=0)
+
+
+def test_cnmf_tiled(tmp_path, monkeypatch):
+    np.random.seed(42)
+    h, w, nfm = 30, 70, 300
+    cents = [(15, 6), (10, 22), (20, 35), (12, 50), (18, 63)]
+    A = np.stack([gauss_cell(h, w, 2, 0.5, cent=c) for c in cents])
+    A[A < 0.05] = 0
+    C = np.stack([ar_trace(nfm, 0.05, np.array([0.9]))[0] for _ in cents])
+    Y = xr.DataArray(
+        np.einsum("uhw,uf->fhw", A, C),
+        dims=["frame", "height", "width"],
+        coords={"frame": np.arange(nfm), "height": np.arange(h), "width": np.arange(w)},
+    )
+    intpath = str(tmp_path)
+    monkeypatch.setenv("MINIAN_INTERMEDIATE", intpath)
+    npch = len(get_patches(h, w, 32, 16))
+    int_ls = []
+
+    def patch_func(Y_pch, sig):
+        # stand-in for cnmf_patch: report every cell whose footprint lies
+        # entirely within the patch, with noise specific to the patch
+        int_ls.append(os.environ["MINIAN_INTERMEDIATE"])
+        hs, ws = Y_pch.coords["height"].values, Y_pch.coords["width"].values
+        A_pch = A[:, hs[0] : hs[-1] + 1, ws[0] : ws[-1] + 1]
+        inside = np.isclose(A_pch.sum(axis=(1, 2)), A.sum(axis=(1, 2)))
+        if not inside.any():
+            return None
+        uids = np.where(inside)[0] + 100
+        return {
+            "A": xr.DataArray(
+                A_pch[inside],
+                dims=["unit_id", "height", "width"],
+                coords={"unit_id": uids, "height": hs, "width": ws},
+            ),
+            "C": xr.DataArray(
+                C[inside] + np.random.normal(scale=sig, size=(inside.sum(), nfm)),
+                dims=["unit_id", "frame"],
+                coords={"unit_id": uids, "frame": Y_pch.coords["frame"].values},
+            ),
+            "b": Y_pch.mean("frame"),
+            "f": Y_pch.mean(["height", "width"]),
+        }
+
+    res = cnmf_tiled(Y, 32, 16, patch_func=patch_func, sig=0.01)
+    assert os.environ["MINIAN_INTERMEDIATE"] == intpath
+    assert int_ls == [os.path.join(intpath, "patch{}".format(i)) for i in range(npch)]
+    # per-patch background is dropped
+    assert set(res.keys()) == {"A", "C"}
+    # cells found in two patches are only kept once
+    A_res = as_dense(res["A"]).compute()
+    assert A_res.sizes["unit_id"] == len(cents)
+    assert (A_res.coords["unit_id"] == res["C"].coords["unit_id"]).all()
+    order = np.argsort(
+        (A_res * A_res.coords["width"]).sum(["height", "width"]).values
+        / A_res.sum(["height", "width"]).values
+    )
+    assert np.allclose(A_res.values[order], A)
+    assert np.abs(res["C"].values[order] - C).max() < 0.1
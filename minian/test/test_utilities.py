@@ -0,0 +1,136 @@
+import os
+
+import dask.array as darr
+import numpy as np
+import pytest
+import xarray as xr
+import zarr
+from scipy.sparse import csc_matrix
+
+from ..utilities import (
+    as_dense,
+    as_sparse,
+    compute_projections,
+    is_sparse,
+    open_minian,
+    save_minian,
+    sps_lstsq_gram,
+)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.int16, np.float32])
+def test_compute_projections(dtype):
+    rng = np.random.default_rng(42)
+    nfm, h, w = 60, 20, 30
+    if np.issubdtype(dtype, np.integer):
+        lo, hi = np.iinfo(dtype).min, np.iinfo(dtype).max
+        arr = rng.integers(max(lo, -300), min(hi, 300), (nfm, h, w)).astype(dtype)
+        hist_range = None
+    else:
+        arr = (rng.random((nfm, h, w)) * 255).astype(dtype)
+        hist_range = (0, 255)
+    varr = xr.DataArray(
+        darr.from_array(arr, chunks=(7, 8, -1)),
+        dims=["frame", "height", "width"],
+        coords={"frame": np.arange(nfm), "height": np.arange(h), "width": np.arange(w)},
+    )
+    q = [0, 5, 50, 95, 100]
+    proj = compute_projections(
+        varr,
+        ("min", "max", "mean", "std", "percentile"),
+        q=q,
+        nbins=256,
+        hist_range=hist_range,
+    ).compute()
+    assert proj["min"].dims == ("height", "width")
+    assert proj["min"].dtype == dtype
+    assert (proj["min"].values == arr.min(axis=0)).all()
+    assert (proj["max"].values == arr.max(axis=0)).all()
+    assert np.allclose(proj["mean"].values, arr.mean(axis=0, dtype=np.float64))
+    assert np.allclose(proj["std"].values, arr.std(axis=0, dtype=np.float64))
+    assert proj["percentile"].dims == ("q", "height", "width")
+    pct = np.percentile(arr, q, axis=0)
+    if dtype == np.uint8:
+        # each bin holds a single value, only the interpolation between ranks
+        # is subject to rounding
+        assert np.allclose(proj["percentile"].values, pct, rtol=0, atol=1e-9)
+    else:
+        lo, hi = hist_range or (np.iinfo(dtype).min, np.iinfo(dtype).max + 1)
+        width = np.ceil((hi - lo) / 256)
+        assert np.abs(proj["percentile"].values - pct).max() <= width
+
+
+def test_compute_projections_multiple_dims():
+    rng = np.random.default_rng(42)
+    arr = rng.random((40, 12, 16, 2))
+    varr = xr.DataArray(
+        darr.from_array(arr, chunks=(9, 5, -1, 1)),
+        dims=["frame", "height", "width", "session"],
+        coords={"frame": np.arange(40), "session": ["a", "b"]},
+    )
+    proj = compute_projections(
+        varr, ["min", "max", "mean"], dim=["height", "width"]
+    ).compute()
+    assert proj["mean"].dims == ("frame", "session")
+    assert (proj["session"].values == ["a", "b"]).all()
+    assert (proj["min"].values == arr.min(axis=(1, 2))).all()
+    assert (proj["max"].values == arr.max(axis=(1, 2))).all()
+    assert np.allclose(proj["mean"].values, arr.mean(axis=(1, 2)))
+
+
+def test_compute_projections_unknown_stat():
+    varr = xr.DataArray(np.zeros((3, 2, 2)), dims=["frame", "height", "width"])
+    with pytest.raises(ValueError):
+        compute_projections(varr, ["median"])
+    with pytest.raises(ValueError):
+        compute_projections(varr, ["percentile"])
+
+
+def test_sps_lstsq_gram():
+    rng = np.random.default_rng(42)
+    m, n, nfm = 400, 12, 50
+    a = np.zeros((m, n))
+    for i in range(n):
+        a[rng.choice(m, 40, replace=False), i] = rng.random(40)
+    b = rng.random((nfm, m))
+    x_exp = np.linalg.lstsq(a, b.T, rcond=None)[0].T
+    A = darr.from_array(a, chunks=-1).map_blocks(csc_matrix)
+    x = sps_lstsq_gram(A, darr.from_array(b, chunks=(7, -1))).compute()
+    assert x.shape == (nfm, n)
+    assert np.abs(x - x_exp).max() < 1e-13
+    # singular gram matrix from identical columns falls back to lsqr
+    a_sing = np.concatenate([a, a[:, :1]], axis=1)
+    x_sing = sps_lstsq_gram.pyfunc(csc_matrix(a_sing), b)
+    assert np.allclose(a_sing @ x_sing.T, a @ x_exp.T, atol=1e-4)
+
+
+def test_save_open_sparse(tmp_path):
+    rng = np.random.default_rng(42)
+    nu, h, w = 5, 12, 16
+    A = rng.random((nu, h, w)) * (rng.random((nu, h, w)) > 0.8)
+    A[2] = 0
+    A = xr.DataArray(
+        A,
+        dims=["unit_id", "height", "width"],
+        coords={
+            "unit_id": np.arange(nu) + 3,
+            "height": np.arange(h) * 2,
+            "width": np.arange(w) + 10,
+            "unit_labels": ("unit_id", np.array([0, 1, 1, 2, 3])),
+        },
+        name="A",
+    )
+    dpath = str(tmp_path / "minian")
+    A_sv = save_minian(as_sparse(A.chunk({"unit_id": 1})), dpath)
+    assert is_sparse(A_sv)
+    # stored as a csr matrix of shape (pixels, units)
+    zg = zarr.open_group(os.path.join(dpath, "A.zarr"), mode="r")
+    assert zg.attrs["sparse_format"] == "csr"
+    assert zg["data"].shape == ((A.values > 0).sum(),)
+    assert zg["indptr"].shape == (h * w + 1,)
+    A_ld = open_minian(dpath, return_dict=True)["A"]
+    assert is_sparse(A_ld)
+    assert A_ld.dims == A.dims
+    for d in ["unit_id", "height", "width", "unit_labels"]:
+        assert (A_ld.coords[d].values == A.coords[d].values).all()
+    assert (as_dense(A_ld).values == A.values).all()
@@ -0,0 +1,509 @@
+import os
+import warnings
+from typing import Callable, List, Optional
+
+import dask.array as darr
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import sparse
+import xarray as xr
+
+from .cnmf import (
+    adj_corr,
+    compute_trace,
+    get_noise_fft,
+    label_connected,
+    unit_merge,
+    update_background,
+    update_spatial,
+    update_temporal,
+)
+from .initialization import (
+    initA,
+    initC,
+    ks_refine,
+    pnr_refine,
+    seeds_init,
+    seeds_merge,
+)
+from .utilities import as_dense, as_sparse, get_optimal_chk, save_minian
+
+
+def get_patches(h: int, w: int, patch_size: int, overlap: int) -> List[dict]:
+    """
+    Partition the field of view into overlapping patches.
+
+    Patches are laid out on a regular grid, using the smallest number of
+    patches along each dimension such that neighboring patches overlap by at
+    least `overlap`. The patches are then spread evenly so that the first and
+    last patches are aligned with the edges of the field of view.
+
+    Parameters
+    ----------
+    h : int
+        Height of the field of view.
+    w : int
+        Width of the field of view.
+    patch_size : int
+        Size of each patch in pixels along both dimensions.
+    overlap : int
+        Size of overlap between neighboring patches in pixels. Should be
+        smaller than `patch_size` and larger than the diameter of cells.
+
+    Returns
+    -------
+    patches : List[dict]
+        List of patches. Each patch is represented as a dictionary mapping
+        "height" and "width" to positional slices, which can be passed to
+        :meth:`xarray.DataArray.isel`.
+    """
+    assert overlap < patch_size, "`overlap` must be smaller than `patch_size`"
+
+    def starts(n):
+        if n <= patch_size:
+            return [0]
+        npch = int(np.ceil((n - overlap) / (patch_size - overlap)))
+        return np.round(np.linspace(0, n - patch_size, npch)).astype(int).tolist()
+
+    return [
+        {
+            "height": slice(hs, min(hs + patch_size, h)),
+            "width": slice(ws, min(ws + patch_size, w)),
+        }
+        for hs in starts(h)
+        for ws in starts(w)
+    ]
+
+
+def cnmf_tiled(
+    Y: xr.DataArray,
+    patch_size: int,
+    overlap: int,
+    patch_func: Optional[Callable] = None,
+    thres_corr=0.8,
+    noise_freq: Optional[float] = None,
+    **kwargs,
+) -> dict:
+    """
+    Run initialization and CNMF on overlapping patches of the field of view,
+    then reconcile cells across patches.
+
+    The field of view is partitioned with :func:`get_patches`, and `patch_func`
+    is applied to each patch of `Y` in turn. Each patch uses its own
+    sub-directory under the intermediate path, and all steps within a patch
+    are parallelized with dask as usual, so the memory demand of each worker
+    is bounded by the size of a patch rather than the whole field of view.
+    The results are then merged with :func:`merge_patches`. Recordings with
+    multiple planes can be processed by calling this function on each plane.
+
+    Parameters
+    ----------
+    Y : xr.DataArray
+        Input movie data. Should have dimensions "frame", "height" and "width".
+    patch_size : int
+        Size of each patch. See :func:`get_patches`.
+    overlap : int
+        Size of overlap between neighboring patches. See :func:`get_patches`.
+    patch_func : Callable, optional
+        Function to process each patch. Should take the patch of `Y` as the
+        first argument, and return either `None` if no cell is found or a
+        dictionary containing at least the spatial footprints "A" and the
+        temporal components "C". Any other values with a "unit_id" dimension
+        will be merged alongside. If `None` then :func:`cnmf_patch` is used. By
+        default `None`.
+    thres_corr : float, optional
+        Threshold of temporal correlation for cells from different patches to
+        be considered as the same cell. See :func:`merge_patches`. By default
+        `0.8`.
+    noise_freq : float, optional
+        Cut-off frequency used to smooth the temporal components before
+        calculating correlation. If `None` then no smoothing will be done. By
+        default `None`.
+
+    Other Parameters
+    ----------------
+    **kwargs : dict
+        Keyword arguments passed to `patch_func`.
+
+    Returns
+    -------
+    res : dict
+        Dictionary with the same keys as the results of `patch_func`, where
+        each value with a "unit_id" dimension is merged across all patches.
+        Values without a "unit_id" dimension, like per-patch background, are
+        dropped. The spatial footprints "A" are returned as sparse-backed array
+        covering the whole field of view. `None` if no cell is found in any
+        patch.
+
+    See Also
+    -------
+    get_patches
+    cnmf_patch
+    merge_patches
+    """
+    if patch_func is None:
+        patch_func = cnmf_patch
+    intpath = os.environ["MINIAN_INTERMEDIATE"]
+    patches = get_patches(Y.sizes["height"], Y.sizes["width"], patch_size, overlap)
+    res_ls, pch_ls = [], []
+    for ipch, pch in enumerate(patches):
+        print("processing patch {} out of {}".format(ipch + 1, len(patches)))
+        os.environ["MINIAN_INTERMEDIATE"] = os.path.join(
+            intpath, "patch{}".format(ipch)
+        )
+        try:
+            res = patch_func(Y.isel(**pch), **kwargs)
+        finally:
+            os.environ["MINIAN_INTERMEDIATE"] = intpath
+        if res is not None and res["A"].sizes["unit_id"] > 0:
+            res_ls.append(res)
+            pch_ls.append(pch)
+    if not res_ls:
+        warnings.warn("No cell found in any patch")
+        return None
+    print("merging patches")
+    return merge_patches(
+        res_ls,
+        pch_ls,
+        Y.coords["height"],
+        Y.coords["width"],
+        thres_corr=thres_corr,
+        noise_freq=noise_freq,
+    )
+
+
+def cnmf_patch(
+    Y: xr.DataArray,
+    param_seeds_init: Optional[dict] = None,
+    param_pnr_refine: Optional[dict] = None,
+    param_ks_refine: Optional[dict] = None,
+    param_seeds_merge: Optional[dict] = None,
+    param_initialize: Optional[dict] = None,
+    param_init_merge: Optional[dict] = None,
+    param_get_noise: Optional[dict] = None,
+    param_spatial: Optional[dict] = None,
+    param_temporal: Optional[dict] = None,
+    param_merge: Optional[dict] = None,
+    n_iter=2,
+) -> Optional[dict]:
+    """
+    Run the standard initialization and CNMF pipeline on a single patch.
+
+    The steps follow the pipeline notebook: seeds are initialized and refined
+    with :func:`~minian.initialization.seeds_init`,
+    :func:`~minian.initialization.pnr_refine`,
+    :func:`~minian.initialization.ks_refine` and
+    :func:`~minian.initialization.seeds_merge`, spatial and temporal
+    components are initialized with :func:`~minian.initialization.initA` and
+    :func:`~minian.initialization.initC`, then `n_iter` iterations of
+    :func:`~minian.cnmf.update_spatial`, :func:`~minian.cnmf.update_background`
+    and :func:`~minian.cnmf.update_temporal` are carried out, with
+    :func:`~minian.cnmf.unit_merge` in between iterations. All intermediate
+    variables are saved under the intermediate path.
+
+    Parameters
+    ----------
+    Y : xr.DataArray
+        Input movie data of the patch. Should have dimensions "frame",
+        "height" and "width".
+    param_seeds_init, param_pnr_refine, param_ks_refine, param_seeds_merge,
+    param_initialize, param_init_merge, param_get_noise : dict, optional
+        Keyword arguments passed to the corresponding steps, named in the same
+        way as the pipeline notebook. By default `None`, in which case the
+        defaults of each function are used.
+    param_spatial, param_temporal, param_merge : dict, optional
+        Keyword arguments passed to :func:`~minian.cnmf.update_spatial`,
+        :func:`~minian.cnmf.update_temporal` and :func:`~minian.cnmf.unit_merge`
+        in every iteration. By default `None`.
+    n_iter : int, optional
+        Number of CNMF iterations. Should be at least `1`. By default `2`.
+
+    Returns
+    -------
+    res : dict
+        Dictionary containing spatial footprints "A", temporal components "C",
+        deconvolved spikes "S", baseline fluorescence "b0" and initial
+        calcium concentration "c0". The spatial footprints are sparse-backed.
+        `None` if no cell is found in the patch.
+
+    Raises
+    ------
+    ValueError
+        if `n_iter` is smaller than `1`
+    """
+    if n_iter < 1:
+        raise ValueError("n_iter should be at least 1, got {}".format(n_iter))
+    param_seeds_init = param_seeds_init or dict()
+    param_pnr_refine = param_pnr_refine or dict()
+    param_ks_refine = param_ks_refine or dict()
+    param_seeds_merge = param_seeds_merge or dict()
+    param_initialize = param_initialize or dict()
+    param_init_merge = param_init_merge or dict()
+    param_get_noise = param_get_noise or dict()
+    param_spatial = param_spatial or dict()
+    param_temporal = param_temporal or dict()
+    param_merge = param_merge or dict()
+    intpath = os.environ["MINIAN_INTERMEDIATE"]
+    chk, _ = get_optimal_chk(Y, dtype=float)
+    Y_fm_chk = save_minian(
+        Y.astype(float)
+        .chunk({"frame": chk["frame"], "height": -1, "width": -1})
+        .rename("Y_fm_chk"),
+        intpath,
+        overwrite=True,
+    )
+    Y_hw_chk = save_minian(
+        Y_fm_chk.rename("Y_hw_chk"),
+        intpath,
+        overwrite=True,
+        chunks={"frame": -1, "height": chk["height"], "width": chk["width"]},
+    )
+    max_proj = Y_fm_chk.max("frame").compute()
+    seeds = seeds_init(Y_fm_chk, **param_seeds_init)
+    if not len(seeds):
+        return None
+    seeds, pnr, gmm = pnr_refine(Y_hw_chk, seeds, **param_pnr_refine)
+    seeds = ks_refine(Y_hw_chk, seeds, **param_ks_refine)
+    seeds = seeds[seeds["mask_ks"] & seeds["mask_pnr"]].reset_index(drop=True)
+    if not len(seeds):
+        return None
+    seeds = seeds_merge(Y_hw_chk, max_proj, seeds, **param_seeds_merge)
+    A = initA(Y_hw_chk, seeds[seeds["mask_mrg"]], **param_initialize)
+    A = save_minian(as_sparse(A).rename("A_init"), intpath, overwrite=True)
+    C = initC(Y_fm_chk, A)
+    C = save_minian(
+        C.rename("C_init"), intpath, overwrite=True, chunks={"unit_id": 1, "frame": -1}
+    )
+    A, C = unit_merge(A, C, **param_init_merge)
+    A = save_minian(A.rename("A"), intpath, overwrite=True)
+    C = save_minian(C.rename("C"), intpath, overwrite=True)
+    C_chk = save_minian(
+        C.rename("C_chk"),
+        intpath,
+        overwrite=True,
+        chunks={"unit_id": -1, "frame": chk["frame"]},
+    )
+    b, f = update_background(Y_fm_chk, A, C_chk)
+    f = save_minian(f.rename("f"), intpath, overwrite=True)
+    b = save_minian(b.rename("b"), intpath, overwrite=True)
+    sn_spatial = save_minian(
+        get_noise_fft(Y_hw_chk, **param_get_noise).rename("sn_spatial"),
+        intpath,
+        overwrite=True,
+    )
+    for it in range(n_iter):
+        if it > 0:
+            A, C, [sig] = unit_merge(A, C, [C + b0 + c0], **param_merge)
+            A = save_minian(A.rename("A_mrg"), intpath, overwrite=True)
+            C = save_minian(C.rename("C_mrg"), intpath, overwrite=True)
+            C_chk = save_minian(
+                C.rename("C_mrg_chk"),
+                intpath,
+                overwrite=True,
+                chunks={"unit_id": -1, "frame": chk["frame"]},
+            )
+        A_new, mask, norm_fac = update_spatial(
+            Y_hw_chk, A, C, sn_spatial, **param_spatial
+        )
+        if not A_new.sizes["unit_id"]:
+            return None
+        C_new = save_minian(
+            (C.sel(unit_id=mask) * norm_fac).rename("C_new"), intpath, overwrite=True
+        )
+        C_chk_new = save_minian(
+            (C_chk.sel(unit_id=mask) * norm_fac).rename("C_chk_new"),
+            intpath,
+            overwrite=True,
+        )
+        b_new, f_new = update_background(Y_fm_chk, A_new, C_chk_new)
+        A = save_minian(
+            A_new.rename("A"),
+            intpath,
+            overwrite=True,
+            chunks={"unit_id": 1, "height": -1, "width": -1},
+        )
+        b = save_minian(b_new.rename("b"), intpath, overwrite=True)
+        f = save_minian(
+            f_new.chunk({"frame": chk["frame"]}).rename("f"), intpath, overwrite=True
+        )
+        C = save_minian(C_new.rename("C"), intpath, overwrite=True)
+        C_chk = save_minian(C_chk_new.rename("C_chk"), intpath, overwrite=True)
+        YrA = save_minian(
+            compute_trace(Y_fm_chk, A, b, C_chk, f).rename("YrA"),
+            intpath,
+            overwrite=True,
+            chunks={"unit_id": 1, "frame": -1},
+        )
+        C_new, S_new, b0_new, c0_new, g, mask = update_temporal(
+            A, C, YrA=YrA, **param_temporal
+        )
+        if not C_new.sizes["unit_id"]:
+            return None
+        C = save_minian(
+            C_new.rename("C").chunk({"unit_id": 1, "frame": -1}),
+            intpath,
+            overwrite=True,
+        )
+        C_chk = save_minian(
+            C.rename("C_chk"),
+            intpath,
+            overwrite=True,
+            chunks={"unit_id": -1, "frame": chk["frame"]},
+        )
+        S = save_minian(
+            S_new.rename("S").chunk({"unit_id": 1, "frame": -1}),
+            intpath,
+            overwrite=True,
+        )
+        b0 = save_minian(
+            b0_new.rename("b0").chunk({"unit_id": 1, "frame": -1}),
+            intpath,
+            overwrite=True,
+        )
+        c0 = save_minian(
+            c0_new.rename("c0").chunk({"unit_id": 1, "frame": -1}),
+            intpath,
+            overwrite=True,
+        )
+        A = A.sel(unit_id=C.coords["unit_id"].values)
+    return {"A": A, "C": C, "S": S, "b0": b0, "c0": c0}
+
+
+def merge_patches(
+    res_ls: List[dict],
+    patches: List[dict],
+    height: xr.DataArray,
+    width: xr.DataArray,
+    thres_corr=0.8,
+    noise_freq: Optional[float] = None,
+) -> dict:
+    """
+    Merge results from overlapping patches and remove duplicated cells.
+
+    Cells from all patches are placed back into the whole field of view and
+    given new consecutive "unit_id". Any pair of cells from different patches
+    whose spatial footprints overlap and whose temporal components have
+    correlation higher than `thres_corr` are considered duplicates, and
+    duplicates are transitively grouped together. Within each group, only the
+    cell whose centroid lies farthest from the borders of its own patch is
+    kept, since its footprint is least likely to be truncated by the patch.
+    Borders of patches that coincide with the edge of the field of view are
+    not considered.
+
+    Parameters
+    ----------
+    res_ls : List[dict]
+        Results from each patch. Each should be a dictionary containing at
+        least the spatial footprints "A" and the temporal components "C".
+    patches : List[dict]
+        Patches as returned by :func:`get_patches`, in the same order as
+        `res_ls`.
+    height : xr.DataArray
+        "height" coordinate of the whole field of view.
+    width : xr.DataArray
+        "width" coordinate of the whole field of view.
+    thres_corr : float, optional
+        Threshold of temporal correlation. By default `0.8`.
+    noise_freq : float, optional
+        Cut-off frequency used to smooth the temporal components before
+        calculating correlation. If `None` then no smoothing will be done. By
+        default `None`.
+
+    Returns
+    -------
+    res : dict
+        Dictionary with the same keys as each element of `res_ls`, except for
+        values without a "unit_id" dimension, which are dropped. The spatial
+        footprints "A" are returned as sparse-backed array covering the whole
+        field of view, while all other values are concatenated along the
+        "unit_id" dimension. In particular, spatial and temporal background
+        "b" and "f" estimated within each patch cannot be reconciled across
+        patches and are not returned. They should be re-estimated on the whole
+        field of view if needed, e.g. with
+        :func:`~minian.cnmf.update_background`.
+    """
+    h, w = len(height), len(width)
+    crd_ls, dat_ls, pid_ls, dist_ls, uid_ls = [], [], [], [], []
+    nu = 0
+    for ipch, (res, pch) in enumerate(zip(res_ls, patches)):
+        A = as_dense(res["A"].transpose("unit_id", "height", "width")).compute()
+        A_sps = sparse.COO(np.asarray(A.values))
+        uid, hs, ws = A_sps.coords
+        hs, ws = hs + pch["height"].start, ws + pch["width"].start
+        cur_nu = A.sizes["unit_id"]
+        wt = np.bincount(uid, A_sps.data, minlength=cur_nu)
+        cent_h = np.bincount(uid, A_sps.data * hs, minlength=cur_nu) / wt
+        cent_w = np.bincount(uid, A_sps.data * ws, minlength=cur_nu) / wt
+        bnds = [
+            (pch["height"].start, pch["height"].stop, h, cent_h),
+            (pch["width"].start, pch["width"].stop, w, cent_w),
+        ]
+        dist = np.full(cur_nu, np.inf)
+        for st, ed, n, cent in bnds:
+            if st > 0:
+                dist = np.minimum(dist, cent - st)
+            if ed < n:
+                dist = np.minimum(dist, ed - 1 - cent)
+        crd_ls.append(np.stack([uid + nu, hs, ws]))
+        dat_ls.append(A_sps.data)
+        pid_ls.append(np.full(cur_nu, ipch))
+        dist_ls.append(dist)
+        uid_ls.append((A.coords["unit_id"].values, np.arange(cur_nu) + nu))
+        nu += cur_nu
+    crd = np.concatenate(crd_ls, axis=1)
+    A_all = sparse.COO(crd, np.concatenate(dat_ls), shape=(nu, h, w))
+    pid, dist = np.concatenate(pid_ls), np.concatenate(dist_ls)
+    uid_all = np.arange(nu)
+    print("computing overlap across patches")
+    A_bin = scipy.sparse.csr_matrix(
+        (np.ones(crd.shape[1], dtype=np.float32), (crd[0], crd[1] * w + crd[2])),
+        shape=(nu, h * w),
+    )
+    A_inter = scipy.sparse.tril(A_bin @ A_bin.T, k=-1).tocoo()
+    cross = pid[A_inter.row] != pid[A_inter.col]
+    A_inter = scipy.sparse.csr_matrix(
+        (A_inter.data[cross], (A_inter.row[cross], A_inter.col[cross])),
+        shape=(nu, nu),
+    )
+    out = dict()
+    for key, val in res_ls[0].items():
+        if key == "A" or "unit_id" not in val.dims:
+            continue
+        out[key] = xr.concat(
+            [
+                res[key].sel(unit_id=old).assign_coords(unit_id=new)
+                for res, (old, new) in zip(res_ls, uid_ls)
+            ],
+            "unit_id",
+        )
+    keep = np.ones(nu, dtype=bool)
+    if A_inter.nnz > 0:
+        print("computing temporal correlation across patches")
+        nod_df = pd.DataFrame({"unit_id": uid_all})
+        C = out["C"].chunk({"unit_id": 1, "frame": -1})
+        adj = adj_corr(C, A_inter, nod_df, noise_freq)
+        adj = adj > thres_corr
+        adj = adj + adj.T
+        labels = label_connected(adj, only_connected=True)
+        dup_df = pd.DataFrame({"label": labels, "dist": dist})
+        dup_df = dup_df[dup_df["label"] >= 0]
+        keep[dup_df.index] = False
+        keep[dup_df.groupby("label")["dist"].idxmax().values] = True
+    print(
+        "{} out of {} units removed as duplicates across patches".format(
+            nu - keep.sum(), nu
+        )
+    )
+    out = {k: v.sel(unit_id=uid_all[keep]) for k, v in out.items()}
+    A_all = A_all[keep]
+    out["A"] = xr.DataArray(
+        darr.from_array(A_all, chunks=-1, asarray=False),
+        dims=["unit_id", "height", "width"],
+        coords={
+            "unit_id": uid_all[keep],
+            "height": height.values,
+            "width": width.values,
+        },
+    )
+    return {k: out[k] for k in res_ls[0].keys() if k in out}
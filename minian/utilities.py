@@ -19,6 +19,7 @@ import ffmpeg
 import numpy as np
 import pandas as pd
 import rechunker
+import sparse
 import xarray as xr
 import zarr as zr
 from dask.core import flatten
@@ -29,8 +30,8 @@ from distributed.diagnostics.plugin import SchedulerPlugin
 from distributed.scheduler import SchedulerState, cast
 from natsort import natsorted
 from scipy.ndimage.filters import median_filter
-from scipy.sparse import csc_matrix
-from scipy.sparse.linalg import lsqr
+from scipy.sparse import csc_matrix, csr_matrix
+from scipy.sparse.linalg import lsqr, splu
 from tifffile import TiffFile, imread
 
 
@@ -330,7 +331,11 @@ def open_minian(
         for d in listdir(dpath):
             arr_path = pjoin(dpath, d)
             if isdir(arr_path):
-                arr = list(xr.open_zarr(arr_path).values())[0]
+                arr_ds = xr.open_zarr(arr_path)
+                if arr_ds.attrs.get("sparse_format") == "csr":
+                    dslist.append(sparse_from_dataset(arr_ds))
+                    continue
+                arr = list(arr_ds.values())[0]
                 arr.data = darr.from_zarr(
                     os.path.join(arr_path, arr.name), inline_array=True
                 )
@@ -455,7 +460,9 @@ def save_minian(
     `var.name + ".zarr"`. Optionally metadata can be retrieved from directory
     hierarchy and added as coordinates of the `xr.DataArray`. In addition, an
     on-disk rechunking of the result can be performed using
-    :func:`rechunker.rechunk` if `chunks` are given.
+    :func:`rechunker.rechunk` if `chunks` are given. Sparse-backed arrays (see
+    :func:`as_sparse`) are stored natively with :func:`sparse_to_dataset`, in
+    which case `chunks` is ignored.
 
     Parameters
     ----------
@@ -508,7 +515,8 @@ def save_minian(
     """
     dpath = os.path.normpath(dpath)
     Path(dpath).mkdir(parents=True, exist_ok=True)
-    ds = var.to_dataset()
+    sps = is_sparse(var)
+    ds = sparse_to_dataset(var) if sps else var.to_dataset()
     if meta_dict is not None:
         pathlist = os.path.split(os.path.abspath(dpath))[0].split(os.sep)
         ds = ds.assign_coords(
@@ -522,7 +530,7 @@ def save_minian(
         except FileNotFoundError:
             pass
     arr = ds.to_zarr(fp, compute=compute, mode=md)
-    if (chunks is not None) and compute:
+    if (chunks is not None) and compute and not sps:
         chunks = {d: var.sizes[d] if v <= 0 else v for d, v in chunks.items()}
         dst_path = os.path.join(dpath, str(uuid4()))
         temp_path = os.path.join(dpath, str(uuid4()))
@@ -545,12 +553,179 @@ def save_minian(
         for f in os.listdir(dst_path):
             os.rename(os.path.join(dst_path, f), os.path.join(arr_path, f))
         os.rmdir(dst_path)
-    if compute:
+    if compute and sps:
+        arr = sparse_from_dataset(xr.open_zarr(fp))
+    elif compute:
         arr = xr.open_zarr(fp)[var.name]
         arr.data = darr.from_zarr(os.path.join(fp, var.name), inline_array=True)
     return arr
 
 
+def is_sparse(arr: xr.DataArray) -> bool:
+    """
+    Check whether a `xr.DataArray` is backed by sparse arrays.
+
+    Parameters
+    ----------
+    arr : xr.DataArray
+        The input array, either backed by a numpy/sparse array or a dask array.
+
+    Returns
+    -------
+    is_sps : bool
+        Whether the data (or the blocks of the dask array) are
+        :class:`sparse.SparseArray`.
+    """
+    data = arr.data
+    if isinstance(data, darr.Array):
+        data = data._meta
+    return isinstance(data, sparse.SparseArray)
+
+
+def as_sparse(arr: xr.DataArray) -> xr.DataArray:
+    """
+    Convert a `xr.DataArray` to be backed by :class:`sparse.COO`.
+
+    This is the preferred representation of spatial footprints `A`, which are
+    mostly zeros. The conversion is lazy if the input is backed by dask, in
+    which case each block is converted separately. Sparse-backed spatial
+    footprints are accepted by all functions in :mod:`minian.cnmf`, are
+    preserved by :func:`minian.cnmf.update_spatial`, and are stored natively
+    by :func:`save_minian`.
+
+    Parameters
+    ----------
+    arr : xr.DataArray
+        The input array.
+
+    Returns
+    -------
+    arr : xr.DataArray
+        The sparse-backed array. Returned as-is if already sparse.
+
+    See Also
+    -------
+    as_dense
+    """
+    if is_sparse(arr):
+        return arr
+    if isinstance(arr.data, darr.Array):
+        return arr.copy(data=arr.data.map_blocks(sparse.COO, dtype=arr.dtype))
+    return arr.copy(data=sparse.COO(arr.data))
+
+
+def as_dense(arr: xr.DataArray) -> xr.DataArray:
+    """
+    Materialize a sparse-backed `xr.DataArray` as dense array.
+
+    The conversion is lazy if the input is backed by dask, so only the blocks
+    that are eventually computed will be materialized.
+
+    Parameters
+    ----------
+    arr : xr.DataArray
+        The input array.
+
+    Returns
+    -------
+    arr : xr.DataArray
+        The dense array. Returned as-is if already dense.
+
+    See Also
+    -------
+    as_sparse
+    """
+    if not is_sparse(arr):
+        return arr
+    if isinstance(arr.data, darr.Array):
+        return arr.copy(
+            data=arr.data.map_blocks(lambda a: a.todense(), dtype=arr.dtype)
+        )
+    return arr.copy(data=arr.data.todense())
+
+
+def sparse_to_dataset(var: xr.DataArray) -> xr.Dataset:
+    """
+    Convert a sparse-backed `xr.DataArray` into a `xr.Dataset` for storage.
+
+    The first dimension of `var` is treated as units (columns) and all the
+    remaining dimensions are flattened as pixels (rows), and the result is
+    stored as a CSR matrix of shape (pixels, units) in the data variables
+    "data", "indices" and "indptr". All coordinates of `var` are preserved, and
+    the information necessary to restore `var` are stored as attributes.
+
+    Parameters
+    ----------
+    var : xr.DataArray
+        The sparse-backed input array.
+
+    Returns
+    -------
+    ds : xr.Dataset
+        The resulting dataset.
+
+    See Also
+    -------
+    sparse_from_dataset
+    """
+    data = var.data
+    if isinstance(data, darr.Array):
+        data = data.compute()
+    data = sparse.COO(data)
+    nu = data.shape[0]
+    csr = csr_matrix(data.reshape((nu, -1)).to_scipy_sparse().T)
+    csr.sort_indices()
+    ds = xr.Dataset(
+        {
+            "data": ("nnz", csr.data),
+            "indices": ("nnz", csr.indices),
+            "indptr": ("nptr", csr.indptr),
+        },
+        coords=var.coords,
+        attrs={
+            "sparse_format": "csr",
+            "name": var.name,
+            "dims": list(var.dims),
+            "shape": list(var.shape),
+        },
+    )
+    return ds
+
+
+def sparse_from_dataset(ds: xr.Dataset) -> xr.DataArray:
+    """
+    Restore a sparse-backed `xr.DataArray` from a `xr.Dataset`.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        The dataset created by :func:`sparse_to_dataset`.
+
+    Returns
+    -------
+    arr : xr.DataArray
+        The restored array, backed by a dask array with a single
+        :class:`sparse.COO` block.
+
+    See Also
+    -------
+    sparse_to_dataset
+    """
+    dims, shape = tuple(ds.attrs["dims"]), tuple(ds.attrs["shape"])
+    csr = csr_matrix(
+        (ds["data"].values, ds["indices"].values, ds["indptr"].values),
+        shape=(int(np.prod(shape[1:])), shape[0]),
+    )
+    data = sparse.COO.from_scipy_sparse(csr.T.tocoo()).reshape(shape)
+    coords = {k: v for k, v in ds.coords.items() if set(v.dims) <= set(dims)}
+    return xr.DataArray(
+        darr.from_array(data, chunks=-1, asarray=False),
+        dims=dims,
+        coords=coords,
+        name=ds.attrs["name"],
+    )
+
+
 def xrconcat_recursive(var: Union[dict, list], dims: List[str]) -> xr.Dataset:
     """
     Recursively concatenate `xr.DataArray` over multiple dimensions.
@@ -774,11 +949,307 @@ def factors(x: int) -> List[int]:
     return [i for i in range(1, x + 1) if x % i == 0]
 
 
+def compute_projections(
+    varr: xr.DataArray,
+    stats=("min", "max", "mean"),
+    q: Union[float, List[float]] = 50,
+    nbins=256,
+    hist_range: Optional[tuple] = None,
+    dim: Union[str, List[str]] = "frame",
+    split_every=8,
+) -> xr.Dataset:
+    """
+    Compute multiple projections of an array in a single pass.
+
+    The projections are computed along dimension(s) `dim` for every other
+    pixel.
+    Each chunk of the input array is read once and reduced into a small
+    per-chunk state (count, minimum, maximum, running mean and sum of squared
+    deviation, and optionally a per-pixel histogram). The states are then
+    combined with a tree reduction and finalized into the requested
+    projections. Hence any combination of projections only costs one read of
+    `varr`.
+
+    Parameters
+    ----------
+    varr : xr.DataArray
+        The input array. Should have dimension(s) `dim`.
+    stats : tuple, optional
+        Projections to compute. Should be a subset of `"min"`, `"max"`,
+        `"mean"`, `"std"` and `"percentile"`. By default `("min", "max",
+        "mean")`.
+    q : Union[float, List[float]], optional
+        Percentile(s) to compute, between 0 and 100. Only used if
+        `"percentile"` is in `stats`. By default `50`.
+    nbins : int, optional
+        Number of bins of the per-pixel histogram used to estimate percentiles.
+        For integer inputs the bin width is rounded up to an integer, hence the
+        estimation is exact if `nbins` is no less than the range of the data
+        (e.g. `256` for `uint8` input). By default `256`.
+    hist_range : tuple, optional
+        Lower and upper range of the histogram. Values outside the range are
+        counted in the first or last bin. If `None` then the full range of the
+        integer `dtype` of `varr` will be used. Required for floating point
+        inputs. By default `None`.
+    dim : Union[str, List[str]], optional
+        The dimension along which projections are computed. If a list, then
+        projections are computed across all the listed dimensions. By default
+        `"frame"`.
+    split_every : int, optional
+        Number of chunk states combined by each task in the tree reduction. By
+        default `8`.
+
+    Returns
+    -------
+    proj : xr.Dataset
+        Dataset containing one variable for each projection in `stats`. The
+        `"percentile"` variable has an additional dimension `"q"` if `q` is a
+        list.
+
+    Raises
+    ------
+    ValueError
+        if `stats` contains unknown projections
+    ValueError
+        if `"percentile"` is requested for a floating point input without
+        `hist_range`
+
+    Notes
+    -----
+    The memory cost of the histogram is proportional to `nbins` times the
+    number of pixels in each chunk. Hence it is recommended to compute
+    percentiles on arrays that are chunked along spatial dimensions.
+    """
+    stats = list(stats)
+    stat_unk = set(stats) - {"min", "max", "mean", "std", "percentile"}
+    if stat_unk:
+        raise ValueError("Don't understand projections {}".format(stat_unk))
+    dims = [dim] if isinstance(dim, str) else list(dim)
+    nfm = int(np.prod([varr.sizes[d] for d in dims]))
+    if "percentile" in stats:
+        if hist_range is None:
+            if not np.issubdtype(varr.dtype, np.integer):
+                raise ValueError(
+                    "`hist_range` is required to compute percentile of {} input".format(
+                        varr.dtype
+                    )
+                )
+            info = np.iinfo(varr.dtype)
+            hist_range = (info.min, info.max + 1)
+        lo, hi = hist_range
+        width = (hi - lo) / nbins
+        if np.issubdtype(varr.dtype, np.integer):
+            width = max(int(np.ceil(width)), 1)
+            nbins = int(np.ceil((hi - lo) / width))
+        cnt_dtype = np.min_scalar_type(nfm)
+        bins = (lo, width, nbins, cnt_dtype)
+    else:
+        bins = None
+    varr = varr.transpose(*dims, ...)
+    rest_dims = varr.dims[len(dims) :]
+    arr = varr.data
+    if not isinstance(arr, darr.Array):
+        arr = darr.from_array(arr, chunks=-1)
+    if len(dims) > 1:
+        arr = arr.reshape((nfm,) + arr.shape[len(dims) :])
+    qs = np.atleast_1d(q)
+    res_blks = {s: np.empty(arr.numblocks[1:], dtype=object) for s in stats}
+    for ib in np.ndindex(arr.numblocks[1:]):
+        states = [
+            da.delayed(proj_chunk)(arr.blocks[(it,) + ib], stats, bins)
+            for it in range(arr.numblocks[0])
+        ]
+        while len(states) > 1:
+            states = [
+                da.delayed(proj_combine)(states[i : i + split_every])
+                for i in range(0, len(states), split_every)
+            ]
+        res = da.delayed(proj_finalize)(states[0], stats, qs, bins)
+        shp = tuple([c[i] for c, i in zip(arr.chunks[1:], ib)])
+        for s in stats:
+            if s == "percentile":
+                res_blks[s][ib] = darr.from_delayed(
+                    res[s], shape=(len(qs),) + shp, dtype=float
+                )
+            elif s in ["min", "max"]:
+                res_blks[s][ib] = darr.from_delayed(res[s], shape=shp, dtype=arr.dtype)
+            else:
+                res_blks[s][ib] = darr.from_delayed(res[s], shape=shp, dtype=float)
+    coords = {d: varr.coords[d] for d in rest_dims if d in varr.coords}
+    proj = xr.Dataset()
+    for s in stats:
+        if s == "percentile":
+            pct = xr.DataArray(
+                darr.block([res_blks[s].tolist()]),
+                dims=("q",) + rest_dims,
+                coords=dict(q=qs, **coords),
+            )
+            if np.ndim(q) == 0:
+                pct = pct.squeeze("q")
+            proj[s] = pct
+        else:
+            proj[s] = xr.DataArray(
+                darr.block(res_blks[s].tolist()), dims=rest_dims, coords=coords
+            )
+    return proj
+
+
+def proj_chunk(a: np.ndarray, stats: List[str], bins: Optional[tuple]) -> dict:
+    """
+    Reduce a chunk into the state used to compute projections.
+
+    Parameters
+    ----------
+    a : np.ndarray
+        The input chunk. Projections are computed along the first axis.
+    stats : List[str]
+        List of requested projections.
+    bins : tuple, optional
+        Tuple of lower range, bin width, number of bins and dtype of the counts
+        of the histogram. If `None` then no histogram will be computed.
+
+    Returns
+    -------
+    state : dict
+        The state of the chunk.
+
+    See Also
+    -------
+    compute_projections
+    """
+    state = {"n": a.shape[0]}
+    if {"min", "percentile"} & set(stats):
+        state["min"] = a.min(axis=0)
+    if {"max", "percentile"} & set(stats):
+        state["max"] = a.max(axis=0)
+    if {"mean", "std"} & set(stats):
+        state["mean"] = a.mean(axis=0, dtype=np.float64)
+    if "std" in stats:
+        state["m2"] = ((a - state["mean"]) ** 2).sum(axis=0)
+    if bins is not None:
+        lo, width, nbins, cnt_dtype = bins
+        npx = int(np.prod(a.shape[1:]))
+        ibin = (a.reshape((a.shape[0], -1)).astype(np.float64) - lo) // width
+        ibin = np.clip(ibin, 0, nbins - 1)
+        ibin = ibin.astype(np.intp) * npx + np.arange(npx)
+        hist = np.bincount(ibin.ravel(), minlength=nbins * npx)
+        state["hist"] = hist.reshape((nbins,) + a.shape[1:]).astype(cnt_dtype)
+    return state
+
+
+def proj_combine(states: List[dict]) -> dict:
+    """
+    Combine the states of multiple chunks.
+
+    Running means and sum of squared deviations are combined with the parallel
+    algorithm described by Chan et al.
+
+    Parameters
+    ----------
+    states : List[dict]
+        List of states to be combined.
+
+    Returns
+    -------
+    state : dict
+        The combined state.
+
+    See Also
+    -------
+    compute_projections
+    """
+    state = states[0].copy()
+    for st in states[1:]:
+        n = state["n"] + st["n"]
+        if "min" in state:
+            state["min"] = np.minimum(state["min"], st["min"])
+        if "max" in state:
+            state["max"] = np.maximum(state["max"], st["max"])
+        if "mean" in state:
+            delta = st["mean"] - state["mean"]
+            if "m2" in state:
+                state["m2"] = (
+                    state["m2"] + st["m2"] + delta ** 2 * state["n"] * st["n"] / n
+                )
+            state["mean"] = state["mean"] + delta * st["n"] / n
+        if "hist" in state:
+            state["hist"] = state["hist"] + st["hist"]
+        state["n"] = n
+    return state
+
+
+def proj_finalize(
+    state: dict, stats: List[str], q: np.ndarray, bins: Optional[tuple]
+) -> dict:
+    """
+    Compute projections from the final state.
+
+    Percentiles are interpolated linearly between closest ranks as in
+    :func:`numpy.percentile`, where the value at each rank is located from the
+    cumulative histogram. The value is assumed to be uniformly distributed
+    within each bin, except when each bin holds a single integer value, in
+    which case the result is exact. The result is also clipped to the range of
+    the data.
+
+    Parameters
+    ----------
+    state : dict
+        The final state.
+    stats : List[str]
+        List of requested projections.
+    q : np.ndarray
+        Percentiles to compute.
+    bins : tuple, optional
+        Tuple of lower range, bin width, number of bins and dtype of the counts
+        of the histogram.
+
+    Returns
+    -------
+    proj : dict
+        Dictionary mapping the name of each projection to its result.
+
+    See Also
+    -------
+    compute_projections
+    """
+    proj = dict()
+    for s in ["min", "max", "mean"]:
+        if s in stats:
+            proj[s] = state[s]
+    if "std" in stats:
+        proj["std"] = np.sqrt(state["m2"] / state["n"])
+    if "percentile" in stats:
+        lo, width, nbins, _ = bins
+        exact = width == 1 and isinstance(width, int)
+        cum = np.cumsum(state["hist"], axis=0)
+        rank = np.asarray(q, dtype=float) / 100 * (state["n"] - 1)
+        pct = []
+        for r in rank:
+            val = []
+            for k in (np.floor(r), np.ceil(r)):
+                ibin = (cum <= k).sum(axis=0)[np.newaxis]
+                cnt = np.take_along_axis(state["hist"], ibin, axis=0)[0]
+                cum_pre = np.take_along_axis(cum, ibin, axis=0)[0] - cnt
+                edge = lo + ibin[0] * width
+                if exact:
+                    val.append(edge.astype(float))
+                else:
+                    val.append(edge + width * (k - cum_pre + 0.5) / cnt)
+            pct.append(val[0] + (val[1] - val[0]) * (r - np.floor(r)))
+        proj["percentile"] = np.clip(np.stack(pct), state["min"], state["max"])
+    return proj
+
+
 ANNOTATIONS = {
     "from-zarr-store": {"resources": {"MEM": 1}},
     "load_avi_ffmpeg": {"resources": {"MEM": 1}},
     "est_motion_chunk": {"resources": {"MEM": 1}},
+    "est_motion_online_chunk": {"resources": {"MEM": 1}},
     "transform_perframe": {"resources": {"MEM": 0.5}},
+    "shift_frames": {"resources": {"MEM": 1}},
+    "warp_frames": {"resources": {"MEM": 1}},
+    "shift_block": {"resources": {"MEM": 1}},
+    "proj_chunk": {"resources": {"MEM": 1}},
     "pnr_perseed": {"resources": {"MEM": 0.5}},
     "ks_perseed": {"resources": {"MEM": 0.5}},
     "smooth_corr": {"resources": {"MEM": 1}},
@@ -1300,8 +1771,7 @@ def med_baseline(a: np.ndarray, wnd: int) -> np.ndarray:
         Timeseries with baseline subtracted.
     """
     base = median_filter(a, size=wnd)
-    a -= base
-    return a.clip(0, None)
+    return (a - base).clip(0, None)
 
 
 @darr.as_gufunc(signature="(m,n),(m)->(n)", output_dtypes=float)
@@ -1310,3 +1780,32 @@ def sps_lstsq(a: csc_matrix, b: np.ndarray, **kwargs):
     for i in range(b.shape[0]):
         out[i, :] = lsqr(a, b[i, :].squeeze(), **kwargs)[0]
     return out
+
+
+@darr.as_gufunc(signature="(m,n),(m)->(n)", output_dtypes=float)
+def sps_lstsq_gram(a: csc_matrix, b: np.ndarray) -> np.ndarray:
+    """
+    Solve least-square problems sharing the same sparse design matrix through
+    the normal equations.
+
+    The Gram matrix `a.T @ a` is factorized once with :func:`splu`, and all rows
+    of `b` are solved at once as a matrix right-hand side. If the Gram matrix is
+    singular, this function falls back to :func:`sps_lstsq`.
+
+    Parameters
+    ----------
+    a : csc_matrix
+        The design matrix with shape (m, n).
+    b : np.ndarray
+        The dependent variables with shape (..., m).
+
+    Returns
+    -------
+    x : np.ndarray
+        The least-square solutions with shape (..., n).
+    """
+    try:
+        lu = splu(csc_matrix(a.T @ a))
+    except RuntimeError:
+        return sps_lstsq.pyfunc(a, b)
+    return lu.solve(np.asarray(a.T @ b.T, dtype=float)).T
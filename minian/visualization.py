@@ -41,7 +41,12 @@ from scipy.spatial import cKDTree
 
 from .cnmf import compute_AtC
 from .motion_correction import apply_shifts
-from .utilities import custom_arr_optimize, rechunk_like
+from .utilities import (
+    as_dense,
+    compute_projections,
+    custom_arr_optimize,
+    rechunk_like,
+)
 
 
 class VArrayViewer:
@@ -170,21 +175,35 @@ class VArrayViewer:
         self.str_box = BoxEdit()
         self.widgets = self._widgets()
         if type(summary) is list:
-            summ_all = {
-                "mean": self.ds.mean(["height", "width"]),
-                "max": self.ds.max(["height", "width"]),
-                "min": self.ds.min(["height", "width"]),
-                "diff": self.ds.diff("frame").mean(["height", "width"]),
-            }
-            try:
-                summ = {k: summ_all[k] for k in summary}
-            except KeyError:
+            summ = dict()
+            if set(summary) - {"mean", "max", "min", "diff"}:
                 print("{} Not understood for specifying summary".format(summary))
+            elif summary:
+                # all projections of each array are computed in a single pass
+                sp_dims = ["height", "width"]
+                stats = [s for s in ["mean", "max", "min"] if s in summary]
+                proj = {
+                    k: compute_projections(v, stats, dim=sp_dims)
+                    for k, v in self.ds.data_vars.items()
+                }
+                for s in summary:
+                    if s == "diff":
+                        summ[s] = xr.Dataset(
+                            {
+                                k: compute_projections(
+                                    v.diff("frame"), ["mean"], dim=sp_dims
+                                )["mean"]
+                                for k, v in self.ds.data_vars.items()
+                            }
+                        )
+                    else:
+                        summ[s] = xr.Dataset({k: p[s] for k, p in proj.items()})
             if summ:
                 print("computing summary")
-                sum_list = []
-                for k, v in summ.items():
-                    sum_list.append(v.compute().assign_coords(sum_var=k))
+                sum_list = dask.compute(*summ.values())
+                sum_list = [
+                    v.assign_coords(sum_var=k) for k, v in zip(summ.keys(), sum_list)
+                ]
                 summary = xr.concat(sum_list, dim="sum_var")
         self.summary = summary
         if layout:
@@ -447,7 +466,7 @@ class CNMFViewer:
             then cells are simply grouped in 5 by ascending "unit_id". By
             default `True`.
         """
-        self._A = A if A is not None else minian["A"]
+        self._A = as_dense(A if A is not None else minian["A"])
         self._C = C if C is not None else minian["C"]
         self._S = S if S is not None else minian["S"]
         self._org = org if org is not None else minian["org"]
@@ -1023,7 +1042,7 @@ class AlignViewer:
         self.mappings = mappings
         self.shiftds = shiftds
         self.brt_offset = brt_offset
-        A = self.minian_ds["A"]
+        A = as_dense(self.minian_ds["A"])
         self.shifts = rechunk_like(self.shiftds["shifts"], A)
         self.Ash = apply_shifts(A, self.shifts, fill=0)
         # option widgets
@@ -1605,7 +1624,7 @@ def centroid(A: xr.DataArray, verbose=False) -> pd.DataFrame:
     )
     cents = xr.apply_ufunc(
         gu_rel_cent,
-        A.chunk(dict(height=-1, width=-1)),
+        as_dense(A).chunk(dict(height=-1, width=-1)),
         input_core_dims=[["height", "width"]],
         output_core_dims=[["dim"]],
         dask="allowed",
@@ -1868,7 +1887,7 @@ def visualize_spatial_update(
         C_dict = dict(dummy=C_dict)
     hv_pts_dict, hv_A_dict, hv_Ab_dict, hv_C_dict = (dict(), dict(), dict(), dict())
     for key, A in A_dict.items():
-        A = A.compute()
+        A = as_dense(A).compute()
         C = C_dict[key]
         if norm:
             C = xr.apply_ufunc(
@@ -2056,7 +2075,7 @@ def visualize_temporal_update(
                 )
                 for tr in [c, s, sig]
             ]
-        hv_A[k] = hv.Dataset(A_dict[k].rename("A")).to(
+        hv_A[k] = hv.Dataset(as_dense(A_dict[k]).rename("A")).to(
             hv.Image, kdims=["width", "height"]
         )
         h, w = A_dict[k].sizes["height"], A_dict[k].sizes["width"]